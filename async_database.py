@@ -0,0 +1,393 @@
+"""
+Асинхронный интерфейс к database.py.
+
+Каждая функция — awaitable-двойник одноимённой функции из database.py.
+Синхронный вызов (SQLite или HTTP-запрос к Supabase) выполняется в
+ограниченном пуле потоков, поэтому медленный fsync или сетевой запрос
+не блокирует event loop aiogram.
+
+При DB_BACKEND=postgres запросы идут напрямую в postgres_client (asyncpg)
+без пула потоков; кэш пользователей database.user_cache общий для всех
+бэкендов.
+
+Метрики (см. metrics.py):
+    db_pool_queue_wait_seconds — ожидание свободного потока пула
+    db_pool_call_seconds       — время выполнения самого запроса
+    db_pool_in_flight          — запросов в очереди и в работе
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import DB_POOL_SIZE
+import database as db
+import metrics
+import migrations
+import postgres_client as pg
+
+
+USE_POSTGRES = pg.is_postgres_enabled()
+
+# Чтение полей строки пользователя не обращается к БД — реэкспортируем как есть
+user_field = db.user_field
+user_timestamp = db.user_timestamp
+user_cache = db.user_cache
+
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+_in_flight = 0
+
+
+async def run(func, *args):
+    """
+    Выполнить синхронную функцию БД в пуле потоков
+
+    Args:
+        func: Функция из database.py
+        *args: Аргументы функции
+
+    Returns:
+        Результат функции
+    """
+    global _in_flight
+
+    enqueued = time.perf_counter()
+
+    def job():
+        started = time.perf_counter()
+        metrics.observe("db_pool_queue_wait_seconds", started - enqueued)
+        try:
+            return func(*args)
+        finally:
+            metrics.observe("db_pool_call_seconds", time.perf_counter() - started)
+
+    _in_flight += 1
+    metrics.set_gauge("db_pool_in_flight", _in_flight)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, job)
+    finally:
+        _in_flight -= 1
+        metrics.set_gauge("db_pool_in_flight", _in_flight)
+
+
+async def shutdown():
+    """Дождаться завершения запросов пула и закрыть соединения"""
+    await pg.close_pool()
+    _executor.shutdown(wait=True)
+    db.close_connections()
+
+
+async def init_db():
+    if USE_POSTGRES:
+        # DDL выполняется синхронным psycopg2 — в пуле потоков
+        await run(migrations.migrate_postgres, pg.DATABASE_URL)
+        await pg.init_pool()
+        return
+    return await run(db.init_db)
+
+
+async def db_execute(query, params=(), fetchone=False, fetchall=False, commit=False):
+    """Сырой SQL в синтаксисе SQLite (плейсхолдеры ?), только для SQLite"""
+    return await run(db.db_execute, query, params, fetchone, fetchall, commit)
+
+
+# User locks (см. user_locks.user_lock)
+async def acquire_user_lease(tg_id: int, owner: str, ttl: int) -> bool:
+    if USE_POSTGRES:
+        return await pg.acquire_user_lease(tg_id, owner, ttl)
+    return await run(db.acquire_user_lease, tg_id, owner, ttl)
+
+
+async def release_user_lease(tg_id: int, owner: str):
+    if USE_POSTGRES:
+        return await pg.release_user_lease(tg_id, owner)
+    return await run(db.release_user_lease, tg_id, owner)
+
+
+# User management
+async def get_user(tg_id: int):
+    if USE_POSTGRES:
+        return await user_cache.get_or_load_async(tg_id, lambda: pg.get_user(tg_id))
+    return await run(db.get_user, tg_id)
+
+
+async def user_exists(tg_id: int) -> bool:
+    if USE_POSTGRES:
+        return user_cache.get(tg_id) is not None or await pg.user_exists(tg_id)
+    return await run(db.user_exists, tg_id)
+
+
+async def create_user(tg_id: int, username: str, referrer_id=None):
+    if USE_POSTGRES:
+        await pg.create_user(tg_id, username, referrer_id)
+        user_cache.invalidate(tg_id)
+        return
+    return await run(db.create_user, tg_id, username, referrer_id)
+
+
+async def bootstrap_user(tg_id: int, username: str, referrer_id=None) -> tuple:
+    if USE_POSTGRES:
+        user, created = await pg.bootstrap_user(tg_id, username, referrer_id)
+        user_cache.set(tg_id, user)
+        if created and referrer_id:
+            user_cache.invalidate(referrer_id)
+        return user, created
+    return await run(db.bootstrap_user, tg_id, username, referrer_id)
+
+
+# Terms and conditions
+async def accept_terms(tg_id: int):
+    if USE_POSTGRES:
+        await pg.accept_terms(tg_id)
+        user_cache.invalidate(tg_id)
+        return
+    return await run(db.accept_terms, tg_id)
+
+
+async def has_accepted_terms(tg_id: int) -> bool:
+    if USE_POSTGRES:
+        return bool(user_field(await get_user(tg_id), "accepted_terms"))
+    return await run(db.has_accepted_terms, tg_id)
+
+
+# Subscription management
+async def update_subscription(tg_id: int, uuid: str, username: str, subscription_until: str, squad_uuid: str,
+                              subscription_url: str | None = None):
+    if USE_POSTGRES:
+        await pg.update_subscription(tg_id, uuid, username, subscription_until, squad_uuid, subscription_url)
+        user_cache.invalidate(tg_id)
+        return
+    return await run(db.update_subscription, tg_id, uuid, username, subscription_until, squad_uuid, subscription_url)
+
+
+async def sync_subscription(tg_id: int, subscription_until: str | None, subscription_url: str | None):
+    if USE_POSTGRES:
+        await pg.sync_subscription(tg_id, subscription_until, subscription_url)
+        user_cache.invalidate(tg_id)
+        return
+    return await run(db.sync_subscription, tg_id, subscription_until, subscription_url)
+
+
+async def has_subscription(tg_id: int) -> bool:
+    if USE_POSTGRES:
+        return user_field(await get_user(tg_id), "remnawave_uuid") is not None
+    return await run(db.has_subscription, tg_id)
+
+
+# Reconciliation with Remnawave
+async def get_subscription_states(tg_ids: list) -> dict:
+    if not tg_ids:
+        return {}
+    if USE_POSTGRES:
+        return await pg.get_subscription_states(tg_ids)
+    return await run(db.get_subscription_states, tg_ids)
+
+
+async def sync_subscriptions(rows: list, synced_before: int) -> int:
+    if not rows:
+        return 0
+    if USE_POSTGRES:
+        updated = await pg.sync_subscriptions(rows, synced_before)
+        for tg_id in updated:
+            user_cache.invalidate(tg_id)
+        return len(updated)
+    return await run(db.sync_subscriptions, rows, synced_before)
+
+
+async def get_sync_cursor(name: str) -> int:
+    if USE_POSTGRES:
+        return await pg.get_sync_cursor(name)
+    return await run(db.get_sync_cursor, name)
+
+
+async def set_sync_cursor(name: str, position: int):
+    if USE_POSTGRES:
+        return await pg.set_sync_cursor(name, position)
+    return await run(db.set_sync_cursor, name, position)
+
+
+# Payment management
+async def create_payment(tg_id: int, tariff_code: str, amount: float, provider: str, invoice_id: str,
+                         pay_url: str | None = None, expires_at: int | None = None):
+    if USE_POSTGRES:
+        return await pg.create_payment(tg_id, tariff_code, amount, provider, invoice_id, pay_url, expires_at)
+    return await run(db.create_payment, tg_id, tariff_code, amount, provider, invoice_id, pay_url, expires_at)
+
+
+async def get_open_invoice(tg_id: int, tariff_code: str, amount: float, valid_until: int):
+    if USE_POSTGRES:
+        return await pg.get_open_invoice(tg_id, tariff_code, amount, valid_until)
+    return await run(db.get_open_invoice, tg_id, tariff_code, amount, valid_until)
+
+
+async def get_pending_payments():
+    if USE_POSTGRES:
+        return await pg.get_pending_payments()
+    return await run(db.get_pending_payments)
+
+
+async def get_pending_payments_after(after_id: int = 0, limit: int = 1000):
+    if USE_POSTGRES:
+        return await pg.get_pending_payments_after(after_id, limit)
+    return await run(db.get_pending_payments_after, after_id, limit)
+
+
+async def get_last_pending_payment(tg_id: int):
+    if USE_POSTGRES:
+        return await pg.get_last_pending_payment(tg_id)
+    return await run(db.get_last_pending_payment, tg_id)
+
+
+async def get_payment_by_invoice(invoice_id: str):
+    if USE_POSTGRES:
+        return await pg.get_payment_by_invoice(invoice_id)
+    return await run(db.get_payment_by_invoice, invoice_id)
+
+
+async def update_payment_status(payment_id: int, status: str):
+    if USE_POSTGRES:
+        return await pg.update_payment_status(payment_id, status)
+    return await run(db.update_payment_status, payment_id, status)
+
+
+async def update_payment_status_by_invoice(invoice_id: str, status: str):
+    if USE_POSTGRES:
+        return await pg.update_payment_status_by_invoice(invoice_id, status)
+    return await run(db.update_payment_status_by_invoice, invoice_id, status)
+
+
+async def expire_payments(payment_ids: list) -> int:
+    if USE_POSTGRES:
+        return await pg.expire_payments(payment_ids)
+    return await run(db.expire_payments, payment_ids)
+
+
+# Activation outbox
+async def enqueue_activation(invoice_id: str, tg_id: int, tariff_code: str, days: int) -> bool:
+    if USE_POSTGRES:
+        return await pg.enqueue_activation(invoice_id, tg_id, tariff_code, days)
+    return await run(db.enqueue_activation, invoice_id, tg_id, tariff_code, days)
+
+
+async def claim_activation_jobs(owner: str, limit: int, lease_seconds: int, invoice_id: str | None = None) -> list:
+    if USE_POSTGRES:
+        return await pg.claim_activation_jobs(owner, limit, lease_seconds, invoice_id)
+    return await run(db.claim_activation_jobs, owner, limit, lease_seconds, invoice_id)
+
+
+async def save_activation_progress(invoice_id: str, owner: str, step: str | None, lease_seconds: int, fields: dict) -> bool:
+    if USE_POSTGRES:
+        fields = {k: v for k, v in fields.items() if k in db.ACTIVATION_PROGRESS_FIELDS}
+        return await pg.save_activation_progress(invoice_id, owner, step, lease_seconds, fields)
+    return await run(db.save_activation_progress, invoice_id, owner, step, lease_seconds, fields)
+
+
+async def count_activation_referral(invoice_id: str, owner: str, referrer_id: int | None, lease_seconds: int) -> bool:
+    if USE_POSTGRES:
+        counted = await pg.count_activation_referral(invoice_id, owner, referrer_id, lease_seconds)
+        if referrer_id:
+            user_cache.invalidate(referrer_id)
+        return counted
+    return await run(db.count_activation_referral, invoice_id, owner, referrer_id, lease_seconds)
+
+
+async def finish_activation_job(invoice_id: str, owner: str, state: str, attempts: int,
+                                next_attempt_at: int = 0, last_error: str | None = None):
+    if USE_POSTGRES:
+        return await pg.finish_activation_job(invoice_id, owner, state, attempts, next_attempt_at, last_error)
+    return await run(db.finish_activation_job, invoice_id, owner, state, attempts, next_attempt_at, last_error)
+
+
+async def get_activation_backlog() -> dict:
+    if USE_POSTGRES:
+        return await pg.get_activation_backlog()
+    return await run(db.get_activation_backlog)
+
+
+# Referral management
+async def update_referral_count(tg_id: int):
+    if USE_POSTGRES:
+        await pg.update_referral_count(tg_id)
+        user_cache.invalidate(tg_id)
+        return
+    return await run(db.update_referral_count, tg_id)
+
+
+async def increment_active_referrals(tg_id: int):
+    if USE_POSTGRES:
+        await pg.increment_active_referrals(tg_id)
+        user_cache.invalidate(tg_id)
+        return
+    return await run(db.increment_active_referrals, tg_id)
+
+
+async def get_referral_stats(tg_id: int):
+    if USE_POSTGRES:
+        user = await get_user(tg_id)
+        if not user:
+            return None
+        return (user_field(user, "referral_count"), user_field(user, "active_referrals"))
+    return await run(db.get_referral_stats, tg_id)
+
+
+async def get_referrer(tg_id: int):
+    if USE_POSTGRES:
+        user = await get_user(tg_id)
+        if not user:
+            return None
+        return (user_field(user, "referrer_id"), user_field(user, "first_payment"))
+    return await run(db.get_referrer, tg_id)
+
+
+async def mark_first_payment(tg_id: int):
+    if USE_POSTGRES:
+        await pg.mark_first_payment(tg_id)
+        user_cache.invalidate(tg_id)
+        return
+    return await run(db.mark_first_payment, tg_id)
+
+
+# Gift management
+async def is_gift_received(tg_id: int) -> bool:
+    if USE_POSTGRES:
+        return bool(user_field(await get_user(tg_id), "gift_received"))
+    return await run(db.is_gift_received, tg_id)
+
+
+async def mark_gift_received(tg_id: int):
+    if USE_POSTGRES:
+        await pg.mark_gift_received(tg_id)
+        user_cache.invalidate(tg_id)
+        return
+    return await run(db.mark_gift_received, tg_id)
+
+
+# Promo code management
+async def get_promo_code(code: str):
+    if USE_POSTGRES:
+        return await pg.get_promo_code(code)
+    return await run(db.get_promo_code, code)
+
+
+async def create_promo_code(code: str, days: int, max_uses: int):
+    if USE_POSTGRES:
+        return await pg.create_promo_code(code, days, max_uses)
+    return await run(db.create_promo_code, code, days, max_uses)
+
+
+async def increment_promo_usage(code: str):
+    if USE_POSTGRES:
+        return await pg.increment_promo_usage(code)
+    return await run(db.increment_promo_usage, code)
+
+
+async def redeem_promo_code(code: str):
+    if USE_POSTGRES:
+        return await pg.redeem_promo_code(code)
+    return await run(db.redeem_promo_code, code)
+
+
+async def release_promo_code(code: str):
+    if USE_POSTGRES:
+        return await pg.release_promo_code(code)
+    return await run(db.release_promo_code, code)
@@ -0,0 +1,121 @@
+"""
+Бенчмарк автомата отключения Remnawave.
+
+Локальная заглушка GET /users/{uuid} изображает упавшую панель: принимает
+соединение и не отвечает. Волны по --concurrency одновременных запросов
+(«Моя подписка» у разных пользователей) идут к ней через сессию без
+автомата (только UpstreamPolicy) и через сессию http_clients.remnawave с
+remnawave_breaker. Считаются время ответа обработчику и запросы, дошедшие
+до заглушки.
+
+Таймаут чтения — REMNAWAVE_READ_TIMEOUT (по умолчанию здесь 1 с вместо 10,
+чтобы замер шёл недолго).
+
+Запуск из корня проекта:
+    python benchmarks/bench_circuit_breaker.py [waves] [--concurrency 10]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOST, PORT = "127.0.0.1", 18550
+os.environ["REMNAWAVE_BASE_URL"] = f"http://{HOST}:{PORT}"
+os.environ["REMNAWAVE_RATE_LIMIT"] = "0"
+os.environ.setdefault("REMNAWAVE_READ_TIMEOUT", "1")
+
+from aiohttp import web  # noqa: E402
+
+import http_clients  # noqa: E402
+import metrics  # noqa: E402
+from config import (  # noqa: E402
+    HTTP_MAX_RETRIES,
+    HTTP_RETRY_BASE,
+    HTTP_RETRY_MAX,
+    REMNAWAVE_READ_TIMEOUT,
+    REMNAWAVE_BREAKER_MIN_CALLS,
+    REMNAWAVE_BREAKER_OPEN
+)
+from rate_limit import UpstreamPolicy  # noqa: E402
+from services import remnawave  # noqa: E402
+
+
+class Stub:
+    """Заглушка GET /users/{uuid}: панель не отвечает"""
+
+    def __init__(self):
+        self.requests = 0
+        # Отпускает зависшие запросы при остановке заглушки
+        self.stopped = asyncio.Event()
+
+    async def handle(self, request):
+        self.requests += 1
+        await self.stopped.wait()
+        return web.Response(status=503)
+
+
+async def run(name: str, session, stub: Stub, waves: int, concurrency: int):
+    stub.requests = 0
+    latencies = []
+
+    async def call(uuid: str):
+        started = time.perf_counter()
+        await remnawave.remnawave_get_user_info(session, uuid)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for wave in range(waves):
+        await asyncio.gather(*(call(f"{name}-{wave}-{i}") for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(
+        f"{name:<8} calls={len(latencies):<5} upstream requests={stub.requests:<5} "
+        f"p50={statistics.median(latencies) * 1000:8.1f} ms "
+        f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:8.1f} ms "
+        f"total={elapsed:6.1f} s"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("waves", nargs="?", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=10, help="одновременных запросов в волне")
+    args = parser.parse_args()
+    # Таймауты и отклонённые запросы пишут ошибки — в замере они не нужны
+    logging.disable(logging.CRITICAL)
+
+    stub = Stub()
+    app = web.Application()
+    app.router.add_get("/users/{uuid}", stub.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+
+    plain = http_clients._create_session(
+        {}, UpstreamPolicy("plain", 0, 0, HTTP_MAX_RETRIES, HTTP_RETRY_BASE, HTTP_RETRY_MAX)
+    )
+    await http_clients.init_sessions()
+    try:
+        await run("plain", plain, stub, args.waves, args.concurrency)
+        await run("breaker", http_clients.remnawave, stub, args.waves, args.concurrency)
+        print(
+            f"read timeout={REMNAWAVE_READ_TIMEOUT}s, retries={HTTP_MAX_RETRIES}, "
+            f"breaker min calls={REMNAWAVE_BREAKER_MIN_CALLS}, open={REMNAWAVE_BREAKER_OPEN}s"
+        )
+        print(metrics.render())
+    finally:
+        await plain.close()
+        await http_clients.close_sessions()
+        stub.stopped.set()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+"""
+Бенчмарк опроса CryptoBot: счёт за счётом против пачек getInvoices.
+
+Поднимает локальную заглушку CryptoBot API (aiohttp.web) с N счетами,
+из которых каждый сотый оплачен, и сравнивает прежний цикл
+get_invoice_status по каждому счёту с пакетным get_invoices.
+Считаются HTTP-запросы к заглушке и общее время.
+
+Запуск из корня проекта:
+    python benchmarks/bench_cryptobot_polling.py [invoices]
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOST, PORT = "127.0.0.1", 18543
+os.environ["SUPABASE_URL"] = ""
+os.environ["DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="spn_bench_"), "bench.db")
+os.environ["CRYPTOBOT_API_URL"] = f"http://{HOST}:{PORT}"
+os.environ["CRYPTOBOT_TOKEN"] = "bench"
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import http_clients  # noqa: E402
+from config import CRYPTOBOT_BATCH_SIZE  # noqa: E402
+from services.cryptobot import get_invoice_status, get_invoices  # noqa: E402
+
+
+class CryptoBotStub:
+    """Заглушка getInvoices: отдаёт только запрошенные счета"""
+
+    def __init__(self, count: int):
+        self.invoices = {
+            invoice_id: {
+                "invoice_id": invoice_id,
+                "status": "paid" if invoice_id % 100 == 0 else "active"
+            }
+            for invoice_id in range(1, count + 1)
+        }
+        self.requests = 0
+
+    async def get_invoices(self, request):
+        self.requests += 1
+        ids = [int(i) for i in request.query.get("invoice_ids", "").split(",") if i]
+        limit = int(request.query.get("count", 100))
+        items = [self.invoices[i] for i in ids if i in self.invoices][:limit]
+        return web.json_response({"ok": True, "result": {"items": items}})
+
+
+async def legacy_poll(invoice_ids: list) -> int:
+    """Прежний цикл: один запрос и одна сессия на каждый счёт"""
+    paid = 0
+    for invoice_id in invoice_ids:
+        async with aiohttp.ClientSession(headers={"Crypto-Pay-API-Token": "bench"}) as session:
+            invoice = await get_invoice_status(session, invoice_id)
+        if invoice and invoice.get("status") == "paid":
+            paid += 1
+    return paid
+
+
+async def batched_poll(invoice_ids: list) -> int:
+    paid = 0
+    async for invoices in get_invoices(http_clients.cryptobot, invoice_ids):
+        paid += sum(1 for invoice in invoices.values() if invoice.get("status") == "paid")
+    return paid
+
+
+async def run(name: str, poll, stub: CryptoBotStub, invoice_ids: list):
+    stub.requests = 0
+    started = time.perf_counter()
+    paid = await poll(invoice_ids)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<10} {len(invoice_ids)} invoices, paid={paid:<4} requests={stub.requests:<6} {elapsed:7.2f}s")
+    return elapsed
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    stub = CryptoBotStub(count)
+
+    app = web.Application()
+    app.router.add_get("/getInvoices", stub.get_invoices)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+
+    invoice_ids = [str(invoice_id) for invoice_id in stub.invoices]
+    await http_clients.init_sessions()
+    try:
+        print(f"batch size: {CRYPTOBOT_BATCH_SIZE}")
+        before = await run("per-id", legacy_poll, stub, invoice_ids)
+        after = await run("batched", batched_poll, stub, invoice_ids)
+        print(f"speedup: x{before / after:.1f}")
+    finally:
+        await http_clients.close_sessions()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
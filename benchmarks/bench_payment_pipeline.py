@@ -0,0 +1,114 @@
+"""
+Бенчмарк конвейера проверки платежей.
+
+Локальная заглушка отвечает за CryptoBot (все счета оплачены) и за
+Remnawave (каждый запрос с задержкой --latency мс). N оплаченных счетов
+в SQLite прогоняются через run_payment_check с одним обработчиком
+(как прежний последовательный цикл) и с PAYMENT_WORKERS обработчиками.
+
+Запуск из корня проекта:
+    python benchmarks/bench_payment_pipeline.py [invoices] [--latency 20]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOST, PORT = "127.0.0.1", 18544
+os.environ["SUPABASE_URL"] = ""
+os.environ["DB_BACKEND"] = ""
+os.environ["DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="spn_bench_"), "bench.db")
+os.environ["CRYPTOBOT_API_URL"] = f"http://{HOST}:{PORT}/crypto"
+os.environ["REMNAWAVE_BASE_URL"] = f"http://{HOST}:{PORT}/remna"
+os.environ["DEFAULT_SQUAD_UUID"] = "bench-squad"
+# Замеряется конвейер, а не клиентский лимит частоты
+os.environ["CRYPTOBOT_RATE_LIMIT"] = "0"
+os.environ["REMNAWAVE_RATE_LIMIT"] = "0"
+
+from aiohttp import web  # noqa: E402
+
+import async_database as db  # noqa: E402
+import http_clients  # noqa: E402
+import metrics  # noqa: E402
+from config import PAYMENT_WORKERS  # noqa: E402
+from services.cryptobot import run_payment_check  # noqa: E402
+
+
+class Stub:
+    """Заглушка CryptoBot и Remnawave"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def get_invoices(self, request):
+        ids = request.query.get("invoice_ids", "").split(",")
+        items = [{"invoice_id": int(i), "status": "paid"} for i in ids if i]
+        return web.json_response({"ok": True, "result": {"items": items}})
+
+    async def remnawave(self, request):
+        await asyncio.sleep(self.latency)
+        if request.method == "GET" and "by-username" in request.path:
+            return web.json_response({}, status=404)
+        uuid = f"uuid-{request.path.rsplit('/', 1)[-1]}"
+        return web.json_response({"response": {"uuid": uuid, "subscriptionUrl": f"https://sub/{uuid}"}})
+
+
+class Bot:
+    async def send_message(self, chat_id, text):
+        pass
+
+
+async def run(name: str, workers: int, count: int):
+    db.user_cache.clear()
+    await db.db_execute("UPDATE payments SET status = 'pending'", commit=True)
+    # Выполненные задачи outbox не повторяются — каждый прогон с чистой очередью
+    await db.db_execute("DELETE FROM activation_jobs", commit=True)
+    pending = await db.get_pending_payments()
+
+    started = time.perf_counter()
+    results = await run_payment_check(Bot(), http_clients.cryptobot, http_clients.remnawave, pending, workers)
+    processed = sum(1 for outcome in results.values() if outcome == "activated")
+    elapsed = time.perf_counter() - started
+    print(f"{name:<12} workers={workers:<3} processed={processed}/{count} in {elapsed:6.2f}s -> {processed / elapsed:,.1f} payments/sec")
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("invoices", nargs="?", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=20, help="задержка Remnawave, мс")
+    args = parser.parse_args()
+
+    stub = Stub(args.latency / 1000)
+    app = web.Application()
+    app.router.add_get("/crypto/getInvoices", stub.get_invoices)
+    app.router.add_route("*", "/remna/{tail:.*}", stub.remnawave)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+
+    await db.init_db()
+    for i in range(1, args.invoices + 1):
+        await db.create_user(i, f"user_{i}")
+        await db.create_payment(i, "1m", 100, "cryptobot", str(i))
+
+    await http_clients.init_sessions()
+    try:
+        before = await run("sequential", 1, args.invoices)
+        metrics.reset()
+        after = await run("pipeline", PAYMENT_WORKERS, args.invoices)
+        print(f"speedup: x{before / after:.1f}")
+        print(metrics.render())
+    finally:
+        await http_clients.close_sessions()
+        await runner.cleanup()
+        await db.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
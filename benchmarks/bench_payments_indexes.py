@@ -0,0 +1,98 @@
+"""
+Бенчмарк горячих запросов к payments на таблице в 1M строк.
+
+Замеряет запросы get_pending_payments, get_last_pending_payment и
+update_payment_status_by_invoice на схеме без индексов (версия 2), затем
+применяет оставшиеся миграции и повторяет замер.
+
+Запуск из корня проекта:
+    python benchmarks/bench_payments_indexes.py [rows]
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrations  # noqa: E402
+
+
+PENDING_SHARE = 0.01
+USERS = 100_000
+REPEATS = 50
+
+QUERIES = {
+    "get_pending_payments": (
+        "SELECT id, tg_id, invoice_id, tariff_code FROM payments "
+        "WHERE status = 'pending' AND provider = 'cryptobot'",
+        lambda rnd: ()
+    ),
+    "get_last_pending_payment": (
+        "SELECT invoice_id, tariff_code FROM payments "
+        "WHERE tg_id = ? AND status = 'pending' AND provider = 'cryptobot' "
+        "ORDER BY id DESC LIMIT 1",
+        lambda rnd: (rnd.randrange(USERS),)
+    ),
+    "update_payment_status_by_invoice": (
+        "UPDATE payments SET status = status WHERE invoice_id = ?",
+        lambda rnd: (str(rnd.randrange(1, 1_000_000)),)
+    )
+}
+
+
+def fill(conn: sqlite3.Connection, rows: int):
+    rnd = random.Random(1)
+    now = int(time.time())
+
+    def generate():
+        for i in range(1, rows + 1):
+            status = "pending" if rnd.random() < PENDING_SHARE else "paid"
+            yield (rnd.randrange(USERS), "1m", 100, status, now - i, "cryptobot", str(i))
+
+    conn.executemany(
+        "INSERT INTO payments (tg_id, tariff_code, amount, status, created_at, provider, invoice_id) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        generate()
+    )
+    conn.commit()
+
+
+def measure(conn: sqlite3.Connection, label: str):
+    rnd = random.Random(2)
+    print(f"-- {label}")
+    for name, (query, make_params) in QUERIES.items():
+        started = time.perf_counter()
+        for _ in range(REPEATS):
+            conn.execute(query, make_params(rnd)).fetchall()
+        conn.commit()
+        per_call = (time.perf_counter() - started) / REPEATS
+        print(f"{name:<34} {per_call * 1000:9.3f} ms/call")
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    path = os.path.join(tempfile.mkdtemp(prefix="spn_bench_"), "payments.db")
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+    migrations.migrate_sqlite(conn, target=2)
+    print(f"filling {rows} payments...")
+    fill(conn, rows)
+    measure(conn, "without indexes (schema v2)")
+
+    started = time.perf_counter()
+    migrations.migrate_sqlite(conn)
+    print(f"migrated to v{migrations.LATEST_VERSION} in {time.perf_counter() - started:.2f}s")
+    measure(conn, f"with indexes (schema v{migrations.LATEST_VERSION})")
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Бенчмарк: PostgREST (supabase_client) против прямого asyncpg (postgres_client).
+
+Нужны SUPABASE_URL, SUPABASE_KEY и DATABASE_URL, указывающие на одну базу
+с применёнными миграциями. Бенчмарк создаёт пользователя с tg_id=-1 и
+гоняет по нему чтение и атомарный инкремент счётчика.
+
+Запуск из корня проекта:
+    DB_BACKEND=postgres python benchmarks/bench_postgres_backends.py [ops] [concurrency]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("DB_BACKEND", "postgres")
+
+import postgres_client as pg  # noqa: E402
+import supabase_client  # noqa: E402
+
+
+BENCH_TG_ID = -1
+
+
+def report(name: str, ops: int, elapsed: float):
+    print(f"{name:<32} {ops} ops in {elapsed:.2f}s -> {ops / elapsed:,.0f} ops/sec, {elapsed / ops * 1000:.2f} ms/op")
+
+
+async def bench_postgrest(ops: int, concurrency: int):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(func):
+        async with semaphore:
+            await loop.run_in_executor(None, func, BENCH_TG_ID)
+
+    for name, func in (("postgrest get_user", supabase_client.get_user),
+                       ("postgrest update_referral_count", supabase_client.update_referral_count)):
+        started = time.perf_counter()
+        await asyncio.gather(*(one(func) for _ in range(ops)))
+        report(name, ops, time.perf_counter() - started)
+
+
+async def bench_asyncpg(ops: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(func):
+        async with semaphore:
+            await func(BENCH_TG_ID)
+
+    for name, func in (("asyncpg get_user", pg.get_user),
+                       ("asyncpg update_referral_count", pg.update_referral_count)):
+        started = time.perf_counter()
+        await asyncio.gather(*(one(func) for _ in range(ops)))
+        report(name, ops, time.perf_counter() - started)
+
+
+async def main():
+    ops = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    if not pg.is_postgres_enabled() or not supabase_client.is_supabase_enabled():
+        print("Set SUPABASE_URL, SUPABASE_KEY and DATABASE_URL (and install asyncpg)")
+        return
+
+    await pg.init_pool()
+    try:
+        await pg.create_user(BENCH_TG_ID, "bench")
+        await bench_postgrest(ops, concurrency)
+        await bench_asyncpg(ops, concurrency)
+    finally:
+        await pg.pool.execute("DELETE FROM users WHERE tg_id = $1", BENCH_TG_ID)
+        await pg.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+"""
+Конкурентный бенчмарк активации промокода.
+
+100 параллельных активаторов одновременно погашают промокод с лимитом 50.
+Сравниваются прежняя схема read-modify-write (прочитать used_count,
+прибавить 1 в Python, записать обратно — так работал supabase_client) и
+атомарный условный redeem_promo_code. Корректный результат: ровно 50
+успешных активаций и used_count == 50.
+
+Без аргументов работает на временной SQLite. С флагом --supabase гоняет
+атомарную схему через RPC Supabase (нужны SUPABASE_URL и SUPABASE_KEY).
+
+Запуск из корня проекта:
+    python benchmarks/bench_promo_concurrency.py [--supabase]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if "--supabase" not in sys.argv:
+    os.environ["SUPABASE_URL"] = ""
+    os.environ["DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="spn_bench_"), "promo.db")
+
+import database as db  # noqa: E402
+
+
+REDEEMERS = 100
+MAX_USES = 50
+
+
+def legacy_redeem(code: str):
+    """Прежняя схема: проверка и инкремент отдельными запросами"""
+    promo = db.get_promo_code(code)
+    if not promo or not promo[3] or promo[2] >= promo[1]:
+        return None
+    time.sleep(0.001)  # сетевая задержка между чтением и записью
+    db.db_execute(
+        "UPDATE promo_codes SET used_count = ? WHERE code = ?",
+        (promo[2] + 1, code),
+        commit=True
+    )
+    return promo
+
+
+def run(name: str, redeem, code: str):
+    db.create_promo_code(code, 30, MAX_USES)
+    barrier = threading.Barrier(REDEEMERS)
+    successes = []
+
+    def worker():
+        barrier.wait()
+        if redeem(code):
+            successes.append(1)
+
+    threads = [threading.Thread(target=worker) for _ in range(REDEEMERS)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    used_count = db.get_promo_code(code)[2]
+    lost = len(successes) - used_count
+    status = "OK" if len(successes) == MAX_USES and used_count == MAX_USES else "BROKEN"
+    print(
+        f"{name:<18} redeemed={len(successes):<4} used_count={used_count:<4} "
+        f"lost_increments={lost:<4} {elapsed * 1000:7.1f} ms  {status}"
+    )
+
+
+def main():
+    db.init_db()
+    if db.USE_SUPABASE:
+        run("atomic (supabase)", db.redeem_promo_code, "BENCH_ATOMIC")
+        return
+
+    run("read-modify-write", legacy_redeem, "BENCH_LEGACY")
+    run("atomic", db.redeem_promo_code, "BENCH_ATOMIC")
+    db.close_connections()
+
+
+if __name__ == "__main__":
+    main()
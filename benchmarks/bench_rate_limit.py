@@ -0,0 +1,109 @@
+"""
+Бенчмарк лимита частоты и повторов при 429/5xx.
+
+Локальная заглушка пропускает не больше --server-rate запросов в
+секунду (лишние получают 429 с Retry-After: 1) и отвечает 503 на долю
+запросов --error-rate. Всплеск из N одновременных GET отправляется
+сессией без политики (как раньше) и сессией с UpstreamPolicy, лимит
+которой чуть ниже лимита заглушки. Считаются успешные ответы, 429 и
+повторы.
+
+Запуск из корня проекта:
+    python benchmarks/bench_rate_limit.py [requests] [--server-rate 50] [--error-rate 0.05]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import metrics  # noqa: E402
+from rate_limit import UpstreamPolicy  # noqa: E402
+
+HOST, PORT = "127.0.0.1", 18546
+
+
+class Stub:
+    """Заглушка API с собственным лимитом частоты"""
+
+    def __init__(self, rate: float, error_rate: float):
+        self.rate = rate
+        self.burst = max(1, int(rate / 5))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.error_rate = error_rate
+        self.requests = 0
+        self.rejected = 0
+
+    async def handle(self, request):
+        self.requests += 1
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.rejected += 1
+            return web.json_response({"error": "rate limited"}, status=429, headers={"Retry-After": "1"})
+        self.tokens -= 1
+        if random.random() < self.error_rate:
+            return web.json_response({"error": "unavailable"}, status=503)
+        return web.json_response({"ok": True})
+
+
+async def burst(name: str, session: aiohttp.ClientSession, stub: Stub, count: int):
+    stub.requests = stub.rejected = 0
+    metrics.reset()
+
+    async def call():
+        async with session.get(f"http://{HOST}:{PORT}/status") as resp:
+            await resp.read()
+            return resp.status
+
+    started = time.perf_counter()
+    statuses = await asyncio.gather(*(call() for _ in range(count)))
+    elapsed = time.perf_counter() - started
+    ok = statuses.count(200)
+    counters = metrics.snapshot()["counters"]
+    print(
+        f"{name:<10} ok={ok}/{count} upstream requests={stub.requests:<5} 429={stub.rejected:<5} "
+        f"retries={counters.get('http_bench_retries', 0):<4} {elapsed:6.2f}s"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("requests", nargs="?", type=int, default=200)
+    parser.add_argument("--server-rate", type=float, default=50, help="лимит заглушки, запросов в секунду")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="доля ответов 503")
+    args = parser.parse_args()
+    # Каждый повтор пишет предупреждение — в замере они не нужны
+    logging.disable(logging.WARNING)
+
+    stub = Stub(args.server_rate, args.error_rate)
+    app = web.Application()
+    app.router.add_get("/status", stub.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+
+    policy = UpstreamPolicy("bench", args.server_rate * 0.9, max(1, int(args.server_rate / 5)), 3, 0.2, 5)
+    try:
+        async with aiohttp.ClientSession() as session:
+            await burst("no policy", session, stub, args.requests)
+        await asyncio.sleep(1)
+        async with aiohttp.ClientSession(middlewares=(policy,)) as session:
+            await burst("policy", session, stub, args.requests)
+        print(metrics.render())
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+"""
+Бенчмарк сверки users с Remnawave.
+
+Локальная заглушка Remnawave хранит N пользователей и отвечает с
+задержкой --latency мс. В SQLite у доли --drift пользователей
+испорчены дата окончания и ссылка. Сверка выполняется GET /users/{uuid}
+на каждого пользователя с записью по одному (наивный вариант) и
+reconcile_pass по страницам до конца круга. Считаются HTTP-запросы,
+время и исправленные строки.
+
+Запуск из корня проекта:
+    python benchmarks/bench_reconcile.py [users] [--latency 20] [--drift 0.05]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOST, PORT = "127.0.0.1", 18548
+os.environ["SUPABASE_URL"] = ""
+os.environ["DB_BACKEND"] = ""
+os.environ["DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="spn_bench_"), "bench.db")
+os.environ["REMNAWAVE_BASE_URL"] = f"http://{HOST}:{PORT}"
+os.environ["REMNAWAVE_RATE_LIMIT"] = "0"
+
+from aiohttp import web  # noqa: E402
+
+import async_database as db  # noqa: E402
+import database  # noqa: E402
+import http_clients  # noqa: E402
+from config import RECONCILE_PAGE_SIZE, RECONCILE_CONCURRENCY  # noqa: E402
+from services.reconcile import CURSOR, diff_page, reconcile_pass  # noqa: E402
+from services.remnawave import RemnawaveClient  # noqa: E402
+
+
+class RemnawaveStub:
+    """Заглушка GET /users (страницы) и GET /users/{uuid}"""
+
+    def __init__(self, count: int, latency: float):
+        self.latency = latency
+        self.requests = 0
+        base = datetime(2030, 1, 1, tzinfo=timezone.utc)
+        self.users = [
+            {
+                "uuid": f"uuid-{i}",
+                "username": f"tg_{i}",
+                "expireAt": (base + timedelta(days=i % 365)).isoformat().replace("+00:00", "Z"),
+                "subscriptionUrl": f"https://sub/uuid-{i}"
+            }
+            for i in range(1, count + 1)
+        ]
+        self.by_uuid = {user["uuid"]: user for user in self.users}
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if request.path == "/users":
+            start, size = int(request.query["start"]), int(request.query["size"])
+            return web.json_response({"response": {"users": self.users[start:start + size], "total": len(self.users)}})
+        user = self.by_uuid.get(request.path.rsplit("/", 1)[-1])
+        if user is None:
+            return web.json_response({}, status=404)
+        return web.json_response({"response": user})
+
+
+def seed(stub: RemnawaveStub, drift: float) -> int:
+    """Заполнить users копией Remnawave, испортив долю drift строк"""
+    conn = database.get_connection()
+    conn.execute("DELETE FROM users")
+    conn.execute("DELETE FROM sync_cursors")
+    rows, drifted = [], 0
+    for user in stub.users:
+        tg_id = int(user["username"][3:])
+        until = database._to_epoch(user["expireAt"])
+        url = user["subscriptionUrl"]
+        if random.random() < drift:
+            until, url, drifted = until - 86400 * 30, None, drifted + 1
+        rows.append((tg_id, user["uuid"], user["username"], until, url))
+    conn.executemany(
+        """
+        INSERT INTO users (tg_id, remnawave_uuid, remnawave_username, subscription_until, subscription_url)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        rows
+    )
+    conn.commit()
+    db.user_cache.clear()
+    return drifted
+
+
+async def per_user(concurrency: int) -> int:
+    """Наивная сверка: GET на каждого пользователя, запись по одному"""
+    client = RemnawaveClient(http_clients.remnawave)
+    tg_ids = [row[0] for row in database.get_connection().execute("SELECT tg_id FROM users")]
+    semaphore = asyncio.Semaphore(concurrency)
+    repaired = 0
+
+    async def check(tg_id: int):
+        nonlocal repaired
+        state = (await db.get_subscription_states([tg_id]))[tg_id]
+        async with semaphore:
+            user = await client.get_user(state[0])
+        for _, _, _, until, url in diff_page([user], {tg_id: state}):
+            await db.sync_subscription(tg_id, until, url)
+            repaired += 1
+
+    await asyncio.gather(*(check(tg_id) for tg_id in tg_ids))
+    return repaired
+
+
+async def paged() -> int:
+    """reconcile_pass до конца круга"""
+    repaired = 0
+    while True:
+        result = await reconcile_pass(http_clients.remnawave)
+        repaired += result["repaired"]
+        if result["position"] == 0:
+            return repaired
+
+
+async def run(name: str, reconcile, stub: RemnawaveStub, drift: float):
+    drifted = seed(stub, drift)
+    stub.requests = 0
+    started = time.perf_counter()
+    repaired = await reconcile()
+    elapsed = time.perf_counter() - started
+    left = len(diff_page(stub.users, await db.get_subscription_states([i for i in range(1, len(stub.users) + 1)])))
+    print(
+        f"{name:<10} users={len(stub.users):<6} drifted={drifted:<5} repaired={repaired:<5} left={left:<3} "
+        f"requests={stub.requests:<6} {elapsed:6.2f}s"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("users", nargs="?", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=20, help="задержка Remnawave, мс")
+    parser.add_argument("--drift", type=float, default=0.05, help="доля расходящихся пользователей")
+    args = parser.parse_args()
+
+    stub = RemnawaveStub(args.users, args.latency / 1000)
+    app = web.Application()
+    app.router.add_route("GET", "/{tail:.*}", stub.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+
+    await db.init_db()
+    await http_clients.init_sessions()
+    try:
+        await run("per-user", lambda: per_user(RECONCILE_CONCURRENCY), stub, args.drift)
+        await run("paged", paged, stub, args.drift)
+        print(f"page size={RECONCILE_PAGE_SIZE}, concurrency={RECONCILE_CONCURRENCY}, cursor={await db.get_sync_cursor(CURSOR)}")
+    finally:
+        await http_clients.close_sessions()
+        await runner.cleanup()
+        await db.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
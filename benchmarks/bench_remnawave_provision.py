@@ -0,0 +1,171 @@
+"""
+Бенчмарк выдачи подписки в Remnawave: прежняя последовательность против
+RemnawaveClient.provision.
+
+Локальная заглушка Remnawave хранит пользователей в памяти и отвечает с
+задержкой --latency мс. Для N новых пользователей и N продлений
+выполняется прежняя последовательность (GET по username, GET + PATCH
+продления, POST сквада, GET ссылки) и provision — с поиском по username
+и с UUID из БД. Считаются HTTP-запросы и время.
+
+Запуск из корня проекта:
+    python benchmarks/bench_remnawave_provision.py [users] [--latency 20]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid as uuid_lib
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOST, PORT = "127.0.0.1", 18547
+BASE = f"http://{HOST}:{PORT}"
+os.environ["REMNAWAVE_BASE_URL"] = BASE
+os.environ["DEFAULT_SQUAD_UUID"] = "squad-1"
+os.environ["REMNAWAVE_RATE_LIMIT"] = "0"
+
+from aiohttp import web  # noqa: E402
+
+import http_clients  # noqa: E402
+from services.remnawave import RemnawaveClient  # noqa: E402
+
+
+class RemnawaveStub:
+    """Заглушка Remnawave: пользователи в памяти"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.users = {}  # uuid -> user
+        self.requests = 0
+
+    def _public(self, user: dict) -> dict:
+        return {**user, "subscriptionUrl": f"https://sub/{user['uuid']}"}
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        path = request.path
+
+        if request.method == "GET" and path.startswith("/users/by-username/"):
+            username = path.rsplit("/", 1)[-1]
+            for user in self.users.values():
+                if user["username"] == username:
+                    return web.json_response({"response": self._public(user)})
+            return web.json_response({}, status=404)
+
+        if request.method == "GET" and path.startswith("/users/"):
+            user = self.users.get(path.rsplit("/", 1)[-1])
+            if user is None:
+                return web.json_response({}, status=404)
+            return web.json_response({"response": self._public(user)})
+
+        if request.method == "POST" and path == "/users":
+            body = await request.json()
+            user = {
+                "uuid": str(uuid_lib.uuid4()),
+                "username": body["username"],
+                "expireAt": body["expireAt"],
+                "activeInternalSquads": [{"uuid": s} for s in body.get("activeInternalSquads", [])]
+            }
+            self.users[user["uuid"]] = user
+            return web.json_response({"response": self._public(user)}, status=201)
+
+        if request.method == "PATCH" and path == "/users":
+            body = await request.json()
+            user = self.users[body["uuid"]]
+            if "expireAt" in body:
+                user["expireAt"] = body["expireAt"]
+            if "activeInternalSquads" in body:
+                user["activeInternalSquads"] = [{"uuid": s} for s in body["activeInternalSquads"]]
+            return web.json_response({"response": self._public(user)})
+
+        if request.method == "POST" and path.endswith("/bulk-actions/add-users"):
+            squad = path.split("/")[2]
+            for user_uuid in (await request.json())["userUuids"]:
+                squads = self.users[user_uuid]["activeInternalSquads"]
+                if {"uuid": squad} not in squads:
+                    squads.append({"uuid": squad})
+            return web.json_response({"response": {"eventSent": True}})
+
+        return web.json_response({}, status=404)
+
+
+async def legacy_provision(session, tg_id: int, days: int):
+    """Прежняя последовательность remnawave_get_or_create_user + сквад + ссылка"""
+    async with session.get(f"{BASE}/users/by-username/tg_{tg_id}") as resp:
+        user = (await resp.json()).get("response") if resp.status == 200 else None
+    if user:
+        async with session.get(f"{BASE}/users/{user['uuid']}") as resp:
+            current = datetime.fromisoformat((await resp.json())["response"]["expireAt"])
+        payload = {"uuid": user["uuid"], "expireAt": (current + timedelta(days=days)).isoformat()}
+        async with session.patch(f"{BASE}/users", json=payload) as resp:
+            await resp.read()
+    else:
+        payload = {
+            "username": f"tg_{tg_id}",
+            "password": "x",
+            "expireAt": (datetime.now(timezone.utc) + timedelta(days=days)).isoformat()
+        }
+        async with session.post(f"{BASE}/users", json=payload) as resp:
+            user = (await resp.json())["response"]
+    async with session.post(f"{BASE}/internal-squads/squad-1/bulk-actions/add-users", json={"userUuids": [user["uuid"]]}) as resp:
+        await resp.read()
+    async with session.get(f"{BASE}/users/{user['uuid']}") as resp:
+        return (await resp.json())["response"]["subscriptionUrl"]
+
+
+async def new_provision(session, tg_id: int, days: int):
+    return (await RemnawaveClient(session).provision(tg_id, days)).subscription_url
+
+
+def provision_with_uuid(stub: RemnawaveStub):
+    """provision с UUID, сохранённым в БД (продление)"""
+    uuids = {user["username"]: user_uuid for user_uuid, user in stub.users.items()}
+
+    async def provision(session, tg_id: int, days: int):
+        client = RemnawaveClient(session)
+        return (await client.provision(tg_id, days, user_uuid=uuids.get(f"tg_{tg_id}"))).subscription_url
+    return provision
+
+
+async def run(name: str, provision, stub: RemnawaveStub, tg_ids: range):
+    stub.requests = 0
+    started = time.perf_counter()
+    await asyncio.gather(*(provision(http_clients.remnawave, tg_id, 30) for tg_id in tg_ids))
+    elapsed = time.perf_counter() - started
+    print(f"{name:<24} users={len(tg_ids):<5} requests={stub.requests:<6} per user={stub.requests / len(tg_ids):.1f}  {elapsed:6.2f}s")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("users", nargs="?", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=20, help="задержка Remnawave, мс")
+    args = parser.parse_args()
+
+    stub = RemnawaveStub(args.latency / 1000)
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", stub.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+
+    await http_clients.init_sessions()
+    try:
+        legacy_ids = range(1, args.users + 1)
+        new_ids = range(100000, 100000 + args.users)
+        await run("legacy new users", legacy_provision, stub, legacy_ids)
+        await run("provision new users", new_provision, stub, new_ids)
+        await run("legacy renewals", legacy_provision, stub, legacy_ids)
+        await run("provision renewals", new_provision, stub, new_ids)
+        await run("provision renewals uuid", provision_with_uuid(stub), stub, new_ids)
+    finally:
+        await http_clients.close_sessions()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
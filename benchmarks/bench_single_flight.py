@@ -0,0 +1,101 @@
+"""
+Бенчмарк объединения одинаковых запросов к Remnawave и CryptoBot.
+
+Локальная заглушка отвечает с задержкой --latency мс. N одновременных
+«Моя подписка» одного пользователя (ссылка + информация, как в
+обработчике) и N одновременных «Проверить оплату» одного счёта
+выполняются без объединения (прежние прямые запросы) и через
+SingleFlight. Считаются HTTP-запросы к заглушке.
+
+Запуск из корня проекта:
+    python benchmarks/bench_single_flight.py [callers] [--latency 50]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOST, PORT = "127.0.0.1", 18545
+os.environ["CRYPTOBOT_API_URL"] = f"http://{HOST}:{PORT}/crypto"
+os.environ["REMNAWAVE_BASE_URL"] = f"http://{HOST}:{PORT}/remna"
+
+from aiohttp import web  # noqa: E402
+
+import http_clients  # noqa: E402
+import metrics  # noqa: E402
+from services import cryptobot, remnawave  # noqa: E402
+
+
+class Stub:
+    """Заглушка GET /users/{uuid} и getInvoices"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.requests = 0
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if request.path.endswith("getInvoices"):
+            invoice_id = int(request.query["invoice_ids"])
+            return web.json_response({"ok": True, "result": {"items": [{"invoice_id": invoice_id, "status": "active"}]}})
+        return web.json_response({"response": {"uuid": "u", "subscriptionUrl": "https://sub/u", "expireAt": None}})
+
+
+async def my_subscription_direct(uuid: str):
+    await remnawave._fetch_user_info(http_clients.remnawave, uuid)
+    await remnawave._fetch_user_info(http_clients.remnawave, uuid)
+
+
+async def my_subscription(uuid: str):
+    await remnawave.remnawave_get_subscription_url(http_clients.remnawave, uuid)
+    await remnawave.remnawave_get_user_info(http_clients.remnawave, uuid)
+
+
+async def check_payment_direct(invoice_id: str):
+    await cryptobot._fetch_invoice_status(http_clients.cryptobot, invoice_id)
+
+
+async def check_payment(invoice_id: str):
+    await cryptobot.get_invoice_status(http_clients.cryptobot, invoice_id)
+
+
+async def run(name: str, call, key: str, callers: int, stub: Stub):
+    stub.requests = 0
+    started = time.perf_counter()
+    await asyncio.gather(*(call(key) for _ in range(callers)))
+    elapsed = time.perf_counter() - started
+    print(f"{name:<30} callers={callers:<5} upstream requests={stub.requests:<5} {elapsed * 1000:8.1f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("callers", nargs="?", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=50, help="задержка заглушки, мс")
+    args = parser.parse_args()
+
+    stub = Stub(args.latency / 1000)
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", stub.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+
+    await http_clients.init_sessions()
+    try:
+        await run("my_subscription direct", my_subscription_direct, "uuid-1", args.callers, stub)
+        await run("my_subscription single-flight", my_subscription, "uuid-2", args.callers, stub)
+        await run("check_payment direct", check_payment_direct, "1", args.callers, stub)
+        await run("check_payment single-flight", check_payment, "2", args.callers, stub)
+        print(metrics.render())
+    finally:
+        await http_clients.close_sessions()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
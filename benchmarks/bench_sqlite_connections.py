@@ -0,0 +1,78 @@
+"""
+Бенчмарк слоя соединений SQLite.
+
+Сравнивает старую схему (новое sqlite3.connect на каждый запрос) с
+долгоживущим соединением из database.get_connection.
+
+Запуск из корня проекта:
+    python benchmarks/bench_sqlite_connections.py [ops]
+"""
+
+import os
+import sys
+import sqlite3
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp_dir = tempfile.mkdtemp(prefix="spn_bench_")
+os.environ["DB_FILE"] = os.path.join(_tmp_dir, "bench.db")
+
+import database as db  # noqa: E402
+
+
+USERS = 1000
+
+
+def legacy_execute(query, params=(), fetchone=False, commit=False):
+    """Старая реализация db_execute: соединение на каждый вызов"""
+    conn = sqlite3.connect(db.DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    result = cursor.fetchone() if fetchone else None
+    if commit:
+        conn.commit()
+    conn.close()
+    return result
+
+
+def workload(execute, ops: int):
+    """Смесь чтений и записей, похожая на /start и process_paid_invoice"""
+    for i in range(ops):
+        tg_id = i % USERS
+        if i % 4 == 0:
+            execute(
+                "UPDATE users SET referral_count = referral_count + 1 WHERE tg_id = ?",
+                (tg_id,),
+                commit=True
+            )
+        else:
+            execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,), fetchone=True)
+
+
+def run(name: str, execute, ops: int) -> float:
+    started = time.perf_counter()
+    workload(execute, ops)
+    elapsed = time.perf_counter() - started
+    rate = ops / elapsed
+    print(f"{name:<12} {ops} ops in {elapsed:.3f}s -> {rate:,.0f} ops/sec")
+    return rate
+
+
+def main():
+    ops = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    db.init_db()
+    for tg_id in range(USERS):
+        db.create_user(tg_id, f"user_{tg_id}")
+
+    before = run("per-call", legacy_execute, ops)
+    after = run("persistent", db.db_execute, ops)
+    print(f"speedup: x{after / before:.1f}")
+
+    db.close_connections()
+
+
+if __name__ == "__main__":
+    main()
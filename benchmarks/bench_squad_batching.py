@@ -0,0 +1,105 @@
+"""
+Бенчмарк объединения добавлений в сквад Remnawave.
+
+Локальная заглушка bulk-actions/add-users отвечает с задержкой --latency
+мс и отклоняет (400) пачку, в которой есть UUID из --bad. N одновременных
+активаций добавляют пользователей в сквад по одному запросу (как раньше)
+и через remnawave_add_to_squad с пачками. Считаются HTTP-запросы, время
+и успешные добавления.
+
+Запуск из корня проекта:
+    python benchmarks/bench_squad_batching.py [activations] [--latency 50] [--bad 3]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOST, PORT = "127.0.0.1", 18549
+os.environ["REMNAWAVE_BASE_URL"] = f"http://{HOST}:{PORT}"
+os.environ["REMNAWAVE_RATE_LIMIT"] = "0"
+
+from aiohttp import web  # noqa: E402
+
+import http_clients  # noqa: E402
+import metrics  # noqa: E402
+from config import SQUAD_BATCH_WINDOW, SQUAD_BATCH_SIZE  # noqa: E402
+from services import remnawave  # noqa: E402
+
+
+class Stub:
+    """Заглушка POST /internal-squads/{squad}/bulk-actions/add-users"""
+
+    def __init__(self, latency: float, bad: set):
+        self.latency = latency
+        self.bad = bad
+        self.requests = 0
+        self.members = set()
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        uuids = (await request.json())["userUuids"]
+        if self.bad.intersection(uuids):
+            return web.json_response({"message": "User not found"}, status=400)
+        self.members.update(uuids)
+        return web.json_response({"response": {"eventSent": True}})
+
+
+async def direct(uuid: str) -> bool:
+    status = await remnawave._post_add_users(http_clients.remnawave, "squad-1", [uuid])
+    return status in (200, 201)
+
+
+async def batched(uuid: str) -> bool:
+    return await remnawave.remnawave_add_to_squad(http_clients.remnawave, uuid, "squad-1")
+
+
+async def run(name: str, add, stub: Stub, count: int):
+    stub.requests = 0
+    stub.members.clear()
+    uuids = [f"uuid-{i}" for i in range(count)]
+    started = time.perf_counter()
+    results = await asyncio.gather(*(add(uuid) for uuid in uuids))
+    elapsed = time.perf_counter() - started
+    wrong = sum(1 for uuid, ok in zip(uuids, results) if ok != (uuid in stub.members))
+    print(
+        f"{name:<8} activations={count:<5} added={sum(results):<5} wrong results={wrong} "
+        f"requests={stub.requests:<5} {elapsed * 1000:8.1f} ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("activations", nargs="?", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=50, help="задержка Remnawave, мс")
+    parser.add_argument("--bad", type=int, default=3, help="сколько UUID заглушка не знает")
+    args = parser.parse_args()
+    # Отклонённые пачки пишут ошибки — в замере они не нужны
+    logging.disable(logging.ERROR)
+
+    stub = Stub(args.latency / 1000, {f"uuid-{i}" for i in range(0, args.activations, max(1, args.activations // max(1, args.bad)))[:args.bad]})
+    app = web.Application()
+    app.router.add_post("/internal-squads/{squad}/bulk-actions/add-users", stub.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+
+    await http_clients.init_sessions()
+    try:
+        await run("direct", direct, stub, args.activations)
+        await run("batched", batched, stub, args.activations)
+        print(f"window={SQUAD_BATCH_WINDOW}s, batch size={SQUAD_BATCH_SIZE}")
+        print(metrics.render())
+    finally:
+        await http_clients.close_sessions()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,142 @@
+"""
+Нагрузочная проверка вебхука Telegram.
+
+Отправляет N синтетических обновлений (сообщения от разных пользователей)
+POST-запросами с секретом, не больше --connections одновременно — как
+Telegram с max_connections. Печатает статусы ответов, время ответа
+вебхука и пропускную способность.
+
+По умолчанию поднимает локальный вебхук (services/telegram_webhook.py) с
+обработчиком, который «работает» --work мс без обращения к Telegram, и
+после отправки ждёт обработки всех принятых обновлений. С --url
+нагружает запущенного бота (секрет — TELEGRAM_WEBHOOK_SECRET); его
+обработчики отвечают в Telegram, поэтому --chat должен быть чатом, куда
+бот может писать.
+
+Запуск из корня проекта:
+    python benchmarks/bench_telegram_webhook.py [updates] [--connections 40] [--work 50]
+        [--workers 16] [--queue 1000] [--url http://127.0.0.1:8080/telegram/webhook --chat <id>]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOST, PORT = "127.0.0.1", 18551
+os.environ.setdefault("TELEGRAM_WEBHOOK_SECRET", "bench-secret")
+
+import aiohttp  # noqa: E402
+from aiogram import Bot, Dispatcher, Router  # noqa: E402
+from aiogram.types import Message  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import metrics  # noqa: E402
+from config import TELEGRAM_WEBHOOK_PATH, TELEGRAM_WEBHOOK_SECRET  # noqa: E402
+from services.telegram_webhook import SECRET_HEADER, UpdatePool, create_webhook_app  # noqa: E402
+
+
+def build_update(update_id: int, chat_id: int | None) -> dict:
+    """Обновление с текстовым сообщением"""
+    user_id = chat_id or 100000 + update_id
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+            "text": "/start"
+        }
+    }
+
+
+async def send_all(url: str, count: int, connections: int, chat_id: int | None) -> tuple[Counter, list[float]]:
+    statuses = Counter()
+    latencies = []
+    semaphore = asyncio.Semaphore(connections)
+    headers = {SECRET_HEADER: TELEGRAM_WEBHOOK_SECRET}
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=connections)) as session:
+        async def send(update_id: int):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    async with session.post(url, json=build_update(update_id, chat_id), headers=headers) as resp:
+                        await resp.read()
+                        statuses[resp.status] += 1
+                except aiohttp.ClientError as e:
+                    statuses[type(e).__name__] += 1
+                latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(send(update_id) for update_id in range(1, count + 1)))
+    return statuses, latencies
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("updates", nargs="?", type=int, default=2000)
+    parser.add_argument("--connections", type=int, default=40, help="одновременных запросов (max_connections)")
+    parser.add_argument("--work", type=float, default=50, help="время обработки обновления локальным обработчиком, мс")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--queue", type=int, default=1000)
+    parser.add_argument("--enqueue-timeout", type=float, default=5)
+    parser.add_argument("--url", help="вебхук запущенного бота вместо локального")
+    parser.add_argument("--chat", type=int, help="chat_id для обновлений (с --url)")
+    args = parser.parse_args()
+
+    pool = runner = None
+    url = args.url
+    if url is None:
+        handled = Counter()
+        router = Router()
+
+        @router.message()
+        async def handle(message: Message):
+            await asyncio.sleep(args.work / 1000)
+            handled["messages"] += 1
+
+        dp = Dispatcher()
+        dp.include_router(router)
+        bot = Bot("123456:bench")
+        pool = UpdatePool(dp, bot, args.workers, args.queue, args.enqueue_timeout)
+        pool.start()
+        runner = web.AppRunner(create_webhook_app(pool), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, HOST, PORT).start()
+        url = f"http://{HOST}:{PORT}{TELEGRAM_WEBHOOK_PATH}"
+
+    try:
+        started = time.perf_counter()
+        statuses, latencies = await send_all(url, args.updates, args.connections, args.chat)
+        sent = time.perf_counter() - started
+        if pool is not None:
+            await pool.stop(timeout=3600)
+        elapsed = time.perf_counter() - started
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+            await bot.session.close()
+
+    latencies.sort()
+    print(f"updates={args.updates} connections={args.connections} statuses={dict(statuses)}")
+    print(
+        f"webhook response p50={statistics.median(latencies) * 1000:.1f} ms "
+        f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} ms "
+        f"max={latencies[-1] * 1000:.1f} ms, sent in {sent:.2f} s"
+    )
+    if pool is not None:
+        print(
+            f"workers={args.workers} queue={args.queue} work={args.work} ms: "
+            f"handled {handled['messages']} in {elapsed:.2f} s ({handled['messages'] / elapsed:.0f} updates/s)"
+        )
+        print(metrics.render())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
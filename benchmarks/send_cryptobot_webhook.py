@@ -0,0 +1,68 @@
+"""
+Генератор подписанных вебхуков CryptoBot для проверки приёмника.
+
+Собирает обновление invoice_paid в формате CryptoBot, подписывает его
+CRYPTOBOT_TOKEN (как это делает CryptoBot) и отправляет на локальный
+вебхук бота. Печатает HTTP-статус и время ответа на каждый запрос.
+
+Запуск из корня проекта (бот запущен с CRYPTOBOT_WEBHOOK_PORT):
+    python benchmarks/send_cryptobot_webhook.py <invoice_id> [invoice_id ...]
+        [--url http://127.0.0.1:8081/cryptobot/webhook] [--bad-signature]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp  # noqa: E402
+
+from config import CRYPTOBOT_WEBHOOK_PATH, CRYPTOBOT_WEBHOOK_PORT  # noqa: E402
+from services.cryptobot_webhook import SIGNATURE_HEADER, sign_body  # noqa: E402
+
+
+def build_update(invoice_id: int, update_id: int) -> bytes:
+    """Тело обновления invoice_paid"""
+    now = datetime.now(timezone.utc).isoformat()
+    update = {
+        "update_id": update_id,
+        "update_type": "invoice_paid",
+        "request_date": now,
+        "payload": {
+            "invoice_id": invoice_id,
+            "status": "paid",
+            "currency_type": "fiat",
+            "fiat": "RUB",
+            "paid_at": now
+        }
+    }
+    return json.dumps(update).encode()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("invoice_ids", nargs="+", type=int)
+    parser.add_argument("--url", default=f"http://127.0.0.1:{CRYPTOBOT_WEBHOOK_PORT or 8081}{CRYPTOBOT_WEBHOOK_PATH}")
+    parser.add_argument("--bad-signature", action="store_true", help="подписать неверным токеном")
+    args = parser.parse_args()
+
+    async with aiohttp.ClientSession() as session:
+        for update_id, invoice_id in enumerate(args.invoice_ids, start=1):
+            body = build_update(invoice_id, update_id)
+            signature = sign_body(body, "wrong-token") if args.bad_signature else sign_body(body)
+            headers = {SIGNATURE_HEADER: signature, "Content-Type": "application/json"}
+
+            started = time.perf_counter()
+            async with session.post(args.url, data=body, headers=headers) as resp:
+                await resp.read()
+                elapsed = (time.perf_counter() - started) * 1000
+                print(f"invoice {invoice_id}: HTTP {resp.status} in {elapsed:.1f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,128 @@
+"""
+Внутрипроцессный LRU-кэш с TTL.
+
+Потокобезопасен: обращения идут из пула потоков async_database.
+Попадания, промахи и вытеснения учитываются в metrics под именами
+<name>_cache_hits / <name>_cache_misses / <name>_cache_evictions.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """LRU-кэш ограниченного размера с временем жизни записей"""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        # Ключи, загружаемые прямо сейчас: key -> [загрузчиков, инвалидаций]
+        self._loading: dict = {}
+
+    def get(self, key, default=None):
+        """Получить значение или default, если записи нет или она устарела"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    metrics.inc(f"{self.name}_cache_hits")
+                    return value
+                del self._data[key]
+
+        metrics.inc(f"{self.name}_cache_misses")
+        return default
+
+    def set(self, key, value):
+        """Положить значение в кэш"""
+        with self._lock:
+            self._store(key, value)
+
+    def invalidate(self, key):
+        """Удалить запись; загрузка этого ключа, идущая параллельно, не попадёт в кэш"""
+        with self._lock:
+            self._data.pop(key, None)
+            loading = self._loading.get(key)
+            if loading is not None:
+                loading[1] += 1
+
+    def clear(self):
+        """Очистить кэш"""
+        with self._lock:
+            self._data.clear()
+            for loading in self._loading.values():
+                loading[1] += 1
+
+    def get_or_load(self, key, loader):
+        """
+        Получить значение из кэша или загрузить его через loader()
+
+        None не кэшируется. Если во время загрузки ключ инвалидировали,
+        результат возвращается вызывающему, но в кэш не сохраняется —
+        так устаревшая строка не переживёт параллельную запись.
+
+        Args:
+            key: Ключ
+            loader: Функция без аргументов, читающая значение из хранилища
+
+        Returns:
+            Значение из кэша или результат loader()
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        loading, seen = self._begin_load(key)
+        try:
+            value = loader()
+        finally:
+            self._finish_load(key, loading, seen, value)
+        return value
+
+    async def get_or_load_async(self, key, loader):
+        """То же, что get_or_load, но loader — корутинная функция без аргументов"""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        loading, seen = self._begin_load(key)
+        try:
+            value = await loader()
+        finally:
+            self._finish_load(key, loading, seen, value)
+        return value
+
+    def __len__(self):
+        return len(self._data)
+
+    def _begin_load(self, key) -> tuple[list, int]:
+        with self._lock:
+            loading = self._loading.setdefault(key, [0, 0])
+            loading[0] += 1
+            return loading, loading[1]
+
+    def _finish_load(self, key, loading: list, seen: int, value):
+        with self._lock:
+            loading[0] -= 1
+            if value is not _MISSING and value is not None and loading[1] == seen:
+                self._store(key, value)
+            if loading[0] == 0:
+                del self._loading[key]
+
+    def _store(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            metrics.inc(f"{self.name}_cache_evictions")
+        metrics.set_gauge(f"{self.name}_cache_size", len(self._data))
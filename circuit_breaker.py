@@ -0,0 +1,173 @@
+"""
+Автомат отключения (circuit breaker) для внешнего API.
+
+CircuitBreaker — клиентский middleware aiohttp, как UpstreamPolicy
+(rate_limit.py), и стоит перед ним: логический запрос со всеми повторами
+считается одним вызовом.
+
+- closed    — запросы идут как обычно. Если за последние window секунд
+  было не меньше min_calls вызовов и доля ошибок (сетевые ошибки,
+  таймауты, 5xx) не меньше failure_rate или доля медленных (дольше
+  slow_call секунд) не меньше slow_rate — цепь размыкается.
+- open      — запросы сразу получают CircuitOpenError, не занимая
+  соединения и user_lock на время таймаута. Через open_seconds цепь
+  переходит в half_open.
+- half_open — пропускается не больше probes пробных запросов. Если все
+  они успешны и не медленные — цепь замыкается, первая же неудача снова
+  размыкает её на open_seconds.
+
+Пока цепь разомкнута, обработчики работают в деградированном режиме
+(см. services/remnawave.remnawave_unavailable).
+
+Метрики (см. metrics.py), <name> — имя API:
+    circuit_<name>_state     — 0 closed, 1 open, 2 half_open (gauge)
+    circuit_<name>_opened    — сколько раз цепь разомкнулась
+    circuit_<name>_rejected  — запросов, отклонённых без отправки
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+import aiohttp
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+_STATE_GAUGE = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+
+class CircuitOpenError(aiohttp.ClientConnectionError):
+    """Запрос не отправлен: цепь разомкнута"""
+
+
+class CircuitBreaker:
+    """Клиентский middleware aiohttp: размыкает цепь при ошибках или медленных ответах API"""
+
+    def __init__(
+        self,
+        name: str,
+        window: float,
+        min_calls: int,
+        failure_rate: float,
+        slow_call: float,
+        slow_rate: float,
+        open_seconds: float,
+        probes: int
+    ):
+        self.name = name
+        self.window = window
+        self.min_calls = max(1, min_calls)
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.probes = max(1, probes)
+        self._calls: deque[tuple[float, bool, bool]] = deque()  # (время, ошибка, медленный)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        # Меняется при каждой смене состояния: ответы на запросы, отправленные
+        # в прежнем состоянии, на новое не влияют
+        self._generation = 0
+        metrics.set_gauge(f"circuit_{name}_state", _STATE_GAUGE[CLOSED])
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._set_state(HALF_OPEN)
+        return self._state
+
+    @property
+    def is_open(self) -> bool:
+        """Цепь разомкнута: запросы не отправляются (в half_open уже идут пробные)"""
+        return self.state == OPEN
+
+    def retry_in(self) -> float:
+        """Через сколько секунд цепь перейдёт в half_open (0, если не разомкнута)"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def _set_state(self, state: str):
+        if state == self._state:
+            return
+        previous, self._state = self._state, state
+        self._generation += 1
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+            metrics.inc(f"circuit_{self.name}_opened")
+        self._calls.clear()
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        metrics.set_gauge(f"circuit_{self.name}_state", _STATE_GAUGE[state])
+        log = logger.warning if state == OPEN else logger.info
+        log(f"{self.name}: circuit {previous} → {state}")
+
+    def _admit(self) -> bool | None:
+        """Пропустить запрос: False — обычный, True — пробный, None — отклонить"""
+        state = self.state
+        if state == CLOSED:
+            return False
+        if state == HALF_OPEN and self._probes_in_flight < self.probes - self._probe_successes:
+            self._probes_in_flight += 1
+            return True
+        return None
+
+    def _record(self, generation: int, probe: bool, failed: bool, slow: bool):
+        if generation != self._generation:
+            return
+        if probe:
+            self._probes_in_flight -= 1
+            if failed or slow:
+                self._set_state(OPEN)
+            else:
+                self._probe_successes += 1
+                if self._probe_successes >= self.probes:
+                    self._set_state(CLOSED)
+            return
+
+        now = time.monotonic()
+        self._calls.append((now, failed, slow))
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+        total = len(self._calls)
+        if total < self.min_calls:
+            return
+        failures = sum(1 for _, f, _ in self._calls if f)
+        slow_calls = sum(1 for _, _, s in self._calls if s)
+        if failures / total >= self.failure_rate or slow_calls / total >= self.slow_rate:
+            logger.warning(
+                f"{self.name}: {failures}/{total} failed, {slow_calls}/{total} slow "
+                f"in {self.window:g}s — opening circuit for {self.open_seconds:g}s"
+            )
+            self._set_state(OPEN)
+
+    async def __call__(self, request: aiohttp.ClientRequest, handler) -> aiohttp.ClientResponse:
+        probe = self._admit()
+        if probe is None:
+            metrics.inc(f"circuit_{self.name}_rejected")
+            raise CircuitOpenError(f"{self.name}: circuit open, retry in {self.retry_in():.0f}s")
+
+        generation = self._generation
+        started = time.monotonic()
+        try:
+            response = await handler(request)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            self._record(generation, probe, True, False)
+            raise
+        except BaseException:
+            # Отмена (в том числе общий таймаут запроса) или ошибка не сети:
+            # ответа нет, но долгое ожидание — признак медленного API
+            if time.monotonic() - started >= self.slow_call:
+                self._record(generation, probe, False, True)
+            elif probe and generation == self._generation:
+                self._probes_in_flight -= 1
+            raise
+
+        self._record(generation, probe, response.status >= 500, time.monotonic() - started >= self.slow_call)
+        return response
@@ -11,6 +11,20 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 
+# Вебхук Telegram (см. services/telegram_webhook.py). Пустой URL — long polling.
+# URL — публичный адрес (https://bot.example.com), к нему добавляется TELEGRAM_WEBHOOK_PATH
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")
+TELEGRAM_WEBHOOK_HOST = os.getenv("TELEGRAM_WEBHOOK_HOST", "0.0.0.0")
+TELEGRAM_WEBHOOK_PORT = int(os.getenv("TELEGRAM_WEBHOOK_PORT", "8080"))
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")  # 1–256 символов A-Z, a-z, 0-9, _ и -
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", "40"))  # одновременных запросов от Telegram (1–100)
+
+# Обновления из вебхука обрабатывает пул воркеров с ограниченной очередью
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))  # обновлений обрабатывается одновременно
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))  # обновлений ждёт в очереди
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv("UPDATE_ENQUEUE_TIMEOUT", "5"))  # секунд ждать места в очереди, потом 503
+
 # ────────────────────────────────────────────────
 #           SUPPORT & NEWS CHANNELS
 # ────────────────────────────────────────────────
@@ -27,12 +41,75 @@ REMNAWAVE_BASE_URL = os.getenv("REMNAWAVE_BASE_URL", "")
 REMNAWAVE_API_TOKEN = os.getenv("REMNAWAVE_API_TOKEN", "")
 DEFAULT_SQUAD_UUID = os.getenv("DEFAULT_SQUAD_UUID", "")
 
+# «Моя подписка» показывается из users (ссылка и дата окончания из Remnawave);
+# если данные старше N секунд, они обновляются из Remnawave в фоне
+SUBSCRIPTION_REFRESH_AGE = int(os.getenv("SUBSCRIPTION_REFRESH_AGE", "600"))
+
 # ────────────────────────────────────────────────
 #            CRYPTOBOT PAYMENT CONFIG
 # ────────────────────────────────────────────────
 
 CRYPTOBOT_TOKEN = os.getenv("CRYPTOBOT_TOKEN", "")
 CRYPTOBOT_API_URL = os.getenv("CRYPTOBOT_API_URL", "")
+CRYPTOBOT_BATCH_SIZE = int(os.getenv("CRYPTOBOT_BATCH_SIZE", "100"))  # invoice_ids в одном запросе getInvoices (максимум 1000)
+CRYPTOBOT_INVOICE_TTL = int(os.getenv("CRYPTOBOT_INVOICE_TTL", "3600"))  # секунд до истечения счёта (expires_in)
+CRYPTOBOT_INVOICE_REUSE_MARGIN = int(os.getenv("CRYPTOBOT_INVOICE_REUSE_MARGIN", "300"))  # секунд: счёт, истекающий раньше, повторно не показывается
+
+# Вебхук CryptoBot (invoice_paid). Порт 0 — вебхук выключен, работает только опрос
+CRYPTOBOT_WEBHOOK_HOST = os.getenv("CRYPTOBOT_WEBHOOK_HOST", "0.0.0.0")
+CRYPTOBOT_WEBHOOK_PORT = int(os.getenv("CRYPTOBOT_WEBHOOK_PORT", "0"))
+CRYPTOBOT_WEBHOOK_PATH = os.getenv("CRYPTOBOT_WEBHOOK_PATH", "/cryptobot/webhook")
+
+# ────────────────────────────────────────────────
+#              HTTP CLIENT CONFIG
+# ────────────────────────────────────────────────
+
+# Долгоживущие сессии к CryptoBot и Remnawave (см. http_clients.py)
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "20"))  # соединений к одному хосту
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))  # секунд простоя keep-alive соединения
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))  # секунд кэша DNS
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))  # секунд на запрос целиком
+
+# Таймауты соединения и чтения ответа по API; общий таймаут запроса — остаток
+# бюджета обработчика, но не больше HTTP_TIMEOUT (см. deadline.py)
+CRYPTOBOT_CONNECT_TIMEOUT = float(os.getenv("CRYPTOBOT_CONNECT_TIMEOUT", "5"))  # секунд
+CRYPTOBOT_READ_TIMEOUT = float(os.getenv("CRYPTOBOT_READ_TIMEOUT", "10"))  # секунд
+REMNAWAVE_CONNECT_TIMEOUT = float(os.getenv("REMNAWAVE_CONNECT_TIMEOUT", "3"))  # секунд
+REMNAWAVE_READ_TIMEOUT = float(os.getenv("REMNAWAVE_READ_TIMEOUT", "10"))  # секунд
+
+# Бюджет на обработку апдейта Telegram: ответа на кнопку Telegram ждёт ~15 с,
+# все запросы к API внутри обработчика укладываются в остаток бюджета
+HANDLER_DEADLINE = float(os.getenv("HANDLER_DEADLINE", "12"))  # секунд; 0 — без бюджета
+
+# Лимит частоты запросов к API (бакет токенов, 0 — без лимита) и повторы
+# GET-запросов при 429/5xx/сетевых ошибках (см. rate_limit.py)
+CRYPTOBOT_RATE_LIMIT = float(os.getenv("CRYPTOBOT_RATE_LIMIT", "10"))  # запросов в секунду
+CRYPTOBOT_RATE_BURST = int(os.getenv("CRYPTOBOT_RATE_BURST", "20"))  # запросов подряд без ожидания
+REMNAWAVE_RATE_LIMIT = float(os.getenv("REMNAWAVE_RATE_LIMIT", "20"))  # запросов в секунду
+REMNAWAVE_RATE_BURST = int(os.getenv("REMNAWAVE_RATE_BURST", "40"))  # запросов подряд без ожидания
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))  # повторов идемпотентного запроса
+HTTP_RETRY_BASE = float(os.getenv("HTTP_RETRY_BASE", "0.5"))  # секунд - первая задержка повтора
+HTTP_RETRY_MAX = float(os.getenv("HTTP_RETRY_MAX", "30"))  # секунд - потолок задержки и Retry-After
+
+# Автомат отключения Remnawave (см. circuit_breaker.py): если за окно доля ошибок
+# или медленных ответов выше порога, запросы не отправляются OPEN секунд, затем
+# PROBES пробных запросов проверяют, восстановилась ли панель
+REMNAWAVE_BREAKER_WINDOW = float(os.getenv("REMNAWAVE_BREAKER_WINDOW", "60"))  # секунд - окно статистики
+REMNAWAVE_BREAKER_MIN_CALLS = int(os.getenv("REMNAWAVE_BREAKER_MIN_CALLS", "10"))  # запросов в окне до решения
+REMNAWAVE_BREAKER_FAILURE_RATE = float(os.getenv("REMNAWAVE_BREAKER_FAILURE_RATE", "0.5"))  # доля ошибок
+REMNAWAVE_BREAKER_SLOW_CALL = float(os.getenv("REMNAWAVE_BREAKER_SLOW_CALL", "5"))  # секунд - медленный ответ
+REMNAWAVE_BREAKER_SLOW_RATE = float(os.getenv("REMNAWAVE_BREAKER_SLOW_RATE", "0.8"))  # доля медленных ответов
+REMNAWAVE_BREAKER_OPEN = float(os.getenv("REMNAWAVE_BREAKER_OPEN", "30"))  # секунд - цепь разомкнута
+REMNAWAVE_BREAKER_PROBES = int(os.getenv("REMNAWAVE_BREAKER_PROBES", "3"))  # пробных запросов в half_open
+
+# Одинаковые запросы статуса (счёт CryptoBot, пользователь Remnawave) объединяются,
+# результат переиспользуется ещё N секунд (см. single_flight.py)
+SINGLE_FLIGHT_TTL = float(os.getenv("SINGLE_FLIGHT_TTL", "5"))
+
+# Добавления в сквад Remnawave копятся и отправляются одним bulk-запросом
+# на сквад (см. micro_batch.py)
+SQUAD_BATCH_WINDOW = float(os.getenv("SQUAD_BATCH_WINDOW", "0.2"))  # секунд - сколько копить пачку
+SQUAD_BATCH_SIZE = int(os.getenv("SQUAD_BATCH_SIZE", "100"))  # UUID в пачке, при котором она уходит сразу
 
 # ────────────────────────────────────────────────
 #                DATABASE CONFIG
@@ -40,11 +117,35 @@ CRYPTOBOT_API_URL = os.getenv("CRYPTOBOT_API_URL", "")
 
 DB_FILE = os.getenv("DB_FILE", "spn_vpn_bot.db")
 
+# Настройки соединения SQLite
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "8192"))  # размер кэша страниц на соединение
+SQLITE_STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", "128"))  # кэш подготовленных запросов
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "5"))  # секунд ожидания блокировки БД
+
+# Размер пула потоков для запросов к БД из асинхронного кода
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+# Блокировки действий пользователя: "memory" — только внутри процесса,
+# "db" — дополнительно аренда в БД для нескольких процессов бота
+USER_LOCK_BACKEND = os.getenv("USER_LOCK_BACKEND", "memory")
+USER_LOCK_TTL = int(os.getenv("USER_LOCK_TTL", "120"))  # секунд до истечения аренды
+
+# Кэш записей пользователей перед SQLite/Supabase
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))  # записей
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))  # секунд
+
 # Supabase config
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
 DATABASE_URL = os.getenv("DATABASE_URL", "")
 
+# Нативный асинхронный бэкенд PostgreSQL (asyncpg) по DATABASE_URL.
+# Включается значением DB_BACKEND=postgres, иначе используется Supabase/SQLite
+DB_BACKEND = os.getenv("DB_BACKEND", "")
+PG_POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE", "2"))
+PG_POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", "10"))
+PG_STATEMENT_CACHE_SIZE = int(os.getenv("PG_STATEMENT_CACHE_SIZE", "100"))
+
 # ────────────────────────────────────────────────
 #                LOGGING CONFIG
 # ────────────────────────────────────────────────
@@ -66,4 +167,27 @@ TARIFFS = {
 #             TASK CONFIGURATION
 # ────────────────────────────────────────────────
 
-PAYMENT_CHECK_INTERVAL = 30  # секунд - интервал проверки платежей
+# Опрос счёта: первая проверка через PAYMENT_CHECK_INTERVAL после создания,
+# дальше интервал растёт вместе с возрастом счёта до PAYMENT_POLL_MAX_INTERVAL
+PAYMENT_CHECK_INTERVAL = int(os.getenv("PAYMENT_CHECK_INTERVAL", "10"))  # секунд - интервал проверки свежего счёта
+PAYMENT_POLL_MAX_INTERVAL = int(os.getenv("PAYMENT_POLL_MAX_INTERVAL", "900"))  # секунд - предельный интервал проверки
+PAYMENT_SCHEDULER_TICK = float(os.getenv("PAYMENT_SCHEDULER_TICK", "5"))  # секунд - шаг планировщика проверок
+PAYMENT_SAFETY_NET_INTERVAL = int(os.getenv("PAYMENT_SAFETY_NET_INTERVAL", "300"))  # секунд - интервал проверки при включённом вебхуке
+PAYMENT_WORKERS = int(os.getenv("PAYMENT_WORKERS", "8"))  # оплаченных счетов активируется одновременно
+
+# Outbox активаций (см. services/activation.py): оплаченный счёт сначала
+# записывается в activation_jobs, затем шаги выполняются с повторами
+ACTIVATION_WORKERS = int(os.getenv("ACTIVATION_WORKERS", "8"))  # задач outbox выполняется одновременно
+ACTIVATION_POLL_INTERVAL = float(os.getenv("ACTIVATION_POLL_INTERVAL", "5"))  # секунд - опрос outbox
+ACTIVATION_LEASE = int(os.getenv("ACTIVATION_LEASE", "120"))  # секунд - аренда задачи (после падения процесса задача вернётся)
+ACTIVATION_MAX_ATTEMPTS = int(os.getenv("ACTIVATION_MAX_ATTEMPTS", "10"))  # попыток до состояния failed
+ACTIVATION_RETRY_BASE = float(os.getenv("ACTIVATION_RETRY_BASE", "10"))  # секунд - первая задержка повтора
+ACTIVATION_RETRY_MAX = float(os.getenv("ACTIVATION_RETRY_MAX", "1800"))  # секунд - потолок задержки повтора
+
+# Сверка users с Remnawave (см. services/reconcile.py): за проход берётся
+# RECONCILE_PAGES страниц списка пользователей начиная с сохранённого курсора.
+# По умолчанию 10 × 500 пользователей в минуту — 300k пользователей в час
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "60"))  # секунд - между проходами; 0 - сверка выключена
+RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "500"))  # пользователей в странице GET /users
+RECONCILE_PAGES = int(os.getenv("RECONCILE_PAGES", "10"))  # страниц за проход
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", "2"))  # страниц запрашивается одновременно
@@ -1,6 +1,21 @@
 import sqlite3
 import logging
-from config import DB_FILE, SUPABASE_URL, SUPABASE_KEY
+import threading
+import time
+from datetime import datetime, timezone
+from config import (
+    DB_FILE,
+    SUPABASE_URL,
+    SUPABASE_KEY,
+    DATABASE_URL,
+    SQLITE_CACHE_SIZE_KB,
+    SQLITE_STATEMENT_CACHE,
+    SQLITE_BUSY_TIMEOUT,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL
+)
+import migrations
+from cache import TTLCache
 
 # Импортируем Supabase клиент
 try:
@@ -10,60 +25,122 @@ except ImportError:
     USE_SUPABASE = False
 
 
+# Порядок колонок users в SQLite (строки возвращаются кортежами)
+USER_COLUMNS = (
+    "tg_id", "username", "accepted_terms", "remnawave_uuid", "remnawave_username",
+    "subscription_until", "squad_uuid", "referrer_id", "gift_received",
+    "referral_count", "active_referrals", "first_payment", "action_lock",
+    "lock_owner", "lock_expires_at", "subscription_url", "subscription_synced_at"
+)
+
+# Кэш строк users для обоих бэкендов. Все функции, меняющие пользователя,
+# инвалидируют запись. Поля аренды блокировки в кэшированной строке не
+# актуальны — блокировки всегда идут напрямую в хранилище.
+user_cache = TTLCache("user", USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def user_field(user, column: str):
+    """Получить поле пользователя из строки SQLite (кортеж), Supabase (словарь) или asyncpg (Record)"""
+    if not user:
+        return None
+    if isinstance(user, tuple):
+        return user[USER_COLUMNS.index(column)]
+    return user.get(column)
+
+
+def user_timestamp(user, column: str) -> int | None:
+    """Получить поле-дату пользователя в epoch-секундах (SQLite — число, Supabase — ISO, asyncpg — datetime)"""
+    return _to_epoch(user_field(user, column))
+
+
+# ────────────────────────────────────────────────
+#          СОЕДИНЕНИЯ SQLITE
+# ────────────────────────────────────────────────
+
+# Одно долгоживущее соединение на поток: sqlite3.Connection нельзя
+# безопасно делить между потоками без внешней синхронизации
+_local = threading.local()
+_connections: list[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Получить соединение SQLite текущего потока (создаётся при первом обращении)
+
+    Соединение открывается один раз, переводится в режим WAL с
+    synchronous=NORMAL и переиспользуется всеми последующими запросами
+    этого потока вместе с кэшем страниц и подготовленных запросов.
+
+    Returns:
+        Открытое соединение sqlite3
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        return conn
+
+    conn = sqlite3.connect(
+        DB_FILE,
+        timeout=SQLITE_BUSY_TIMEOUT,
+        cached_statements=SQLITE_STATEMENT_CACHE,
+        check_same_thread=False  # закрываются из главного потока в close_connections
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+
+    _local.conn = conn
+    with _connections_lock:
+        _connections.append(conn)
+
+    return conn
+
+
+def close_connections():
+    """Закрыть все открытые соединения SQLite (вызывается при остановке бота)"""
+    with _connections_lock:
+        for conn in _connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logging.error(f"Error closing SQLite connection: {e}")
+        _connections.clear()
+    _local.__dict__.pop("conn", None)
+
+
 def init_db():
-    """Инициализация базы данных с необходимыми таблицами"""
+    """Инициализация базы данных: применяет недостающие миграции схемы"""
     if USE_SUPABASE:
         supabase_db.init_tables()
+        if DATABASE_URL:
+            applied = migrations.migrate_postgres(DATABASE_URL)
+            logging.info(f"Postgres schema up to date ({applied} migrations applied)")
+        else:
+            # Без DATABASE_URL схему применяют вручную — проверяем, что она не отстала
+            version = supabase_db.get_schema_version()
+            if version is None or version < migrations.LATEST_VERSION:
+                raise RuntimeError(
+                    f"Supabase schema is at version {version or 0}, the bot needs {migrations.LATEST_VERSION}. "
+                    "Set DATABASE_URL to migrate automatically, or run the output of "
+                    f"`python migrations.py --print-sql --from {version or 0}` in the Supabase SQL editor"
+                )
+            logging.info(f"Supabase schema is at version {version}, DATABASE_URL not set, migrations skipped")
         logging.info("Supabase tables initialized")
     else:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                tg_id INTEGER PRIMARY KEY,
-                username TEXT,
-                accepted_terms BOOLEAN DEFAULT FALSE,
-                remnawave_uuid TEXT,
-                remnawave_username TEXT,
-                subscription_until TEXT,
-                squad_uuid TEXT,
-                referrer_id INTEGER,
-                gift_received BOOLEAN DEFAULT FALSE,
-                referral_count INTEGER DEFAULT 0,
-                active_referrals INTEGER DEFAULT 0,
-                first_payment BOOLEAN DEFAULT FALSE,
-                action_lock INTEGER DEFAULT 0
-            )
-        ''')
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tg_id INTEGER,
-                tariff_code TEXT,
-                amount REAL,
-                status TEXT DEFAULT 'pending',
-                created_at TEXT,
-                provider TEXT,
-                invoice_id TEXT,
-                payload TEXT
-            )
-        ''')
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS promo_codes (
-                code TEXT PRIMARY KEY,
-                days INTEGER,
-                max_uses INTEGER,
-                used_count INTEGER DEFAULT 0,
-                active BOOLEAN DEFAULT TRUE
-            )
-        ''')
+        applied = migrations.migrate_sqlite(get_connection())
+        logging.info(f"SQLite database initialized successfully ({applied} migrations applied)")
 
-        conn.commit()
-        conn.close()
-        logging.info("SQLite database initialized successfully")
+
+def _to_epoch(value) -> int | None:
+    """Перевести ISO-строку или datetime в epoch-секунды для SQLite"""
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
 
 
 def db_execute(query, params=(), fetchone=False, fetchall=False, commit=False):
@@ -80,74 +157,89 @@ def db_execute(query, params=(), fetchone=False, fetchall=False, commit=False):
     Returns:
         Результат запроса или None
     """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(query, params)
-    
-    if fetchone:
-        result = cursor.fetchone()
-    elif fetchall:
-        result = cursor.fetchall()
-    else:
-        result = None
-    
-    if commit:
-        conn.commit()
-    
-    conn.close()
+    conn = get_connection()
+
+    try:
+        cursor = conn.execute(query, params)
+        if fetchone:
+            result = cursor.fetchone()
+        elif fetchall:
+            result = cursor.fetchall()
+        else:
+            result = None
+        cursor.close()
+
+        if commit:
+            conn.commit()
+    except sqlite3.Error:
+        # Соединение живёт дольше запроса — не оставляем открытую транзакцию
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+
     return result
 
 
-def acquire_user_lock(tg_id: int) -> bool:
+def acquire_user_lease(tg_id: int, owner: str, ttl: int) -> bool:
     """
-    Атомарно блокирует пользователя.
-    Возвращает True если блок получен, False если уже занят.
+    Взять аренду блокировки пользователя для нескольких процессов бота
+
+    Аренда берётся, если она свободна или у прежнего владельца истёк срок,
+    поэтому упавший процесс не блокирует пользователя навсегда.
+    Используется через user_locks.user_lock.
 
     Args:
         tg_id: ID пользователя Telegram
+        owner: Уникальный идентификатор владельца аренды
+        ttl: Срок аренды в секундах
 
     Returns:
-        True если удалось получить блокировку, False иначе
+        True если аренда получена, False если занята другим владельцем
     """
     if USE_SUPABASE:
-        return supabase_db.acquire_user_lock(tg_id)
-
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+        return supabase_db.acquire_user_lease(tg_id, owner, ttl)
 
-    cursor.execute("""
+    now = int(time.time())
+    conn = get_connection()
+    cursor = conn.execute("""
         UPDATE users
-        SET action_lock = 1
-        WHERE tg_id = ? AND action_lock = 0
-    """, (tg_id,))
+        SET lock_owner = ?, lock_expires_at = ?
+        WHERE tg_id = ? AND (lock_owner IS NULL OR lock_expires_at < ?)
+    """, (owner, now + ttl, tg_id, now))
 
     changed = cursor.rowcount
     conn.commit()
-    conn.close()
+    cursor.close()
 
     return changed == 1
 
 
-def release_user_lock(tg_id: int):
+def release_user_lease(tg_id: int, owner: str):
     """
-    Освобождает блокировку пользователя
+    Освободить аренду блокировки, если она всё ещё принадлежит owner
 
     Args:
         tg_id: ID пользователя Telegram
+        owner: Идентификатор владельца, переданный в acquire_user_lease
     """
     if USE_SUPABASE:
-        supabase_db.release_user_lock(tg_id)
+        supabase_db.release_user_lease(tg_id, owner)
     else:
         db_execute(
-            "UPDATE users SET action_lock = 0 WHERE tg_id = ?",
-            (tg_id,),
+            "UPDATE users SET lock_owner = NULL, lock_expires_at = NULL WHERE tg_id = ? AND lock_owner = ?",
+            (tg_id, owner),
             commit=True
         )
 
 
 # User management
 def get_user(tg_id: int):
-    """Получить информацию о пользователе"""
+    """Получить информацию о пользователе (через кэш)"""
+    return user_cache.get_or_load(tg_id, lambda: _load_user(tg_id))
+
+
+def _load_user(tg_id: int):
+    """Прочитать пользователя из хранилища в обход кэша"""
     if USE_SUPABASE:
         return supabase_db.get_user(tg_id)
     return db_execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,), fetchone=True)
@@ -155,6 +247,8 @@ def get_user(tg_id: int):
 
 def user_exists(tg_id: int) -> bool:
     """Проверить существует ли пользователь"""
+    if user_cache.get(tg_id) is not None:
+        return True
     if USE_SUPABASE:
         return supabase_db.user_exists(tg_id)
     result = db_execute("SELECT 1 FROM users WHERE tg_id = ?", (tg_id,), fetchone=True)
@@ -171,6 +265,54 @@ def create_user(tg_id: int, username: str, referrer_id=None):
             (tg_id, username, referrer_id),
             commit=True
         )
+    user_cache.invalidate(tg_id)
+
+
+def bootstrap_user(tg_id: int, username: str, referrer_id=None) -> tuple:
+    """
+    Создать пользователя при необходимости и вернуть его запись одним вызовом
+
+    Счётчик рефералов у referrer_id увеличивается только если пользователь
+    действительно новый. В SQLite всё выполняется в одной транзакции,
+    в Supabase — одним RPC-вызовом bootstrap_user.
+
+    Args:
+        tg_id: ID пользователя Telegram
+        username: Имя пользователя Telegram
+        referrer_id: ID пригласившего пользователя или None
+
+    Returns:
+        Кортеж (запись пользователя, создан ли пользователь сейчас)
+    """
+    if USE_SUPABASE:
+        user, created = supabase_db.bootstrap_user(tg_id, username, referrer_id)
+    else:
+        conn = get_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            created = conn.execute(
+                "INSERT INTO users (tg_id, username, referrer_id) VALUES (?, ?, ?) ON CONFLICT(tg_id) DO NOTHING",
+                (tg_id, username, referrer_id)
+            ).rowcount == 1
+            if created and referrer_id:
+                conn.execute(
+                    "UPDATE users SET referral_count = referral_count + 1 WHERE tg_id = ?",
+                    (referrer_id,)
+                )
+            user = conn.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,)).fetchone()
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    if user:
+        user_cache.set(tg_id, user)
+    else:
+        user_cache.invalidate(tg_id)
+    if created and referrer_id:
+        user_cache.invalidate(referrer_id)
+
+    return user, created
 
 
 # Terms and conditions
@@ -184,54 +326,217 @@ def accept_terms(tg_id: int):
             (tg_id,),
             commit=True
         )
+    user_cache.invalidate(tg_id)
 
 
 def has_accepted_terms(tg_id: int) -> bool:
     """Проверить принял ли пользователь условия"""
-    if USE_SUPABASE:
-        return supabase_db.has_accepted_terms(tg_id)
-    user = get_user(tg_id)
-    return user and user[2]  # accepted_terms column
+    return bool(user_field(get_user(tg_id), "accepted_terms"))
 
 
 # Subscription management
-def update_subscription(tg_id: int, uuid: str, username: str, subscription_until: str, squad_uuid: str):
-    """Обновить подписку пользователя"""
+def update_subscription(tg_id: int, uuid: str, username: str, subscription_until: str, squad_uuid: str,
+                        subscription_url: str | None = None):
+    """
+    Обновить подписку пользователя
+
+    subscription_until — дата окончания, которую вернул (или принял)
+    Remnawave, поэтому запись считается сверенной сейчас. subscription_url
+    сохраняется, если передан.
+    """
     if USE_SUPABASE:
-        supabase_db.update_subscription(tg_id, uuid, username, subscription_until, squad_uuid)
+        supabase_db.update_subscription(tg_id, uuid, username, subscription_until, squad_uuid, subscription_url)
     else:
         db_execute(
-            "UPDATE users SET remnawave_uuid = ?, remnawave_username = ?, subscription_until = ?, squad_uuid = ? WHERE tg_id = ?",
-            (uuid, username, subscription_until, squad_uuid, tg_id),
+            """
+            UPDATE users
+            SET remnawave_uuid = ?, remnawave_username = ?, subscription_until = ?, squad_uuid = ?,
+                subscription_url = COALESCE(?, subscription_url), subscription_synced_at = ?
+            WHERE tg_id = ?
+            """,
+            (uuid, username, _to_epoch(subscription_until), squad_uuid, subscription_url, int(time.time()), tg_id),
             commit=True
         )
+    user_cache.invalidate(tg_id)
+
+
+def sync_subscription(tg_id: int, subscription_until: str | None, subscription_url: str | None):
+    """
+    Сохранить состояние подписки, прочитанное из Remnawave
+
+    Args:
+        tg_id: ID пользователя Telegram
+        subscription_until: expireAt из Remnawave (ISO)
+        subscription_url: subscriptionUrl из Remnawave
+    """
+    if USE_SUPABASE:
+        supabase_db.sync_subscription(tg_id, subscription_until, subscription_url)
+    else:
+        db_execute(
+            """
+            UPDATE users
+            SET subscription_until = ?, subscription_url = COALESCE(?, subscription_url), subscription_synced_at = ?
+            WHERE tg_id = ?
+            """,
+            (_to_epoch(subscription_until), subscription_url, int(time.time()), tg_id),
+            commit=True
+        )
+    user_cache.invalidate(tg_id)
 
 
 def has_subscription(tg_id: int) -> bool:
     """Проверить есть ли активная подписка"""
+    return user_field(get_user(tg_id), "remnawave_uuid") is not None
+
+
+# Reconciliation with Remnawave (см. services/reconcile.py)
+def get_subscription_states(tg_ids: list) -> dict:
+    """
+    Состояние подписки пользователей одной страницы сверки одним запросом
+
+    Returns:
+        {tg_id: (remnawave_uuid, subscription_until в epoch, subscription_url)}
+        только для пользователей, которые есть в users
+    """
+    if not tg_ids:
+        return {}
     if USE_SUPABASE:
-        return supabase_db.has_subscription(tg_id)
-    user = get_user(tg_id)
-    return user and user[3] is not None  # remnawave_uuid column
+        rows = supabase_db.get_subscription_states(tg_ids)
+    else:
+        placeholders = ",".join("?" * len(tg_ids))
+        rows = db_execute(
+            f"SELECT tg_id, remnawave_uuid, subscription_until, subscription_url FROM users WHERE tg_id IN ({placeholders})",
+            list(tg_ids),
+            fetchall=True
+        )
+    return {row[0]: (row[1], _to_epoch(row[2]), row[3]) for row in rows}
+
+
+def sync_subscriptions(rows: list, synced_before: int) -> int:
+    """
+    Записать исправления сверки пачкой
+
+    Строка пропускается, если её subscription_synced_at не раньше
+    synced_before: подписку продлили уже после чтения страницы из
+    Remnawave, и в БД более свежие данные.
+
+    Args:
+        rows: [(tg_id, remnawave_uuid, remnawave_username, subscription_until ISO, subscription_url)]
+        synced_before: Время (epoch) перед запросом страницы в Remnawave
+
+    Returns:
+        Количество обновлённых пользователей
+    """
+    if not rows:
+        return 0
+    if USE_SUPABASE:
+        updated = supabase_db.sync_subscriptions(rows, synced_before)
+    else:
+        now = int(time.time())
+        conn = get_connection()
+        try:
+            cursor = conn.executemany(
+                """
+                UPDATE users
+                SET remnawave_uuid = ?, remnawave_username = ?, subscription_until = ?,
+                    subscription_url = COALESCE(?, subscription_url), subscription_synced_at = ?
+                WHERE tg_id = ? AND (subscription_synced_at IS NULL OR subscription_synced_at < ?)
+                """,
+                [
+                    (uuid, username, _to_epoch(until), url, now, tg_id, synced_before)
+                    for tg_id, uuid, username, until, url in rows
+                ]
+            )
+            conn.commit()
+            updated = cursor.rowcount
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    for row in rows:
+        user_cache.invalidate(row[0])
+    return updated
+
+
+def get_sync_cursor(name: str) -> int:
+    """Позиция фонового обхода name (0, если обход ещё не запускался)"""
+    if USE_SUPABASE:
+        return supabase_db.get_sync_cursor(name)
+    row = db_execute("SELECT position FROM sync_cursors WHERE name = ?", (name,), fetchone=True)
+    return row[0] if row else 0
+
+
+def set_sync_cursor(name: str, position: int):
+    """Сохранить позицию фонового обхода name"""
+    if USE_SUPABASE:
+        supabase_db.set_sync_cursor(name, position)
+        return
+    db_execute(
+        """
+        INSERT INTO sync_cursors (name, position, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET position = excluded.position, updated_at = excluded.updated_at
+        """,
+        (name, position, int(time.time())),
+        commit=True
+    )
 
 
 # Payment management
-def create_payment(tg_id: int, tariff_code: str, amount: float, provider: str, invoice_id: str):
-    """Создать запись о платеже"""
+def create_payment(
+    tg_id: int,
+    tariff_code: str,
+    amount: float,
+    provider: str,
+    invoice_id: str,
+    pay_url: str | None = None,
+    expires_at: int | None = None
+):
+    """
+    Создать запись о платеже
+
+    Args:
+        pay_url: Ссылка на оплату счёта (для повторного показа)
+        expires_at: Когда счёт истекает, epoch-секунды
+    """
     if USE_SUPABASE:
-        supabase_db.create_payment(tg_id, tariff_code, amount, provider, invoice_id)
+        supabase_db.create_payment(tg_id, tariff_code, amount, provider, invoice_id, pay_url, expires_at)
     else:
-        from datetime import datetime
         db_execute(
             """
-            INSERT INTO payments (tg_id, tariff_code, amount, created_at, provider, invoice_id)
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT INTO payments (tg_id, tariff_code, amount, created_at, provider, invoice_id, pay_url, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             """,
-            (tg_id, tariff_code, amount, datetime.utcnow().isoformat(), provider, str(invoice_id)),
+            (tg_id, tariff_code, amount, int(time.time()), provider, str(invoice_id), pay_url, expires_at),
             commit=True
         )
 
 
+def get_open_invoice(tg_id: int, tariff_code: str, amount: float, valid_until: int):
+    """
+    Найти неоплаченный счёт пользователя на тот же тариф и сумму
+
+    Args:
+        tg_id: ID пользователя Telegram
+        tariff_code: Код тарифа
+        amount: Сумма платежа
+        valid_until: Счёт должен быть действителен хотя бы до этого момента (epoch)
+
+    Returns:
+        Кортеж (invoice_id, pay_url) или None
+    """
+    if USE_SUPABASE:
+        return supabase_db.get_open_invoice(tg_id, tariff_code, amount, valid_until)
+    return db_execute(
+        """
+        SELECT invoice_id, pay_url FROM payments
+        WHERE tg_id = ? AND status = 'pending' AND provider = 'cryptobot'
+          AND tariff_code = ? AND amount = ? AND pay_url IS NOT NULL AND expires_at > ?
+        ORDER BY id DESC LIMIT 1
+        """,
+        (tg_id, tariff_code, amount, valid_until),
+        fetchone=True
+    )
+
+
 def get_pending_payments():
     """Получить все ожидающие платежи"""
     if USE_SUPABASE:
@@ -242,6 +547,35 @@ def get_pending_payments():
     )
 
 
+def get_pending_payments_after(after_id: int = 0, limit: int = 1000):
+    """
+    Получить ожидающие платежи с id больше after_id (по возрастанию id)
+
+    Позволяет планировщику проверки подхватывать только новые платежи,
+    не перечитывая всю таблицу.
+
+    Args:
+        after_id: Последний уже загруженный id платежа
+        limit: Максимум строк за вызов
+
+    Returns:
+        Список кортежей (id, tg_id, invoice_id, tariff_code, created_at),
+        created_at — epoch-секунды
+    """
+    if USE_SUPABASE:
+        rows = supabase_db.get_pending_payments_after(after_id, limit)
+        return [(row[0], row[1], row[2], row[3], _to_epoch(row[4])) for row in rows]
+    return db_execute(
+        """
+        SELECT id, tg_id, invoice_id, tariff_code, created_at FROM payments
+        WHERE status = 'pending' AND provider = 'cryptobot' AND id > ?
+        ORDER BY id LIMIT ?
+        """,
+        (after_id, limit),
+        fetchall=True
+    )
+
+
 def get_last_pending_payment(tg_id: int):
     """Получить последний ожидающий платеж пользователя"""
     if USE_SUPABASE:
@@ -253,6 +587,22 @@ def get_last_pending_payment(tg_id: int):
     )
 
 
+def get_payment_by_invoice(invoice_id: str):
+    """
+    Получить платёж по invoice_id
+
+    Returns:
+        Кортеж (id, tg_id, tariff_code, status) или None
+    """
+    if USE_SUPABASE:
+        return supabase_db.get_payment_by_invoice(invoice_id)
+    return db_execute(
+        "SELECT id, tg_id, tariff_code, status FROM payments WHERE invoice_id = ?",
+        (str(invoice_id),),
+        fetchone=True
+    )
+
+
 def update_payment_status(payment_id: int, status: str):
     """Обновить статус платежа"""
     if USE_SUPABASE:
@@ -277,6 +627,255 @@ def update_payment_status_by_invoice(invoice_id: str, status: str):
         )
 
 
+def expire_payments(payment_ids: list) -> int:
+    """
+    Пометить платежи как expired, если они всё ещё ожидают оплаты
+
+    Returns:
+        Количество изменённых платежей
+    """
+    if not payment_ids:
+        return 0
+    if USE_SUPABASE:
+        return supabase_db.expire_payments(payment_ids)
+    conn = get_connection()
+    try:
+        placeholders = ",".join("?" * len(payment_ids))
+        cursor = conn.execute(
+            f"UPDATE payments SET status = 'expired' WHERE status = 'pending' AND id IN ({placeholders})",
+            list(payment_ids)
+        )
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+
+# Activation outbox (см. services/activation.py)
+ACTIVATION_JOB_COLUMNS = (
+    "id", "invoice_id", "tg_id", "tariff_code", "days", "state", "step", "attempts",
+    "next_attempt_at", "locked_by", "locked_until", "remnawave_uuid", "remnawave_username",
+    "sub_url", "target_expire_at", "referrer_expire_at", "last_error", "created_at", "updated_at"
+)
+
+# Поля, которые шаги активации сохраняют по ходу выполнения
+ACTIVATION_PROGRESS_FIELDS = (
+    "remnawave_uuid", "remnawave_username", "sub_url", "target_expire_at", "referrer_expire_at"
+)
+
+
+def enqueue_activation(invoice_id: str, tg_id: int, tariff_code: str, days: int) -> bool:
+    """
+    Поставить активацию оплаченного счёта в outbox
+
+    invoice_id — ключ идемпотентности: повторная постановка того же счёта
+    ничего не делает.
+
+    Returns:
+        True если задача создана сейчас
+    """
+    if USE_SUPABASE:
+        return supabase_db.enqueue_activation(invoice_id, tg_id, tariff_code, days)
+    now = int(time.time())
+    conn = get_connection()
+    try:
+        created = conn.execute(
+            """
+            INSERT INTO activation_jobs (invoice_id, tg_id, tariff_code, days, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(invoice_id) DO NOTHING
+            """,
+            (str(invoice_id), tg_id, tariff_code, days, now, now)
+        ).rowcount == 1
+        conn.commit()
+        return created
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+
+def claim_activation_jobs(owner: str, limit: int, lease_seconds: int, invoice_id: str | None = None) -> list:
+    """
+    Захватить готовые к выполнению задачи outbox
+
+    Берутся задачи pending, чей next_attempt_at наступил, и задачи running
+    с истёкшей арендой (процесс упал). Задача пользователя не берётся,
+    пока не завершена его более ранняя задача.
+
+    Args:
+        owner: Идентификатор захватывающего обработчика
+        limit: Максимум задач
+        lease_seconds: Срок аренды задачи
+        invoice_id: Захватить только задачу этого счёта
+
+    Returns:
+        Список задач (словари с колонками ACTIVATION_JOB_COLUMNS)
+    """
+    if USE_SUPABASE:
+        return supabase_db.claim_activation_jobs(owner, limit, lease_seconds, invoice_id)
+    now = int(time.time())
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        ids = [row[0] for row in conn.execute(
+            """
+            SELECT c.id FROM activation_jobs c
+            WHERE ((c.state = 'pending' AND c.next_attempt_at <= ?)
+                   OR (c.state = 'running' AND c.locked_until < ?))
+              AND (? IS NULL OR c.invoice_id = ?)
+              AND NOT EXISTS (
+                  SELECT 1 FROM activation_jobs o
+                  WHERE o.tg_id = c.tg_id AND o.id < c.id AND o.state IN ('pending', 'running')
+              )
+            ORDER BY c.id LIMIT ?
+            """,
+            (now, now, invoice_id, invoice_id, limit)
+        )]
+        rows = []
+        for job_id in ids:
+            conn.execute(
+                "UPDATE activation_jobs SET state = 'running', locked_by = ?, locked_until = ?, updated_at = ? WHERE id = ?",
+                (owner, now + lease_seconds, now, job_id)
+            )
+            rows.append(conn.execute(
+                f"SELECT {', '.join(ACTIVATION_JOB_COLUMNS)} FROM activation_jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone())
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return [dict(zip(ACTIVATION_JOB_COLUMNS, row)) for row in rows]
+
+
+def save_activation_progress(invoice_id: str, owner: str, step: str | None, lease_seconds: int, fields: dict) -> bool:
+    """
+    Сохранить выполненный шаг и его результаты, продлить аренду задачи
+
+    Args:
+        invoice_id: ID счёта (ключ задачи)
+        owner: Владелец аренды; чужую задачу не трогаем
+        step: Последний выполненный шаг; None — шаг не меняется (сохраняются только поля)
+        lease_seconds: На сколько продлить аренду
+        fields: Значения из ACTIVATION_PROGRESS_FIELDS
+
+    Returns:
+        True если задача всё ещё принадлежит owner
+    """
+    fields = {k: v for k, v in fields.items() if k in ACTIVATION_PROGRESS_FIELDS}
+    if USE_SUPABASE:
+        return supabase_db.save_activation_progress(invoice_id, owner, step, lease_seconds, fields)
+    now = int(time.time())
+    assignments = "".join(f", {column} = ?" for column in fields)
+    conn = get_connection()
+    try:
+        updated = conn.execute(
+            f"UPDATE activation_jobs SET step = COALESCE(?, step), locked_until = ?, updated_at = ?{assignments} "
+            "WHERE invoice_id = ? AND locked_by = ?",
+            (step, now + lease_seconds, now, *fields.values(), str(invoice_id), owner)
+        ).rowcount == 1
+        conn.commit()
+        return updated
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+
+def count_activation_referral(invoice_id: str, owner: str, referrer_id: int | None, lease_seconds: int) -> bool:
+    """
+    Засчитать активного реферала и отметить шаг referral_count одной транзакцией
+
+    Счётчик рефералита увеличивается, только если последний сохранённый шаг
+    задачи — referral: повтор после сбоя не засчитывает реферала второй раз.
+
+    Args:
+        invoice_id: ID счёта (ключ задачи)
+        owner: Владелец аренды; чужую задачу не трогаем
+        referrer_id: tg_id рефералита или None (шаг отмечается без счётчика)
+        lease_seconds: На сколько продлить аренду
+
+    Returns:
+        True если задача всё ещё принадлежит owner
+    """
+    if USE_SUPABASE:
+        counted = supabase_db.count_activation_referral(invoice_id, owner, referrer_id, lease_seconds)
+    else:
+        now = int(time.time())
+        conn = get_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT step FROM activation_jobs WHERE invoice_id = ? AND locked_by = ?",
+                (str(invoice_id), owner)
+            ).fetchone()
+            counted = row is not None
+            if counted:
+                if row[0] == "referral" and referrer_id:
+                    conn.execute(
+                        "UPDATE users SET active_referrals = active_referrals + 1 WHERE tg_id = ?",
+                        (referrer_id,)
+                    )
+                conn.execute(
+                    "UPDATE activation_jobs SET step = 'referral_count', locked_until = ?, updated_at = ? "
+                    "WHERE invoice_id = ?",
+                    (now + lease_seconds, now, str(invoice_id))
+                )
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    if referrer_id:
+        user_cache.invalidate(referrer_id)
+    return counted
+
+
+def finish_activation_job(invoice_id: str, owner: str, state: str, attempts: int,
+                          next_attempt_at: int = 0, last_error: str | None = None):
+    """
+    Завершить попытку: done, failed или pending с новым временем попытки
+
+    Аренда снимается, задача снова доступна для захвата (если pending).
+    """
+    if USE_SUPABASE:
+        return supabase_db.finish_activation_job(invoice_id, owner, state, attempts, next_attempt_at, last_error)
+    db_execute(
+        """
+        UPDATE activation_jobs
+        SET state = ?, attempts = ?, next_attempt_at = ?, last_error = ?,
+            locked_by = NULL, locked_until = NULL, updated_at = ?
+        WHERE invoice_id = ? AND locked_by = ?
+        """,
+        (state, attempts, next_attempt_at, last_error, int(time.time()), str(invoice_id), owner),
+        commit=True
+    )
+
+
+def get_activation_backlog() -> dict:
+    """
+    Состояние outbox для администратора
+
+    Returns:
+        {"counts": {state: n}, "oldest_pending_at": epoch или None,
+         "failed": [(invoice_id, tg_id, attempts, last_error), ...] — последние 5}
+    """
+    if USE_SUPABASE:
+        return supabase_db.get_activation_backlog()
+    counts = dict(db_execute(
+        "SELECT state, COUNT(*) FROM activation_jobs GROUP BY state",
+        fetchall=True
+    ))
+    oldest = db_execute(
+        "SELECT MIN(created_at) FROM activation_jobs WHERE state IN ('pending', 'running')",
+        fetchone=True
+    )[0]
+    failed = db_execute(
+        "SELECT invoice_id, tg_id, attempts, last_error FROM activation_jobs WHERE state = 'failed' ORDER BY id DESC LIMIT 5",
+        fetchall=True
+    )
+    return {"counts": counts, "oldest_pending_at": oldest, "failed": failed}
+
+
 # Referral management
 def update_referral_count(tg_id: int):
     """Увеличить счётчик рефералов"""
@@ -288,6 +887,7 @@ def update_referral_count(tg_id: int):
             (tg_id,),
             commit=True
         )
+    user_cache.invalidate(tg_id)
 
 
 def increment_active_referrals(tg_id: int):
@@ -300,28 +900,23 @@ def increment_active_referrals(tg_id: int):
             (tg_id,),
             commit=True
         )
+    user_cache.invalidate(tg_id)
 
 
 def get_referral_stats(tg_id: int):
     """Получить статистику рефералов пользователя"""
-    if USE_SUPABASE:
-        return supabase_db.get_referral_stats(tg_id)
-    return db_execute(
-        "SELECT referral_count, active_referrals FROM users WHERE tg_id = ?",
-        (tg_id,),
-        fetchone=True
-    )
+    user = get_user(tg_id)
+    if not user:
+        return None
+    return (user_field(user, "referral_count"), user_field(user, "active_referrals"))
 
 
 def get_referrer(tg_id: int):
     """Получить информацию о рефералите"""
-    if USE_SUPABASE:
-        return supabase_db.get_referrer(tg_id)
-    return db_execute(
-        "SELECT referrer_id, first_payment FROM users WHERE tg_id = ?",
-        (tg_id,),
-        fetchone=True
-    )
+    user = get_user(tg_id)
+    if not user:
+        return None
+    return (user_field(user, "referrer_id"), user_field(user, "first_payment"))
 
 
 def mark_first_payment(tg_id: int):
@@ -334,15 +929,13 @@ def mark_first_payment(tg_id: int):
             (tg_id,),
             commit=True
         )
+    user_cache.invalidate(tg_id)
 
 
 # Gift management
 def is_gift_received(tg_id: int) -> bool:
     """Проверить получил ли пользователь подарок"""
-    if USE_SUPABASE:
-        return supabase_db.is_gift_received(tg_id)
-    user = get_user(tg_id)
-    return user and user[8]  # gift_received column
+    return bool(user_field(get_user(tg_id), "gift_received"))
 
 
 def mark_gift_received(tg_id: int):
@@ -355,6 +948,7 @@ def mark_gift_received(tg_id: int):
             (tg_id,),
             commit=True
         )
+    user_cache.invalidate(tg_id)
 
 
 # Promo code management
@@ -364,7 +958,7 @@ def get_promo_code(code: str):
         return supabase_db.get_promo_code(code)
     return db_execute(
         "SELECT days, max_uses, used_count, active FROM promo_codes WHERE code = ?",
-        (code,),
+        (code.upper(),),
         fetchone=True
     )
 
@@ -388,6 +982,52 @@ def increment_promo_usage(code: str):
     else:
         db_execute(
             "UPDATE promo_codes SET used_count = used_count + 1 WHERE code = ?",
-            (code,),
+            (code.upper(),),
+            commit=True
+        )
+
+
+def redeem_promo_code(code: str):
+    """
+    Списать одно использование промокода, если он активен и лимит не исчерпан
+
+    Args:
+        code: Промокод
+
+    Returns:
+        Кортеж (days, used_count, max_uses) после списания или None
+    """
+    if USE_SUPABASE:
+        return supabase_db.redeem_promo_code(code)
+
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        redeemed = conn.execute(
+            "UPDATE promo_codes SET used_count = used_count + 1 WHERE code = ? AND active AND used_count < max_uses",
+            (code.upper(),)
+        ).rowcount == 1
+        result = None
+        if redeemed:
+            result = conn.execute(
+                "SELECT days, used_count, max_uses FROM promo_codes WHERE code = ?",
+                (code.upper(),)
+            ).fetchone()
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+    return result
+
+
+def release_promo_code(code: str):
+    """Вернуть использование промокода (если активация не удалась)"""
+    if USE_SUPABASE:
+        supabase_db.release_promo_code(code)
+    else:
+        db_execute(
+            "UPDATE promo_codes SET used_count = used_count - 1 WHERE code = ? AND used_count > 0",
+            (code.upper(),),
             commit=True
         )
@@ -0,0 +1,128 @@
+"""
+Бюджет времени на обработку и дедлайны исходящих запросов.
+
+Обработчик апдейта Telegram получает бюджет HANDLER_DEADLINE секунд
+(DeadlineMiddleware): Telegram перестаёт ждать ответа на кнопку через
+~15 с, и держать user_lock дольше бессмысленно. Дедлайн хранится в
+contextvar, поэтому его наследуют все вызовы и задачи, созданные внутри
+обработчика. Вложенный budget() может только сократить оставшееся время.
+
+Каждый запрос к CryptoBot и Remnawave получает client_timeout(): свои
+таймауты соединения и чтения для API, а общий таймаут — остаток бюджета
+(не больше HTTP_TIMEOUT). Повторы в UpstreamPolicy не начинаются, если
+задержка перед ними не укладывается в остаток.
+
+Общие задачи (single-flight запрос, пачка добавлений в сквад) выполняются
+без дедлайна вызывающего (unbounded): их результат ждут и другие, а
+каждый вызывающий ждёт не дольше своего остатка.
+
+Метрики (см. metrics.py):
+    http_<name>_deadline_exceeded — запросов, не отправленных или прерванных из-за дедлайна
+    handler_deadline_exceeded     — обработчиков, не уложившихся в бюджет
+"""
+
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable
+
+import aiohttp
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from config import HTTP_TIMEOUT
+import metrics
+
+# Дедлайн текущей обработки (time.monotonic()) или None — без бюджета
+_deadline: ContextVar[float | None] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """Бюджет времени исчерпан до отправки запроса"""
+
+
+@contextmanager
+def budget(seconds: float | None):
+    """
+    Ограничить время выполнения блока seconds секундами
+
+    Внешний дедлайн, если он раньше, сохраняется. None или 0 — блок без
+    нового ограничения.
+    """
+    if not seconds or seconds <= 0:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def unbounded():
+    """Выполнить блок без дедлайна вызывающего (для задач, результат которых ждут несколько вызывающих)"""
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> float | None:
+    """Сколько секунд осталось до дедлайна (None — дедлайна нет)"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def expired() -> bool:
+    """Дедлайн уже наступил"""
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def client_timeout(name: str, connect: float, read: float) -> aiohttp.ClientTimeout:
+    """
+    Таймаут запроса к API с учётом дедлайна
+
+    Args:
+        name: Имя API для метрик (cryptobot, remnawave)
+        connect: Таймаут соединения, сек
+        read: Таймаут чтения ответа, сек
+
+    Returns:
+        ClientTimeout, total — остаток бюджета, но не больше HTTP_TIMEOUT
+
+    Raises:
+        DeadlineExceeded: бюджет уже исчерпан
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        metrics.inc(f"http_{name}_deadline_exceeded")
+        raise DeadlineExceeded(f"{name}: deadline exceeded before request")
+    total = HTTP_TIMEOUT if left is None else min(HTTP_TIMEOUT, left)
+    return aiohttp.ClientTimeout(total=total, connect=min(connect, total), sock_read=min(read, total))
+
+
+class DeadlineMiddleware(BaseMiddleware):
+    """Outer-middleware aiogram: бюджет времени на обработку апдейта"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any]
+    ) -> Any:
+        with budget(self.seconds):
+            try:
+                return await handler(event, data)
+            except asyncio.TimeoutError:
+                if expired():
+                    metrics.inc("handler_deadline_exceeded")
+                raise
@@ -1,20 +1,24 @@
+import asyncio
+import html
 import logging
 import aiohttp
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from aiogram import Router
 from aiogram.filters import Command
 from aiogram.types import Message
 from config import ADMIN_ID, DEFAULT_SQUAD_UUID
-import database as db
-from services.remnawave import (
-    remnawave_get_or_create_user,
-    remnawave_add_to_squad
-)
+import async_database as db
+from user_locks import user_lock
+import metrics
+from services.remnawave import RemnawaveClient, RemnawaveError
 
 logger = logging.getLogger(__name__)
 
 router = Router()
 
+# Сколько символов last_error показывать в /outbox: сообщение Telegram ограничено 4096
+OUTBOX_ERROR_PREVIEW = 300
+
 
 def is_admin(user_id: int) -> bool:
     """Проверить является ли пользователь администратором"""
@@ -54,7 +58,7 @@ async def admin_new_code(message: Message):
 
     try:
         # Создаём промокод
-        db.create_promo_code(code.upper(), days, limit)
+        await db.create_promo_code(code.upper(), days, limit)
 
         await message.answer(
             f"✅ <b>Промокод создан успешно</b>\n\n"
@@ -71,7 +75,7 @@ async def admin_new_code(message: Message):
 
 
 @router.message(Command("give_sub"))
-async def admin_give_sub(message: Message):
+async def admin_give_sub(message: Message, remnawave: aiohttp.ClientSession):
     """Админ команда: выдать/продлить подписку пользователю по ИД"""
     admin_id = message.from_user.id
 
@@ -103,64 +107,59 @@ async def admin_give_sub(message: Message):
         logger.error(f"Admin {admin_id} /give_sub parsing error: {e}")
         return
 
-    if not db.acquire_user_lock(tg_id):
-        await message.answer(f"❌ Пользователь {tg_id} занят, попробуй позже")
-        return
+    # Убедимся что пользователь существует в БД (аренда блокировки хранится в его строке)
+    if not await db.user_exists(tg_id):
+        await db.create_user(tg_id, f"user_{tg_id}")
+        logger.info(f"Created new user {tg_id} in database")
 
-    try:
-        # Убедимся что пользователь существует в БД
-        if not db.user_exists(tg_id):
-            db.create_user(tg_id, f"user_{tg_id}")
-            logger.info(f"Created new user {tg_id} in database")
-
-        connector = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            # Создаём или получаем пользователя в Remnawave
-            uuid, username = await remnawave_get_or_create_user(
-                session, tg_id, days=days, extend_if_exists=True
-            )
+    async with user_lock(tg_id) as acquired:
+        if not acquired:
+            await message.answer(f"❌ Пользователь {tg_id} занят, попробуй позже")
+            return
 
-            if not uuid:
+        try:
+            # Продлеваем или создаём пользователя в Remnawave и добавляем в сквад
+            # Для продления UUID берём из БД — без поиска по username
+            known_uuid = db.user_field(await db.get_user(tg_id), "remnawave_uuid")
+            try:
+                provisioned = await RemnawaveClient(remnawave).provision(tg_id, days, user_uuid=known_uuid)
+            except (RemnawaveError, aiohttp.ClientError, asyncio.TimeoutError) as e:
                 await message.answer(f"❌ Ошибка при работе с Remnawave API для пользователя {tg_id}")
-                logger.error(f"Failed to get/create Remnawave user for TG {tg_id}")
+                logger.error(f"Failed to provision Remnawave user for TG {tg_id}: {e}")
                 return
 
-            # Добавляем в сквад
-            squad_added = await remnawave_add_to_squad(session, uuid)
-            if not squad_added:
-                logger.warning(f"Failed to add user {uuid} to squad, continuing anyway")
+            uuid = provisioned.uuid
 
             # Обновляем подписку в БД
-            new_until = (datetime.now(timezone.utc) + timedelta(days=days)).isoformat()
-            db.update_subscription(tg_id, uuid, username, new_until, DEFAULT_SQUAD_UUID)
-
-        await message.answer(
-            f"✅ <b>Подписка выдана успешно</b>\n\n"
-            f"<b>Пользователь:</b> {tg_id}\n"
-            f"<b>Дней:</b> {days}\n"
-            f"<b>Remnawave UUID:</b> <code>{uuid}</code>"
-        )
+            await db.update_subscription(
+                tg_id, uuid, provisioned.username, provisioned.expire_at, DEFAULT_SQUAD_UUID,
+                provisioned.subscription_url
+            )
 
-        # Уведомляем пользователя
-        try:
-            await message.bot.send_message(
-                tg_id,
-                f"🎉 <b>Поздравляем!</b>\n\n"
-                f"Вам выдана подписка SPN VPN на <b>{days} дней</b>\n\n"
-                f"Спасибо за использование нашего сервиса! 🚀"
+            await message.answer(
+                f"✅ <b>Подписка выдана успешно</b>\n\n"
+                f"<b>Пользователь:</b> {tg_id}\n"
+                f"<b>Дней:</b> {days}\n"
+                f"<b>Remnawave UUID:</b> <code>{uuid}</code>"
             )
-            logger.info(f"User {tg_id} notified about subscription")
-        except Exception as e:
-            logger.warning(f"Failed to notify user {tg_id}: {e}")
 
-        logger.info(f"Admin {admin_id} gave subscription to user {tg_id} for {days} days")
+            # Уведомляем пользователя
+            try:
+                await message.bot.send_message(
+                    tg_id,
+                    f"🎉 <b>Поздравляем!</b>\n\n"
+                    f"Вам выдана подписка SPN VPN на <b>{days} дней</b>\n\n"
+                    f"Спасибо за использование нашего сервиса! 🚀"
+                )
+                logger.info(f"User {tg_id} notified about subscription")
+            except Exception as e:
+                logger.warning(f"Failed to notify user {tg_id}: {e}")
 
-    except Exception as e:
-        logger.error(f"Give subscription error: {e}")
-        await message.answer(f"❌ Ошибка при выдаче подписки: {str(e)}")
+            logger.info(f"Admin {admin_id} gave subscription to user {tg_id} for {days} days")
 
-    finally:
-        db.release_user_lock(tg_id)
+        except Exception as e:
+            logger.error(f"Give subscription error: {e}")
+            await message.answer(f"❌ Ошибка при выдаче подписки: {str(e)}")
 
 
 @router.message(Command("stats"))
@@ -173,5 +172,37 @@ async def admin_stats(message: Message):
         logger.warning(f"User {admin_id} tried to use /stats without admin permissions")
         return
 
-    # TODO: Реализовать получение статистики из БД
-    await message.answer("📊 Статистика ещё не реализована\n\nВ разработке...")
+    await message.answer(
+        "📊 <b>Метрики процесса</b>\n\n"
+        f"<code>{metrics.render()}</code>"
+    )
+
+
+@router.message(Command("outbox"))
+async def admin_outbox(message: Message):
+    """Админ команда: состояние outbox активаций"""
+    admin_id = message.from_user.id
+
+    if not is_admin(admin_id):
+        await message.answer("❌ Эта команда доступна только администратору")
+        logger.warning(f"User {admin_id} tried to use /outbox without admin permissions")
+        return
+
+    backlog = await db.get_activation_backlog()
+    counts = backlog.get("counts") or {}
+    lines = [f"{state}: {counts.get(state, 0)}" for state in ("pending", "running", "done", "failed")]
+
+    oldest = backlog.get("oldest_pending_at")
+    if oldest:
+        age = int(datetime.now(timezone.utc).timestamp() - float(oldest))
+        lines.append(f"\nСамая старая незавершённая: {age // 60} мин назад")
+
+    failed = backlog.get("failed") or []
+    if failed:
+        lines.append("\n<b>Последние failed:</b>")
+        for invoice_id, tg_id, attempts, last_error in failed:
+            # Текст ошибки Remnawave/aiohttp может содержать <, > и &
+            error = html.escape(str(last_error or "")[:OUTBOX_ERROR_PREVIEW])
+            lines.append(f"• {html.escape(str(invoice_id))} (user {tg_id}, попыток {attempts}): {error}")
+
+    await message.answer("📦 <b>Outbox активаций</b>\n\n" + "\n".join(lines))
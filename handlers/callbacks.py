@@ -4,7 +4,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from config import SUPPORT_URL
 from states import UserStates
-import database as db
+import async_database as db
 from handlers.start import show_main_menu
 
 
@@ -15,7 +15,7 @@ router = Router()
 async def process_accept_terms(callback: CallbackQuery, state: FSMContext):
     """Обработчик принятия условий использования"""
     tg_id = callback.from_user.id
-    db.accept_terms(tg_id)
+    await db.accept_terms(tg_id)
 
     await callback.message.delete()
     await state.clear()
@@ -1,17 +1,15 @@
+import asyncio
 import logging
 import aiohttp
-from datetime import datetime, timedelta, timezone
 from aiogram import Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from config import DEFAULT_SQUAD_UUID
 from states import UserStates
-import database as db
-from services.remnawave import (
-    remnawave_get_or_create_user,
-    remnawave_add_to_squad,
-    remnawave_get_subscription_url
-)
+import async_database as db
+from user_locks import user_lock
+import metrics
+from services.remnawave import RemnawaveClient, RemnawaveError, remnawave_unavailable, DEGRADED_TEXT
 from handlers.start import show_main_menu
 
 
@@ -26,45 +24,61 @@ async def process_enter_promo(callback: CallbackQuery, state: FSMContext):
 
 
 @router.message(UserStates.waiting_for_promo)
-async def process_promo_input(message: Message, state: FSMContext):
+async def process_promo_input(message: Message, state: FSMContext, remnawave: aiohttp.ClientSession):
     """Обработать введённый промокод"""
     code = message.text.strip().upper()
     tg_id = message.from_user.id
 
-    if not db.acquire_user_lock(tg_id):
-        await message.answer("Подожди пару секунд ⏳")
+    if remnawave_unavailable():
+        # Промокод не списываем: выдать подписку сейчас всё равно не получится
+        metrics.inc("remnawave_degraded_responses")
+        await message.answer(DEGRADED_TEXT)
+        await state.clear()
+        await show_main_menu(message)
         return
 
-    try:
-        # Проверяем промокод в БД
-        promo = db.get_promo_code(code)
-
-        if not promo or not promo[3] or promo[2] >= promo[1]:  # active и used_count < max_uses
-            await message.answer("❌ Неверный или исчерпанный промокод")
-            await state.clear()
-            await show_main_menu(message)
+    async with user_lock(tg_id) as acquired:
+        if not acquired:
+            await message.answer("Подожди пару секунд ⏳")
             return
 
-        days = promo[0]
+        refund_promo = False
 
-        # Создаём или получаем пользователя в Remnawave
-        connector = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            uuid, username = await remnawave_get_or_create_user(
-                session, tg_id, days=days, extend_if_exists=True
-            )
+        try:
+            # Атомарно списываем использование промокода (только если лимит не исчерпан)
+            promo = await db.redeem_promo_code(code)
+
+            if not promo:
+                await message.answer("❌ Неверный или исчерпанный промокод")
+                await state.clear()
+                await show_main_menu(message)
+                return
+
+            refund_promo = True
+            days = promo[0]
 
-            if not uuid:
+            # Продлеваем или создаём пользователя в Remnawave и добавляем в сквад
+            # Для продления UUID берём из БД — без поиска по username
+            known_uuid = db.user_field(await db.get_user(tg_id), "remnawave_uuid")
+            try:
+                provisioned = await RemnawaveClient(remnawave).provision(tg_id, days, user_uuid=known_uuid)
+            except (RemnawaveError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.error(f"Promo provisioning failed for {tg_id}: {e}")
                 await message.answer("❌ Ошибка при применении промокода")
                 await state.clear()
                 await show_main_menu(message)
                 return
 
-            # Добавляем в сквад
-            await remnawave_add_to_squad(session, uuid)
-            
-            # Получаем ссылку подписки
-            sub_url = await remnawave_get_subscription_url(session, uuid)
+            # Подписка выдана — использование промокода остаётся списанным
+            refund_promo = False
+
+            # Обновляем подписку пользователя в БД
+            await db.update_subscription(
+                tg_id, provisioned.uuid, provisioned.username, provisioned.expire_at, DEFAULT_SQUAD_UUID,
+                provisioned.subscription_url
+            )
+
+            sub_url = provisioned.subscription_url
 
             if not sub_url:
                 await message.answer("❌ Ошибка при получении ссылки подписки")
@@ -72,28 +86,23 @@ async def process_promo_input(message: Message, state: FSMContext):
                 await show_main_menu(message)
                 return
 
-        # Обновляем промокод (увеличиваем счётчик использования)
-        db.increment_promo_usage(code)
-
-        # Обновляем подписку пользователя в БД
-        new_until = (datetime.now(timezone.utc) + timedelta(days=days)).isoformat()
-        db.update_subscription(tg_id, uuid, username, new_until, DEFAULT_SQUAD_UUID)
-
-        # Отправляем успешное сообщение
-        await message.answer(
-            f"✅ <b>Промокод активирован!</b>\n\n"
-            f"Добавлено {days} дней подписки\n\n"
-            f"<b>Ссылка подписки:</b>\n<code>{sub_url}</code>"
-        )
-        
-        logging.info(f"Promo code {code} applied by user {tg_id}")
-
-    except Exception as e:
-        logging.error(f"Promo error: {e}")
-        await message.answer("❌ Ошибка при применении промокода")
-    
-    finally:
-        db.release_user_lock(tg_id)
+            # Отправляем успешное сообщение
+            await message.answer(
+                f"✅ <b>Промокод активирован!</b>\n\n"
+                f"Добавлено {days} дней подписки\n\n"
+                f"<b>Ссылка подписки:</b>\n<code>{sub_url}</code>"
+            )
+
+            logging.info(f"Promo code {code} applied by user {tg_id}")
+
+        except Exception as e:
+            logging.error(f"Promo error: {e}")
+            await message.answer("❌ Ошибка при применении промокода")
+
+        finally:
+            if refund_promo:
+                # Подписка не выдана — возвращаем использование промокода
+                await db.release_promo_code(code)
 
     await state.clear()
     await show_main_menu(message)
@@ -1,6 +1,6 @@
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-import database as db
+import async_database as db
 
 
 router = Router()
@@ -16,7 +16,7 @@ async def process_referral(callback: CallbackQuery):
     referral_link = f"https://t.me/{bot_username}?start=ref_{tg_id}"
 
     # Получаем статистику рефералов
-    stats = db.get_referral_stats(tg_id)
+    stats = await db.get_referral_stats(tg_id)
     ref_count = stats[0] if stats else 0
     active_count = stats[1] if stats else 0
 
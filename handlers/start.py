@@ -5,7 +5,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from config import TELEGRAPH_AGREEMENT_URL, SUPPORT_URL
 from states import UserStates
-import database as db
+import async_database as db
 
 
 router = Router()
@@ -25,16 +25,17 @@ async def cmd_start(message: Message, state: FSMContext, bot: Bot):
     if len(args) > 1 and args[1].startswith("ref_"):
         try:
             referrer_id = int(args[1].split("_")[1])
-            db.update_referral_count(referrer_id)
-            logging.info(f"User {tg_id} joined via referral link from {referrer_id}")
         except (ValueError, IndexError):
             referrer_id = None
 
-    # Создаём пользователя если его нет
-    db.create_user(tg_id, username, referrer_id)
+    # Создаём пользователя если его нет и получаем его запись одним запросом
+    user, created = await db.bootstrap_user(tg_id, username, referrer_id)
+
+    if created and referrer_id:
+        logging.info(f"User {tg_id} joined via referral link from {referrer_id}")
 
     # Проверяем принял ли пользователь условия
-    if not db.has_accepted_terms(tg_id):
+    if not db.user_field(user, "accepted_terms"):
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="✅ Принять", callback_data="accept_terms")],
             [InlineKeyboardButton(text="📄 Прочитать соглашение", url=TELEGRAPH_AGREEMENT_URL)]
@@ -1,14 +1,24 @@
 import logging
 import logging
+import asyncio
+import time
 import aiohttp
 from datetime import datetime, timedelta, timezone
 from aiogram import Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from config import TARIFFS, DEFAULT_SQUAD_UUID
+from config import (
+    TARIFFS,
+    DEFAULT_SQUAD_UUID,
+    CRYPTOBOT_INVOICE_TTL,
+    CRYPTOBOT_INVOICE_REUSE_MARGIN,
+    SUBSCRIPTION_REFRESH_AGE
+)
 from states import UserStates
-import database as db
-from services.remnawave import remnawave_get_subscription_url, remnawave_get_user_info
+import async_database as db
+import metrics
+from user_locks import user_lock
+from services.remnawave import remnawave_get_user_info, parse_expire_at, remnawave_unavailable
 from services.cryptobot import create_cryptobot_invoice, get_invoice_status, process_paid_invoice
 
 
@@ -51,7 +61,7 @@ async def process_tariff_choice(callback: CallbackQuery, state: FSMContext):
 
 
 @router.callback_query(F.data == "pay_cryptobot")
-async def process_pay_cryptobot(callback: CallbackQuery, state: FSMContext):
+async def process_pay_cryptobot(callback: CallbackQuery, state: FSMContext, cryptobot: aiohttp.ClientSession):
     """Создать счёт в CryptoBot"""
     data = await state.get_data()
     tariff_code = data.get("tariff_code")
@@ -63,26 +73,44 @@ async def process_pay_cryptobot(callback: CallbackQuery, state: FSMContext):
 
     tariff = TARIFFS[tariff_code]
     amount = tariff["price"]
+    tg_id = callback.from_user.id
 
-    # Создаём счёт в CryptoBot
-    invoice = await create_cryptobot_invoice(callback.bot, amount, tariff_code, callback.from_user.id)
-
-    if not invoice:
-        await callback.message.edit_text("Ошибка создания счёта в CryptoBot. Попробуй позже.")
-        await state.clear()
-        return
+    async with user_lock(tg_id) as acquired:
+        if not acquired:
+            await callback.answer("Подожди пару секунд ⏳", show_alert=True)
+            return
 
-    invoice_id = invoice["invoice_id"]
-    pay_url = invoice["bot_invoice_url"]
+        # Открытый счёт на тот же тариф показываем повторно, а не создаём новый
+        open_invoice = await db.get_open_invoice(
+            tg_id, tariff_code, amount, int(time.time()) + CRYPTOBOT_INVOICE_REUSE_MARGIN
+        )
 
-    # Записываем платеж в БД
-    db.create_payment(
-        callback.from_user.id,
-        tariff_code,
-        amount,
-        "cryptobot",
-        invoice_id
-    )
+        if open_invoice:
+            invoice_id, pay_url = open_invoice
+            metrics.inc("cryptobot_invoices_reused")
+        else:
+            # Создаём счёт в CryptoBot
+            invoice = await create_cryptobot_invoice(cryptobot, callback.bot, amount, tariff_code, tg_id)
+
+            if not invoice:
+                await callback.message.edit_text("Ошибка создания счёта в CryptoBot. Попробуй позже.")
+                await state.clear()
+                return
+
+            invoice_id = invoice["invoice_id"]
+            pay_url = invoice["bot_invoice_url"]
+            metrics.inc("cryptobot_invoices_created")
+
+            # Записываем платеж в БД вместе со ссылкой и сроком действия счёта
+            await db.create_payment(
+                tg_id,
+                tariff_code,
+                amount,
+                "cryptobot",
+                invoice_id,
+                pay_url,
+                int(time.time()) + CRYPTOBOT_INVOICE_TTL
+            )
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Оплатить сейчас", url=pay_url)],
@@ -133,55 +161,109 @@ async def process_pay_yookassa(callback: CallbackQuery, state: FSMContext):
 
 
 @router.callback_query(F.data == "check_payment")
-async def process_check_payment(callback: CallbackQuery):
+async def process_check_payment(
+    callback: CallbackQuery,
+    cryptobot: aiohttp.ClientSession,
+    remnawave: aiohttp.ClientSession
+):
     """Проверить статус платежа"""
     tg_id = callback.from_user.id
-    pending = db.get_last_pending_payment(tg_id)
+    pending = await db.get_last_pending_payment(tg_id)
 
     if not pending:
         await callback.answer("Нет ожидающих оплаты счетов", show_alert=True)
         return
 
-    if not db.acquire_user_lock(tg_id):
-        await callback.answer("Подожди пару секунд ⏳", show_alert=True)
-        return
-
-    try:
-        invoice_id, tariff_code = pending
-
-        # Проверяем статус счёта
-        invoice = await get_invoice_status(invoice_id)
-
-        if invoice and invoice.get("status") == "paid":
-            # Обрабатываем оплату
-            success = await process_paid_invoice(callback.bot, tg_id, invoice_id, tariff_code)
-            
-            if success:
-                await callback.message.edit_text(
-                    "✅ <b>Оплата подтверждена!</b>\n\n"
-                    f"Тариф: {tariff_code}\n"
-                    "Ссылка подписки отправлена в сообщении выше."
-                )
+    async with user_lock(tg_id) as acquired:
+        if not acquired:
+            await callback.answer("Подожди пару секунд ⏳", show_alert=True)
+            return
+
+        try:
+            invoice_id, tariff_code = pending
+
+            # Проверяем статус счёта
+            invoice = await get_invoice_status(cryptobot, invoice_id)
+
+            if invoice and invoice.get("status") == "paid":
+                # Обрабатываем оплату
+                success = await process_paid_invoice(callback.bot, remnawave, tg_id, invoice_id, tariff_code)
+
+                if success:
+                    await callback.message.edit_text(
+                        "✅ <b>Оплата подтверждена!</b>\n\n"
+                        f"Тариф: {tariff_code}\n"
+                        "Ссылка подписки отправлена в сообщении выше."
+                    )
+                elif remnawave_unavailable():
+                    metrics.inc("remnawave_degraded_responses")
+                    await callback.answer(
+                        "Оплата получена. Сервер подписок временно недоступен — подписка "
+                        "активируется автоматически, ссылка придёт сообщением.",
+                        show_alert=True
+                    )
+                else:
+                    # Оплата уже записана в outbox — активацию завершит activation_worker
+                    await callback.answer(
+                        "Оплата получена, подписка активируется. Ссылка придёт сообщением.",
+                        show_alert=True
+                    )
             else:
-                await callback.answer("Ошибка при активации подписки", show_alert=True)
-        else:
-            await callback.answer("Оплата ещё не прошла или уже активирована", show_alert=True)
+                await callback.answer("Оплата ещё не прошла или уже активирована", show_alert=True)
+
+        except Exception as e:
+            logging.error(f"Check payment error: {e}")
+            await callback.answer("Ошибка при проверке платежа", show_alert=True)
+
+
+# Пользователи, чья подписка сейчас обновляется из Remnawave в фоне,
+# и ссылки на эти задачи, чтобы их не собрал сборщик мусора
+_refreshing: set[int] = set()
+_refresh_tasks: set[asyncio.Task] = set()
+
 
+async def _fetch_subscription(remnawave: aiohttp.ClientSession, tg_id: int, remnawave_uuid: str) -> dict | None:
+    """Прочитать подписку из Remnawave и сохранить в users"""
+    user_info = await remnawave_get_user_info(remnawave, remnawave_uuid)
+    if user_info:
+        await db.sync_subscription(tg_id, user_info.get("expireAt"), user_info.get("subscriptionUrl"))
+    return user_info
+
+
+async def _refresh_subscription(remnawave: aiohttp.ClientSession, tg_id: int, remnawave_uuid: str):
+    try:
+        if await _fetch_subscription(remnawave, tg_id, remnawave_uuid):
+            metrics.inc("subscription_background_refreshes")
     except Exception as e:
-        logging.error(f"Check payment error: {e}")
-        await callback.answer("Ошибка при проверке платежа", show_alert=True)
-    
+        logging.error(f"Background subscription refresh failed for {tg_id}: {e}")
     finally:
-        db.release_user_lock(tg_id)
+        _refreshing.discard(tg_id)
+
+
+def _schedule_refresh(remnawave: aiohttp.ClientSession, tg_id: int, remnawave_uuid: str):
+    if tg_id in _refreshing:
+        return
+    _refreshing.add(tg_id)
+    task = asyncio.create_task(_refresh_subscription(remnawave, tg_id, remnawave_uuid))
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
 
 
 @router.callback_query(F.data == "my_subscription")
-async def process_my_subscription(callback: CallbackQuery):
-    """Показать информацию о подписке пользователя"""
+async def process_my_subscription(callback: CallbackQuery, remnawave: aiohttp.ClientSession):
+    """
+    Показать информацию о подписке пользователя
+
+    Ссылка и дата окончания берутся из users — их записывает каждая
+    выдача и продление. Если запись старше SUBSCRIPTION_REFRESH_AGE,
+    она обновляется из Remnawave в фоне, экран при этом не ждёт. Пока
+    Remnawave недоступен, показываются сохранённые данные без обновления.
+    """
     tg_id = callback.from_user.id
-    user = db.get_user(tg_id)
+    user = await db.get_user(tg_id)
+    remnawave_uuid = db.user_field(user, "remnawave_uuid")
 
-    if not user or not user[3]:  # remnawave_uuid
+    if not remnawave_uuid:
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="Оформить подписку", callback_data="buy_subscription")],
             [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
@@ -192,47 +274,60 @@ async def process_my_subscription(callback: CallbackQuery):
         )
         return
 
-    # Получаем актуальную информацию о подписке из Remnawave
+    sub_url = db.user_field(user, "subscription_url")
+    expire_at = db.user_timestamp(user, "subscription_until")
+    synced_at = db.user_timestamp(user, "subscription_synced_at")
     remaining_str = "неизвестно"
-    sub_url = "ошибка получения ссылки"
-
-    try:
-        connector = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            # Получаем ссылку подписки
-            sub_url = await remnawave_get_subscription_url(session, user[3])
-
-            # Получаем информацию о пользователе (включая expireAt)
-            user_info = await remnawave_get_user_info(session, user[3])
-
-            if user_info and "expireAt" in user_info:
-                expire_at = user_info["expireAt"]
-                exp_date = datetime.fromisoformat(expire_at.replace('Z', '+00:00'))
-                remaining = exp_date - datetime.now(timezone.utc)
-
-                if remaining.total_seconds() <= 0:
-                    remaining_str = "истекла"
-                else:
-                    days = remaining.days
-                    hours = remaining.seconds // 3600
-                    minutes = (remaining.seconds % 3600) // 60
-                    remaining_str = f"{days}д {hours}ч {minutes}м"
-
-    except Exception as e:
-        logging.error(f"Error fetching subscription info from Remnawave: {e}")
-        remaining_str = "ошибка загрузки"
+    unavailable = remnawave_unavailable()
+
+    if unavailable:
+        metrics.inc("remnawave_degraded_responses")
+    elif not sub_url:
+        # Подписка выдана до появления локальной копии — читаем из Remnawave один раз
+        metrics.inc("my_subscription_live")
+        try:
+            user_info = await _fetch_subscription(remnawave, tg_id, remnawave_uuid)
+            if user_info:
+                sub_url = user_info.get("subscriptionUrl")
+                expire_dt = parse_expire_at(user_info.get("expireAt"))
+                expire_at = int(expire_dt.timestamp()) if expire_dt else None
+        except Exception as e:
+            logging.error(f"Error fetching subscription info from Remnawave: {e}")
+            remaining_str = "ошибка загрузки"
+    else:
+        metrics.inc("my_subscription_local")
+        if synced_at is None or time.time() - synced_at > SUBSCRIPTION_REFRESH_AGE:
+            _schedule_refresh(remnawave, tg_id, remnawave_uuid)
+
+    if expire_at is not None:
+        remaining = datetime.fromtimestamp(expire_at, timezone.utc) - datetime.now(timezone.utc)
+
+        if remaining.total_seconds() <= 0:
+            remaining_str = "истекла"
+        else:
+            days = remaining.days
+            hours = remaining.seconds // 3600
+            minutes = (remaining.seconds % 3600) // 60
+            remaining_str = f"{days}д {hours}ч {minutes}м"
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔄 Продлить подписку", callback_data="buy_subscription")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
     ])
 
+    if unavailable:
+        link = sub_url or "временно недоступна"
+    else:
+        link = sub_url or "ошибка получения ссылки"
+
     text = (
         "🔐 <b>Моя подписка</b>\n\n"
         f"📆 Осталось ещё: {remaining_str}\n"
         f"Сквад: SPN-Squad\n\n"
-        f"<b>Ссылка (кликабельно):</b>\n{sub_url or 'ошибка получения ссылки'}\n\n"
+        f"<b>Ссылка (кликабельно):</b>\n{link}\n\n"
         "Статус: активна"
     )
+    if unavailable:
+        text += "\n\n⚠️ Сервер подписок временно недоступен — показаны последние сохранённые данные"
 
     await callback.message.edit_text(text, reply_markup=kb)
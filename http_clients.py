@@ -0,0 +1,109 @@
+"""
+Долгоживущие HTTP-сессии для CryptoBot и Remnawave.
+
+Сессии создаются один раз при запуске (main.main) и закрываются при
+остановке. В отличие от сессии на каждый запрос, соединения
+переиспользуются (keep-alive), DNS кэшируется, а заголовки авторизации
+собраны заранее и подставляются в каждый запрос автоматически.
+Сертификаты TLS проверяются.
+
+У каждой сессии свой UpstreamPolicy (rate_limit.py): лимит частоты
+запросов к API и повторы GET-запросов при 429/5xx. Перед ним у сессии
+Remnawave стоит remnawave_breaker (circuit_breaker.py): при отказе панели
+запросы сразу получают CircuitOpenError.
+
+Обработчики получают сессии через workflow_data диспетчера по именам
+аргументов cryptobot и remnawave.
+"""
+
+import logging
+
+import aiohttp
+
+from config import (
+    CRYPTOBOT_TOKEN,
+    REMNAWAVE_API_TOKEN,
+    HTTP_LIMIT_PER_HOST,
+    HTTP_KEEPALIVE_TIMEOUT,
+    HTTP_DNS_CACHE_TTL,
+    HTTP_TIMEOUT,
+    CRYPTOBOT_RATE_LIMIT,
+    CRYPTOBOT_RATE_BURST,
+    REMNAWAVE_RATE_LIMIT,
+    REMNAWAVE_RATE_BURST,
+    HTTP_MAX_RETRIES,
+    HTTP_RETRY_BASE,
+    HTTP_RETRY_MAX,
+    REMNAWAVE_BREAKER_WINDOW,
+    REMNAWAVE_BREAKER_MIN_CALLS,
+    REMNAWAVE_BREAKER_FAILURE_RATE,
+    REMNAWAVE_BREAKER_SLOW_CALL,
+    REMNAWAVE_BREAKER_SLOW_RATE,
+    REMNAWAVE_BREAKER_OPEN,
+    REMNAWAVE_BREAKER_PROBES
+)
+from circuit_breaker import CircuitBreaker
+from rate_limit import UpstreamPolicy
+
+logger = logging.getLogger(__name__)
+
+cryptobot: aiohttp.ClientSession | None = None
+remnawave: aiohttp.ClientSession | None = None
+
+# Состояние цепи переживает пересоздание сессии и доступно обработчикам
+remnawave_breaker = CircuitBreaker(
+    "remnawave",
+    REMNAWAVE_BREAKER_WINDOW,
+    REMNAWAVE_BREAKER_MIN_CALLS,
+    REMNAWAVE_BREAKER_FAILURE_RATE,
+    REMNAWAVE_BREAKER_SLOW_CALL,
+    REMNAWAVE_BREAKER_SLOW_RATE,
+    REMNAWAVE_BREAKER_OPEN,
+    REMNAWAVE_BREAKER_PROBES
+)
+
+
+def _create_session(headers: dict, *middlewares) -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers=headers,
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        middlewares=middlewares
+    )
+
+
+async def init_sessions():
+    """Создать сессии CryptoBot и Remnawave"""
+    global cryptobot, remnawave
+    if cryptobot is None:
+        cryptobot = _create_session(
+            {"Crypto-Pay-API-Token": CRYPTOBOT_TOKEN},
+            UpstreamPolicy("cryptobot", CRYPTOBOT_RATE_LIMIT, CRYPTOBOT_RATE_BURST,
+                           HTTP_MAX_RETRIES, HTTP_RETRY_BASE, HTTP_RETRY_MAX)
+        )
+    if remnawave is None:
+        remnawave = _create_session(
+            {"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"},
+            remnawave_breaker,
+            UpstreamPolicy("remnawave", REMNAWAVE_RATE_LIMIT, REMNAWAVE_RATE_BURST,
+                           HTTP_MAX_RETRIES, HTTP_RETRY_BASE, HTTP_RETRY_MAX)
+        )
+    logger.info(
+        f"HTTP sessions created (limit_per_host={HTTP_LIMIT_PER_HOST}, "
+        f"rate cryptobot={CRYPTOBOT_RATE_LIMIT}/s remnawave={REMNAWAVE_RATE_LIMIT}/s)"
+    )
+
+
+async def close_sessions():
+    """Закрыть сессии"""
+    global cryptobot, remnawave
+    for session in (cryptobot, remnawave):
+        if session is not None:
+            await session.close()
+    cryptobot = None
+    remnawave = None
@@ -5,12 +5,30 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
 
-from config import BOT_TOKEN, LOG_LEVEL
-import database as db
+from config import (
+    BOT_TOKEN,
+    LOG_LEVEL,
+    TELEGRAM_WEBHOOK_URL,
+    TELEGRAM_WEBHOOK_HOST,
+    TELEGRAM_WEBHOOK_PORT,
+    CRYPTOBOT_WEBHOOK_HOST,
+    CRYPTOBOT_WEBHOOK_PORT,
+    PAYMENT_CHECK_INTERVAL,
+    PAYMENT_SAFETY_NET_INTERVAL,
+    RECONCILE_INTERVAL,
+    HANDLER_DEADLINE
+)
+import async_database as db
+import http_clients
+from deadline import DeadlineMiddleware
 
 # Импортируем все роутеры обработчиков
 from handlers import start, callbacks, subscription, gift, referral, promo, admin
+from services.activation import activation_worker
 from services.cryptobot import check_cryptobot_invoices
+from services.cryptobot_webhook import start_webhook_server, stop_webhook_server
+from services.reconcile import reconcile_worker
+from services import telegram_webhook
 
 
 # ────────────────────────────────────────────────
@@ -51,6 +69,8 @@ def setup_handlers():
     dp.include_router(referral.router)
     dp.include_router(promo.router)
     dp.include_router(admin.router)
+    # Бюджет времени на апдейт: запросы к API не переживают ожидание Telegram
+    dp.update.outer_middleware(DeadlineMiddleware(HANDLER_DEADLINE))
     logger.info("All handlers registered")
 
 
@@ -61,19 +81,62 @@ def setup_handlers():
 async def main():
     """Главная функция запуска бота"""
     # Инициализируем БД
-    db.init_db()
+    await db.init_db()
     logger.info("Database initialized")
     
+    # Создаём долгоживущие HTTP-сессии и передаём их обработчикам
+    await http_clients.init_sessions()
+    dp["cryptobot"] = http_clients.cryptobot
+    dp["remnawave"] = http_clients.remnawave
+
     # Регистрируем обработчики
     setup_handlers()
     
+    # Вебхук CryptoBot активирует оплату сразу, опрос остаётся страховкой
+    webhook_runner = None
+    check_interval = PAYMENT_CHECK_INTERVAL
+    if CRYPTOBOT_WEBHOOK_PORT:
+        webhook_runner = await start_webhook_server(
+            bot, http_clients.remnawave, CRYPTOBOT_WEBHOOK_HOST, CRYPTOBOT_WEBHOOK_PORT
+        )
+        check_interval = PAYMENT_SAFETY_NET_INTERVAL
+
     # Запускаем фоновую задачу проверки платежей
-    asyncio.create_task(check_cryptobot_invoices(bot))
-    logger.info("Payment checker task started")
+    asyncio.create_task(
+        check_cryptobot_invoices(bot, http_clients.cryptobot, http_clients.remnawave, check_interval)
+    )
+    logger.info(f"Payment checker task started (interval={check_interval}s)")
+
+    # Досрочно прерванные и отложенные активации оплаченных счетов
+    asyncio.create_task(activation_worker(bot, http_clients.remnawave))
+    logger.info("Activation outbox worker started")
+
+    # Сверка users с Remnawave порциями по курсору
+    if RECONCILE_INTERVAL > 0:
+        asyncio.create_task(reconcile_worker(http_clients.remnawave))
+        logger.info(f"Remnawave reconciliation started (interval={RECONCILE_INTERVAL}s)")
     
-    # Выполняем polling
-    logger.info("Bot started polling...")
-    await dp.start_polling(bot)
+    try:
+        if TELEGRAM_WEBHOOK_URL:
+            # Вебхук: обновления обрабатывает пул воркеров с ограниченной очередью
+            telegram_runner, update_pool = await telegram_webhook.start_webhook_server(
+                dp, bot, TELEGRAM_WEBHOOK_HOST, TELEGRAM_WEBHOOK_PORT
+            )
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await telegram_webhook.stop_webhook_server(telegram_runner, update_pool)
+                await bot.session.close()
+        else:
+            # Выполняем polling; вебхук, оставшийся от прежнего запуска, мешает getUpdates
+            await bot.delete_webhook()
+            logger.info("Bot started polling...")
+            await dp.start_polling(bot)
+    finally:
+        if webhook_runner is not None:
+            await stop_webhook_server(webhook_runner)
+        await http_clients.close_sessions()
+        await db.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,90 @@
+"""
+Простые внутрипроцессные метрики бота.
+
+Счётчики, текущие значения (gauges) и сводки задержек хранятся в памяти
+процесса. Сводки рассчитаны на задержки в секундах. Снимок метрик
+выводится администратору командой /stats.
+"""
+
+import threading
+
+
+_lock = threading.Lock()
+_counters: dict[str, int] = {}
+_gauges: dict[str, float] = {}
+_summaries: dict[str, list[float]] = {}  # имя -> [count, total, max]
+
+
+def inc(name: str, value: int = 1):
+    """Увеличить счётчик"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value: float):
+    """Установить текущее значение метрики"""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, value: float):
+    """
+    Добавить наблюдение в сводку (например, задержку в секундах)
+
+    Args:
+        name: Имя метрики
+        value: Наблюдаемое значение
+    """
+    with _lock:
+        summary = _summaries.get(name)
+        if summary is None:
+            _summaries[name] = [1, value, value]
+        else:
+            summary[0] += 1
+            summary[1] += value
+            if value > summary[2]:
+                summary[2] = value
+
+
+def snapshot() -> dict:
+    """
+    Получить снимок всех метрик
+
+    Returns:
+        Словарь {"counters": ..., "gauges": ..., "summaries": ...},
+        где сводка — {"count", "avg", "max"}
+    """
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "summaries": {
+                name: {"count": count, "avg": total / count, "max": max_value}
+                for name, (count, total, max_value) in _summaries.items()
+            }
+        }
+
+
+def reset():
+    """Сбросить все метрики"""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _summaries.clear()
+
+
+def render() -> str:
+    """Отформатировать снимок метрик для сообщения в Telegram"""
+    snap = snapshot()
+    lines = []
+
+    for name, value in sorted(snap["counters"].items()):
+        lines.append(f"{name}: {value}")
+    for name, value in sorted(snap["gauges"].items()):
+        lines.append(f"{name}: {value:g}")
+    for name, s in sorted(snap["summaries"].items()):
+        lines.append(
+            f"{name}: n={s['count']} avg={s['avg'] * 1000:.1f}ms max={s['max'] * 1000:.1f}ms"
+        )
+
+    return "\n".join(lines) if lines else "нет данных"
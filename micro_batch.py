@@ -0,0 +1,104 @@
+"""
+Объединение одиночных вызовов внешнего API в пачки.
+
+Вызывающий отдаёт элемент (например, UUID пользователя для добавления в
+сквад) и ждёт свой результат. Элементы одной группы (сквада) копятся
+window секунд или до max_size штук, затем отправляются одним запросом
+flush(group, items), и каждый вызывающий получает результат своего
+элемента. Одинаковые элементы в одной пачке отправляются один раз.
+
+Метрики (см. metrics.py):
+    <name>_batches        — отправленных пачек
+    <name>_items          — элементов в них (средний размер — items / batches)
+    <name>_shared         — вызовов, чей элемент уже был в пачке
+    <name>_flush_seconds  — длительность отправки пачки
+"""
+
+import asyncio
+import logging
+import time
+
+import deadline
+import metrics
+
+
+class _Batch:
+    def __init__(self):
+        self.items: dict = {}  # item -> asyncio.Future
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class MicroBatcher:
+    """Пачки элементов по группам: не дольше window секунд, не больше max_size"""
+
+    def __init__(self, name: str, flush, window: float, max_size: int):
+        """
+        Args:
+            name: Имя для метрик
+            flush: Корутинная функция (group, items) -> {item: результат};
+                элемент без результата получает None, исключение получают все элементы пачки
+            window: Сколько секунд копить пачку после первого элемента
+            max_size: Размер пачки, при котором она отправляется сразу
+        """
+        self.name = name
+        self.flush = flush
+        self.window = window
+        self.max_size = max(1, max_size)
+        self._pending: dict = {}  # group -> _Batch
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, group, item):
+        """
+        Добавить элемент в пачку группы и дождаться его результата
+
+        Отмена вызывающего или истечение его дедлайна не отменяет отправку
+        пачки для остальных.
+        """
+        batch = self._pending.get(group)
+        if batch is None:
+            batch = self._pending[group] = _Batch()
+            # Пачка общая — её отправка не ограничена дедлайном того, кто её открыл
+            with deadline.unbounded():
+                batch.timer = asyncio.get_running_loop().call_later(self.window, self._send, group, batch)
+
+        future = batch.items.get(item)
+        if future is None:
+            future = batch.items[item] = asyncio.get_running_loop().create_future()
+            if len(batch.items) >= self.max_size:
+                with deadline.unbounded():
+                    self._send(group, batch)
+        else:
+            metrics.inc(f"{self.name}_shared")
+
+        return await asyncio.wait_for(asyncio.shield(future), deadline.remaining())
+
+    def _send(self, group, batch: _Batch):
+        # Пачка уходит один раз: по таймеру или по размеру, что раньше
+        if self._pending.get(group) is not batch:
+            return
+        del self._pending[group]
+        batch.timer.cancel()
+        task = asyncio.create_task(self._run(group, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, group, batch: _Batch):
+        items = list(batch.items)
+        metrics.inc(f"{self.name}_batches")
+        metrics.inc(f"{self.name}_items", len(items))
+        started = time.monotonic()
+        try:
+            results = await self.flush(group, items)
+        except Exception as e:
+            logging.error(f"{self.name}: batch of {len(items)} failed: {e}")
+            for future in batch.items.values():
+                if not future.done():
+                    future.set_exception(e)
+                    # Вызывающий мог уже уйти — исключение не должно остаться «не полученным»
+                    future.add_done_callback(lambda done: done.exception())
+            return
+        finally:
+            metrics.observe(f"{self.name}_flush_seconds", time.monotonic() - started)
+        for item, future in batch.items.items():
+            if not future.done():
+                future.set_result(results.get(item))
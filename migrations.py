@@ -0,0 +1,724 @@
+"""
+Версионные миграции схемы БД для SQLite и PostgreSQL (Supabase).
+
+Каждая миграция — номер версии, описание и списки SQL-команд для обоих
+бэкендов. Применённые версии хранятся в таблице schema_migrations,
+поэтому init_db на существующей базе догоняет схему на месте, а на
+новой — создаёт её с нуля.
+
+Запуск вручную из корня проекта:
+    python migrations.py
+    python migrations.py --print-sql [--from 5]   # SQL для Supabase без DATABASE_URL
+"""
+
+import argparse
+import logging
+import sqlite3
+import textwrap
+import time
+from dataclasses import dataclass, field
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    sqlite: list[str] = field(default_factory=list)
+    postgres: list[str] = field(default_factory=list)
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(
+        version=1,
+        description="baseline tables",
+        sqlite=[
+            '''
+            CREATE TABLE IF NOT EXISTS users (
+                tg_id INTEGER PRIMARY KEY,
+                username TEXT,
+                accepted_terms BOOLEAN DEFAULT FALSE,
+                remnawave_uuid TEXT,
+                remnawave_username TEXT,
+                subscription_until TEXT,
+                squad_uuid TEXT,
+                referrer_id INTEGER,
+                gift_received BOOLEAN DEFAULT FALSE,
+                referral_count INTEGER DEFAULT 0,
+                active_referrals INTEGER DEFAULT 0,
+                first_payment BOOLEAN DEFAULT FALSE,
+                action_lock INTEGER DEFAULT 0
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS payments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tg_id INTEGER,
+                tariff_code TEXT,
+                amount REAL,
+                status TEXT DEFAULT 'pending',
+                created_at TEXT,
+                provider TEXT,
+                invoice_id TEXT,
+                payload TEXT
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS promo_codes (
+                code TEXT PRIMARY KEY,
+                days INTEGER,
+                max_uses INTEGER,
+                used_count INTEGER DEFAULT 0,
+                active BOOLEAN DEFAULT TRUE
+            )
+            '''
+        ],
+        postgres=[
+            '''
+            CREATE TABLE IF NOT EXISTS users (
+                tg_id BIGINT PRIMARY KEY,
+                username TEXT,
+                accepted_terms BOOLEAN DEFAULT FALSE,
+                remnawave_uuid TEXT,
+                remnawave_username TEXT,
+                subscription_until TEXT,
+                squad_uuid TEXT,
+                referrer_id BIGINT,
+                gift_received BOOLEAN DEFAULT FALSE,
+                referral_count INTEGER DEFAULT 0,
+                active_referrals INTEGER DEFAULT 0,
+                first_payment BOOLEAN DEFAULT FALSE,
+                action_lock INTEGER DEFAULT 0
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS payments (
+                id SERIAL PRIMARY KEY,
+                tg_id BIGINT,
+                tariff_code TEXT,
+                amount NUMERIC,
+                status TEXT DEFAULT 'pending',
+                created_at TEXT,
+                provider TEXT,
+                invoice_id TEXT,
+                payload TEXT
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS promo_codes (
+                code TEXT PRIMARY KEY,
+                days INTEGER,
+                max_uses INTEGER,
+                used_count INTEGER DEFAULT 0,
+                active BOOLEAN DEFAULT TRUE
+            )
+            '''
+        ]
+    ),
+    Migration(
+        version=2,
+        description="typed timestamps: epoch seconds in SQLite, TIMESTAMPTZ in Postgres",
+        # SQLite не умеет менять тип колонки — пересобираем таблицы,
+        # сохраняя порядок колонок (обработчики обращаются к ним по индексу)
+        sqlite=[
+            '''
+            CREATE TABLE users_new (
+                tg_id INTEGER PRIMARY KEY,
+                username TEXT,
+                accepted_terms BOOLEAN DEFAULT FALSE,
+                remnawave_uuid TEXT,
+                remnawave_username TEXT,
+                subscription_until INTEGER,
+                squad_uuid TEXT,
+                referrer_id INTEGER,
+                gift_received BOOLEAN DEFAULT FALSE,
+                referral_count INTEGER DEFAULT 0,
+                active_referrals INTEGER DEFAULT 0,
+                first_payment BOOLEAN DEFAULT FALSE,
+                action_lock INTEGER DEFAULT 0
+            )
+            ''',
+            '''
+            INSERT INTO users_new
+            SELECT tg_id, username, accepted_terms, remnawave_uuid, remnawave_username,
+                   CAST(strftime('%s', subscription_until) AS INTEGER),
+                   squad_uuid, referrer_id, gift_received, referral_count,
+                   active_referrals, first_payment, action_lock
+            FROM users
+            ''',
+            "DROP TABLE users",
+            "ALTER TABLE users_new RENAME TO users",
+            '''
+            CREATE TABLE payments_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tg_id INTEGER,
+                tariff_code TEXT,
+                amount REAL,
+                status TEXT DEFAULT 'pending',
+                created_at INTEGER,
+                provider TEXT,
+                invoice_id TEXT,
+                payload TEXT
+            )
+            ''',
+            '''
+            INSERT INTO payments_new
+            SELECT id, tg_id, tariff_code, amount, status,
+                   CAST(strftime('%s', created_at) AS INTEGER),
+                   provider, invoice_id, payload
+            FROM payments
+            ''',
+            "DROP TABLE payments",
+            "ALTER TABLE payments_new RENAME TO payments"
+        ],
+        postgres=[
+            '''
+            ALTER TABLE users
+            ALTER COLUMN subscription_until TYPE TIMESTAMPTZ
+            USING NULLIF(subscription_until::text, '')::timestamptz
+            ''',
+            '''
+            ALTER TABLE payments
+            ALTER COLUMN created_at TYPE TIMESTAMPTZ
+            USING NULLIF(created_at::text, '')::timestamptz
+            ''',
+            "ALTER TABLE payments ALTER COLUMN created_at SET DEFAULT NOW()"
+        ]
+    ),
+    Migration(
+        version=3,
+        description="indexes for pending payments and invoice lookups",
+        sqlite=[
+            # get_pending_payments: status = 'pending' AND provider = ?
+            "CREATE INDEX IF NOT EXISTS idx_payments_status_provider ON payments(status, provider)",
+            # get_last_pending_payment: tg_id = ? AND status AND provider ORDER BY id DESC
+            "CREATE INDEX IF NOT EXISTS idx_payments_tg_status ON payments(tg_id, status, provider, id)",
+            # update_payment_status_by_invoice: invoice_id = ?
+            "CREATE INDEX IF NOT EXISTS idx_payments_invoice_id ON payments(invoice_id)",
+            "CREATE INDEX IF NOT EXISTS idx_users_referrer_id ON users(referrer_id)"
+        ],
+        postgres=[
+            "CREATE INDEX IF NOT EXISTS idx_payments_status_provider ON payments(status, provider)",
+            "CREATE INDEX IF NOT EXISTS idx_payments_tg_status ON payments(tg_id, status, provider, id)",
+            "CREATE INDEX IF NOT EXISTS idx_payments_invoice_id ON payments(invoice_id)",
+            "CREATE INDEX IF NOT EXISTS idx_users_referrer_id ON users(referrer_id)"
+        ]
+    ),
+    Migration(
+        version=4,
+        description="bootstrap_user RPC for /start",
+        # В SQLite то же самое делает транзакция в database.bootstrap_user
+        postgres=[
+            '''
+            CREATE OR REPLACE FUNCTION bootstrap_user(
+                p_tg_id BIGINT,
+                p_username TEXT,
+                p_referrer_id BIGINT DEFAULT NULL
+            ) RETURNS JSONB
+            LANGUAGE plpgsql AS $$
+            DECLARE
+                v_user users;
+                v_created BOOLEAN := FALSE;
+            BEGIN
+                INSERT INTO users (tg_id, username, referrer_id)
+                VALUES (p_tg_id, p_username, p_referrer_id)
+                ON CONFLICT (tg_id) DO NOTHING
+                RETURNING * INTO v_user;
+
+                IF FOUND THEN
+                    v_created := TRUE;
+                    IF p_referrer_id IS NOT NULL THEN
+                        UPDATE users SET referral_count = referral_count + 1
+                        WHERE tg_id = p_referrer_id;
+                    END IF;
+                ELSE
+                    SELECT * INTO v_user FROM users WHERE tg_id = p_tg_id;
+                END IF;
+
+                RETURN jsonb_build_object('user', to_jsonb(v_user), 'created', v_created);
+            END;
+            $$
+            '''
+        ]
+    ),
+    Migration(
+        version=5,
+        description="atomic counter and promo redemption RPCs",
+        # В SQLite счётчики и так обновляются одним UPDATE
+        postgres=[
+            '''
+            CREATE OR REPLACE FUNCTION increment_referral_count(p_tg_id BIGINT)
+            RETURNS INTEGER LANGUAGE sql AS $$
+                UPDATE users SET referral_count = COALESCE(referral_count, 0) + 1
+                WHERE tg_id = p_tg_id
+                RETURNING referral_count
+            $$
+            ''',
+            '''
+            CREATE OR REPLACE FUNCTION increment_active_referrals(p_tg_id BIGINT)
+            RETURNS INTEGER LANGUAGE sql AS $$
+                UPDATE users SET active_referrals = COALESCE(active_referrals, 0) + 1
+                WHERE tg_id = p_tg_id
+                RETURNING active_referrals
+            $$
+            ''',
+            '''
+            CREATE OR REPLACE FUNCTION increment_promo_usage(p_code TEXT)
+            RETURNS INTEGER LANGUAGE sql AS $$
+                UPDATE promo_codes SET used_count = COALESCE(used_count, 0) + 1
+                WHERE code = upper(p_code)
+                RETURNING used_count
+            $$
+            ''',
+            # Списание использования только если лимит не исчерпан
+            '''
+            CREATE OR REPLACE FUNCTION redeem_promo_code(p_code TEXT)
+            RETURNS JSONB LANGUAGE sql AS $$
+                UPDATE promo_codes SET used_count = used_count + 1
+                WHERE code = upper(p_code) AND active AND used_count < max_uses
+                RETURNING jsonb_build_object(
+                    'days', days, 'used_count', used_count, 'max_uses', max_uses
+                )
+            $$
+            ''',
+            '''
+            CREATE OR REPLACE FUNCTION release_promo_code(p_code TEXT)
+            RETURNS INTEGER LANGUAGE sql AS $$
+                UPDATE promo_codes SET used_count = used_count - 1
+                WHERE code = upper(p_code) AND used_count > 0
+                RETURNING used_count
+            $$
+            '''
+        ]
+    ),
+    Migration(
+        version=6,
+        description="user lock leases with owner and expiry instead of action_lock",
+        sqlite=[
+            "ALTER TABLE users ADD COLUMN lock_owner TEXT",
+            "ALTER TABLE users ADD COLUMN lock_expires_at INTEGER",
+            # Флаги, оставшиеся от упавших процессов, больше не нужны
+            "UPDATE users SET action_lock = 0"
+        ],
+        postgres=[
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS lock_owner TEXT",
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS lock_expires_at TIMESTAMPTZ",
+            "UPDATE users SET action_lock = 0 WHERE action_lock <> 0",
+            '''
+            CREATE OR REPLACE FUNCTION acquire_user_lease(
+                p_tg_id BIGINT,
+                p_owner TEXT,
+                p_ttl_seconds INTEGER
+            ) RETURNS BOOLEAN LANGUAGE sql AS $$
+                WITH leased AS (
+                    UPDATE users
+                    SET lock_owner = p_owner,
+                        lock_expires_at = NOW() + make_interval(secs => p_ttl_seconds)
+                    WHERE tg_id = p_tg_id
+                      AND (lock_owner IS NULL OR lock_expires_at < NOW())
+                    RETURNING 1
+                )
+                SELECT EXISTS (SELECT 1 FROM leased)
+            $$
+            ''',
+            '''
+            CREATE OR REPLACE FUNCTION release_user_lease(p_tg_id BIGINT, p_owner TEXT)
+            RETURNS VOID LANGUAGE sql AS $$
+                UPDATE users SET lock_owner = NULL, lock_expires_at = NULL
+                WHERE tg_id = p_tg_id AND lock_owner = p_owner
+            $$
+            '''
+        ]
+    ),
+    Migration(
+        version=7,
+        description="pay URL and expiry on payments for invoice reuse",
+        # get_open_invoice использует idx_payments_tg_status (tg_id, status, provider, id)
+        sqlite=[
+            "ALTER TABLE payments ADD COLUMN pay_url TEXT",
+            "ALTER TABLE payments ADD COLUMN expires_at INTEGER"
+        ],
+        postgres=[
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS pay_url TEXT",
+            "ALTER TABLE payments ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ"
+        ]
+    ),
+    Migration(
+        version=8,
+        description="activation outbox for paid invoices",
+        # state: pending → running → done | failed; step — последний выполненный шаг.
+        # target_expire_at / referrer_expire_at — вычисленные один раз абсолютные
+        # даты окончания подписки (ISO), чтобы повтор шага не продлевал дважды
+        sqlite=[
+            '''
+            CREATE TABLE activation_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                invoice_id TEXT NOT NULL UNIQUE,
+                tg_id INTEGER NOT NULL,
+                tariff_code TEXT,
+                days INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                step TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at INTEGER NOT NULL DEFAULT 0,
+                locked_by TEXT,
+                locked_until INTEGER,
+                remnawave_uuid TEXT,
+                remnawave_username TEXT,
+                sub_url TEXT,
+                target_expire_at TEXT,
+                referrer_expire_at TEXT,
+                last_error TEXT,
+                created_at INTEGER,
+                updated_at INTEGER
+            )
+            ''',
+            "CREATE INDEX idx_activation_jobs_state ON activation_jobs(state, next_attempt_at)",
+            "CREATE INDEX idx_activation_jobs_tg_id ON activation_jobs(tg_id, state)"
+        ],
+        postgres=[
+            '''
+            CREATE TABLE IF NOT EXISTS activation_jobs (
+                id BIGSERIAL PRIMARY KEY,
+                invoice_id TEXT NOT NULL UNIQUE,
+                tg_id BIGINT NOT NULL,
+                tariff_code TEXT,
+                days INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                step TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                locked_by TEXT,
+                locked_until TIMESTAMPTZ,
+                remnawave_uuid TEXT,
+                remnawave_username TEXT,
+                sub_url TEXT,
+                target_expire_at TEXT,
+                referrer_expire_at TEXT,
+                last_error TEXT,
+                created_at TIMESTAMPTZ DEFAULT NOW(),
+                updated_at TIMESTAMPTZ DEFAULT NOW()
+            )
+            ''',
+            "CREATE INDEX IF NOT EXISTS idx_activation_jobs_state ON activation_jobs(state, next_attempt_at)",
+            "CREATE INDEX IF NOT EXISTS idx_activation_jobs_tg_id ON activation_jobs(tg_id, state)",
+            # Захват готовых задач. Задача пользователя не берётся, пока не
+            # завершена его более ранняя задача: продления идут по порядку
+            '''
+            CREATE OR REPLACE FUNCTION claim_activation_jobs(
+                p_owner TEXT,
+                p_limit INTEGER,
+                p_lease_seconds INTEGER,
+                p_invoice_id TEXT DEFAULT NULL
+            ) RETURNS SETOF activation_jobs LANGUAGE sql AS $$
+                UPDATE activation_jobs j
+                SET state = 'running',
+                    locked_by = p_owner,
+                    locked_until = NOW() + make_interval(secs => p_lease_seconds),
+                    updated_at = NOW()
+                WHERE j.id IN (
+                    SELECT c.id FROM activation_jobs c
+                    WHERE ((c.state = 'pending' AND c.next_attempt_at <= NOW())
+                           OR (c.state = 'running' AND c.locked_until < NOW()))
+                      AND (p_invoice_id IS NULL OR c.invoice_id = p_invoice_id)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM activation_jobs o
+                          WHERE o.tg_id = c.tg_id AND o.id < c.id
+                            AND o.state IN ('pending', 'running')
+                      )
+                    ORDER BY c.id
+                    LIMIT p_limit
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING j.*
+            $$
+            ''',
+            '''
+            CREATE OR REPLACE FUNCTION activation_backlog()
+            RETURNS JSONB LANGUAGE sql AS $$
+                SELECT jsonb_build_object(
+                    'counts', COALESCE(
+                        (SELECT jsonb_object_agg(state, n)
+                         FROM (SELECT state, COUNT(*) AS n FROM activation_jobs GROUP BY state) s),
+                        '{}'::jsonb
+                    ),
+                    'oldest_pending_at', (
+                        SELECT EXTRACT(EPOCH FROM MIN(created_at))::BIGINT
+                        FROM activation_jobs WHERE state IN ('pending', 'running')
+                    ),
+                    'failed', COALESCE(
+                        (SELECT jsonb_agg(jsonb_build_array(invoice_id, tg_id, attempts, last_error))
+                         FROM (SELECT * FROM activation_jobs WHERE state = 'failed'
+                               ORDER BY id DESC LIMIT 5) f),
+                        '[]'::jsonb
+                    )
+                )
+            $$
+            '''
+        ]
+    ),
+    Migration(
+        version=9,
+        description="local mirror of subscription URL and Remnawave sync time",
+        # subscription_until — expireAt, который вернул Remnawave; subscription_synced_at —
+        # когда subscription_until и subscription_url последний раз сверены с Remnawave
+        sqlite=[
+            "ALTER TABLE users ADD COLUMN subscription_url TEXT",
+            "ALTER TABLE users ADD COLUMN subscription_synced_at INTEGER"
+        ],
+        postgres=[
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS subscription_url TEXT",
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS subscription_synced_at TIMESTAMPTZ"
+        ]
+    ),
+    Migration(
+        version=10,
+        description="reconciliation cursor and batched subscription sync",
+        # sync_cursors — позиция фоновых обходов (сверка с Remnawave: смещение в списке пользователей)
+        sqlite=[
+            '''
+            CREATE TABLE sync_cursors (
+                name TEXT PRIMARY KEY,
+                position INTEGER NOT NULL DEFAULT 0,
+                updated_at INTEGER
+            )
+            '''
+        ],
+        postgres=[
+            '''
+            CREATE TABLE IF NOT EXISTS sync_cursors (
+                name TEXT PRIMARY KEY,
+                position BIGINT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMPTZ DEFAULT NOW()
+            )
+            ''',
+            # Пачка исправлений сверки одним запросом. Строки, записанные после
+            # p_synced_before (продление во время сверки), не перезаписываются
+            '''
+            CREATE OR REPLACE FUNCTION sync_subscriptions(p_rows JSONB, p_synced_before TIMESTAMPTZ)
+            RETURNS SETOF BIGINT LANGUAGE sql AS $$
+                UPDATE users u
+                SET remnawave_uuid = r.remnawave_uuid,
+                    remnawave_username = r.remnawave_username,
+                    subscription_until = r.subscription_until,
+                    subscription_url = COALESCE(r.subscription_url, u.subscription_url),
+                    subscription_synced_at = NOW()
+                FROM jsonb_to_recordset(p_rows) AS r(
+                    tg_id BIGINT,
+                    remnawave_uuid TEXT,
+                    remnawave_username TEXT,
+                    subscription_until TIMESTAMPTZ,
+                    subscription_url TEXT
+                )
+                WHERE u.tg_id = r.tg_id
+                  AND (u.subscription_synced_at IS NULL OR u.subscription_synced_at < p_synced_before)
+                RETURNING u.tg_id
+            $$
+            '''
+        ]
+    ),
+    Migration(
+        version=11,
+        description="count referral and activation step in one transaction",
+        # Счётчик активных рефералов увеличивается вместе с отметкой шага
+        # referral_count: повтор задачи после сбоя не засчитывает реферала дважды
+        sqlite=[],
+        postgres=[
+            '''
+            CREATE OR REPLACE FUNCTION count_activation_referral(
+                p_invoice_id TEXT,
+                p_owner TEXT,
+                p_referrer_id BIGINT,
+                p_lease_seconds INTEGER
+            ) RETURNS BOOLEAN
+            LANGUAGE plpgsql AS $$
+            DECLARE
+                v_step TEXT;
+            BEGIN
+                SELECT step INTO v_step FROM activation_jobs
+                WHERE invoice_id = p_invoice_id AND locked_by = p_owner
+                FOR UPDATE;
+                IF NOT FOUND THEN
+                    RETURN FALSE;
+                END IF;
+
+                IF v_step = 'referral' AND p_referrer_id IS NOT NULL THEN
+                    UPDATE users SET active_referrals = COALESCE(active_referrals, 0) + 1
+                    WHERE tg_id = p_referrer_id;
+                END IF;
+
+                UPDATE activation_jobs
+                SET step = 'referral_count',
+                    locked_until = NOW() + make_interval(secs => p_lease_seconds),
+                    updated_at = NOW()
+                WHERE invoice_id = p_invoice_id;
+                RETURN TRUE;
+            END
+            $$
+            '''
+        ]
+    )
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+# Ключ pg_advisory_xact_lock, общий для всех процессов бота
+_PG_LOCK_KEY = 0x53504E01
+
+
+def _pending(applied: set[int], target: int | None) -> list[Migration]:
+    target = LATEST_VERSION if target is None else target
+    return [m for m in MIGRATIONS if m.version not in applied and m.version <= target]
+
+
+def migrate_sqlite(conn: sqlite3.Connection, target: int | None = None) -> int:
+    """
+    Применить недостающие миграции к базе SQLite
+
+    Каждая миграция выполняется в отдельной транзакции вместе с записью
+    в schema_migrations.
+
+    Args:
+        conn: Соединение sqlite3
+        target: Версия, до которой мигрировать (по умолчанию последняя)
+
+    Returns:
+        Количество применённых миграций
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            applied_at INTEGER
+        )
+    """)
+    conn.commit()
+
+    applied = {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+    pending = _pending(applied, target)
+
+    for migration in pending:
+        try:
+            conn.execute("BEGIN")
+            for statement in migration.sqlite:
+                conn.execute(statement)
+            conn.execute(
+                "INSERT INTO schema_migrations (version, applied_at) VALUES (?, ?)",
+                (migration.version, int(time.time()))
+            )
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            logging.error(f"SQLite migration {migration.version} failed")
+            raise
+        logging.info(f"Applied SQLite migration {migration.version}: {migration.description}")
+
+    return len(pending)
+
+
+def migrate_postgres(dsn: str, target: int | None = None) -> int:
+    """
+    Применить недостающие миграции к PostgreSQL по прямому подключению
+
+    PostgREST (supabase-py) не выполняет DDL, поэтому используется
+    DATABASE_URL. Advisory-lock не даёт двум процессам бота мигрировать
+    одновременно.
+
+    Args:
+        dsn: Строка подключения PostgreSQL
+        target: Версия, до которой мигрировать (по умолчанию последняя)
+
+    Returns:
+        Количество применённых миграций
+    """
+    import psycopg2
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        applied_at TIMESTAMPTZ DEFAULT NOW()
+                    )
+                """)
+
+        applied_count = 0
+        for migration in MIGRATIONS:
+            if target is not None and migration.version > target:
+                break
+
+            with conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (_PG_LOCK_KEY,))
+                    cursor.execute(
+                        "SELECT 1 FROM schema_migrations WHERE version = %s",
+                        (migration.version,)
+                    )
+                    if cursor.fetchone():
+                        continue
+
+                    for statement in migration.postgres:
+                        cursor.execute(statement)
+                    cursor.execute(
+                        "INSERT INTO schema_migrations (version) VALUES (%s)",
+                        (migration.version,)
+                    )
+
+            applied_count += 1
+            logging.info(f"Applied Postgres migration {migration.version}: {migration.description}")
+
+        return applied_count
+    finally:
+        conn.close()
+
+
+def postgres_sql(after: int = 0) -> str:
+    """
+    SQL-скрипт миграций PostgreSQL для ручного применения (SQL Editor Supabase)
+
+    Каждая миграция — отдельная транзакция вместе с записью в
+    schema_migrations, так что после скрипта бот видит актуальную версию
+    схемы, а migrate_postgres не применяет эти миграции повторно.
+
+    Args:
+        after: Пропустить миграции с версией не больше after (уже применённые)
+
+    Returns:
+        Текст скрипта
+    """
+    parts = [
+        "CREATE TABLE IF NOT EXISTS schema_migrations (\n"
+        "    version INTEGER PRIMARY KEY,\n"
+        "    applied_at TIMESTAMPTZ DEFAULT NOW()\n"
+        ");"
+    ]
+    for migration in MIGRATIONS:
+        if migration.version <= after:
+            continue
+        statements = [textwrap.dedent(statement).strip() + ";" for statement in migration.postgres]
+        parts.append("\n\n".join([
+            f"-- Migration {migration.version}: {migration.description}\nBEGIN;",
+            *statements,
+            f"INSERT INTO schema_migrations (version) VALUES ({migration.version}) ON CONFLICT DO NOTHING;\nCOMMIT;"
+        ]))
+    return "\n\n".join(parts) + "\n"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--print-sql", action="store_true", help="напечатать SQL миграций PostgreSQL вместо применения")
+    parser.add_argument("--from", dest="after", type=int, default=0, help="с --print-sql: пропустить версии до этой включительно")
+    args = parser.parse_args()
+
+    if args.print_sql:
+        print(postgres_sql(args.after), end="")
+    else:
+        from config import DATABASE_URL
+        import database as db
+
+        logging.basicConfig(level=logging.INFO)
+        if DATABASE_URL:
+            migrate_postgres(DATABASE_URL)
+        else:
+            db.init_db()
+        print(f"Schema is at version {LATEST_VERSION}")
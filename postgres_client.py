@@ -0,0 +1,431 @@
+"""
+Модуль для прямой асинхронной работы с PostgreSQL через asyncpg.
+
+Включается переменной DB_BACKEND=postgres и использует DATABASE_URL.
+В отличие от supabase_client (один HTTPS-запрос PostgREST на каждую
+операцию) держит пул соединений, а asyncpg кэширует серверные
+подготовленные запросы на каждом соединении.
+
+Строки возвращаются как asyncpg.Record: они поддерживают и доступ по
+индексу (как кортежи SQLite), и по имени колонки (как словари Supabase).
+
+⚠️ Подготовленные запросы не работают через пулер Supabase в режиме
+transaction (порт 6543) — используйте прямое подключение или режим
+session (порт 5432).
+"""
+
+import json
+import logging
+from datetime import datetime, timezone
+
+from config import (
+    DATABASE_URL,
+    DB_BACKEND,
+    PG_POOL_MIN_SIZE,
+    PG_POOL_MAX_SIZE,
+    PG_STATEMENT_CACHE_SIZE
+)
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+logger = logging.getLogger(__name__)
+
+pool = None
+
+
+def is_postgres_enabled() -> bool:
+    """Проверить выбран ли нативный бэкенд PostgreSQL"""
+    return DB_BACKEND == "postgres" and bool(DATABASE_URL) and asyncpg is not None
+
+
+async def _init_connection(conn):
+    await conn.set_type_codec("jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+
+async def init_pool():
+    """Создать пул соединений"""
+    global pool
+    if pool is not None:
+        return
+
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=PG_POOL_MIN_SIZE,
+        max_size=PG_POOL_MAX_SIZE,
+        statement_cache_size=PG_STATEMENT_CACHE_SIZE,
+        init=_init_connection
+    )
+    logger.info(f"Postgres pool created (min={PG_POOL_MIN_SIZE}, max={PG_POOL_MAX_SIZE})")
+
+
+async def close_pool():
+    """Закрыть пул соединений"""
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+
+def _to_datetime(value) -> datetime | None:
+    """Перевести ISO-строку в datetime для колонок TIMESTAMPTZ"""
+    if value is None or isinstance(value, datetime):
+        return value
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+async def acquire_user_lease(tg_id: int, owner: str, ttl: int) -> bool:
+    """Атомарно взять аренду блокировки пользователя одним UPDATE … RETURNING"""
+    leased = await pool.fetchval(
+        """
+        UPDATE users
+        SET lock_owner = $2, lock_expires_at = NOW() + make_interval(secs => $3)
+        WHERE tg_id = $1 AND (lock_owner IS NULL OR lock_expires_at < NOW())
+        RETURNING tg_id
+        """,
+        tg_id, owner, float(ttl)
+    )
+    return leased is not None
+
+
+async def release_user_lease(tg_id: int, owner: str):
+    """Освободить аренду блокировки, если она принадлежит owner"""
+    await pool.execute(
+        "UPDATE users SET lock_owner = NULL, lock_expires_at = NULL WHERE tg_id = $1 AND lock_owner = $2",
+        tg_id, owner
+    )
+
+
+async def get_user(tg_id: int):
+    """Получить информацию о пользователе"""
+    return await pool.fetchrow("SELECT * FROM users WHERE tg_id = $1", tg_id)
+
+
+async def user_exists(tg_id: int) -> bool:
+    """Проверить существует ли пользователь"""
+    return await pool.fetchval("SELECT 1 FROM users WHERE tg_id = $1", tg_id) is not None
+
+
+async def create_user(tg_id: int, username: str, referrer_id=None):
+    """Создать или игнорировать пользователя"""
+    await pool.execute(
+        "INSERT INTO users (tg_id, username, referrer_id) VALUES ($1, $2, $3) ON CONFLICT (tg_id) DO NOTHING",
+        tg_id, username, referrer_id
+    )
+
+
+async def bootstrap_user(tg_id: int, username: str, referrer_id=None) -> tuple:
+    """
+    Создать пользователя при необходимости и вернуть его запись
+
+    Один запрос к SQL-функции bootstrap_user (миграция v4).
+
+    Returns:
+        Кортеж (запись пользователя в виде словаря, создан ли пользователь сейчас)
+    """
+    data = await pool.fetchval("SELECT bootstrap_user($1, $2, $3)", tg_id, username, referrer_id)
+    return data.get("user"), bool(data.get("created"))
+
+
+async def accept_terms(tg_id: int):
+    """Пользователь принял условия использования"""
+    await pool.execute("UPDATE users SET accepted_terms = TRUE WHERE tg_id = $1", tg_id)
+
+
+async def update_subscription(tg_id: int, uuid: str, username: str, subscription_until: str, squad_uuid: str,
+                              subscription_url: str | None = None):
+    """Обновить подписку пользователя (дата окончания из Remnawave — запись сверена сейчас)"""
+    await pool.execute(
+        """
+        UPDATE users
+        SET remnawave_uuid = $1, remnawave_username = $2, subscription_until = $3, squad_uuid = $4,
+            subscription_url = COALESCE($6, subscription_url), subscription_synced_at = NOW()
+        WHERE tg_id = $5
+        """,
+        uuid, username, _to_datetime(subscription_until), squad_uuid, tg_id, subscription_url
+    )
+
+
+async def sync_subscription(tg_id: int, subscription_until: str | None, subscription_url: str | None):
+    """Сохранить состояние подписки, прочитанное из Remnawave"""
+    await pool.execute(
+        """
+        UPDATE users
+        SET subscription_until = $2, subscription_url = COALESCE($3, subscription_url), subscription_synced_at = NOW()
+        WHERE tg_id = $1
+        """,
+        tg_id, _to_datetime(subscription_until), subscription_url
+    )
+
+
+async def get_subscription_states(tg_ids: list) -> dict:
+    """Состояние подписки пользователей: {tg_id: (remnawave_uuid, subscription_until в epoch, subscription_url)}"""
+    rows = await pool.fetch(
+        """
+        SELECT tg_id, remnawave_uuid, FLOOR(EXTRACT(EPOCH FROM subscription_until))::BIGINT AS until, subscription_url
+        FROM users WHERE tg_id = ANY($1::bigint[])
+        """,
+        list(tg_ids)
+    )
+    return {row["tg_id"]: (row["remnawave_uuid"], row["until"], row["subscription_url"]) for row in rows}
+
+
+async def sync_subscriptions(rows: list, synced_before: int) -> list:
+    """Записать исправления сверки пачкой (функция sync_subscriptions), вернуть tg_id обновлённых"""
+    payload = [
+        {
+            "tg_id": tg_id,
+            "remnawave_uuid": uuid,
+            "remnawave_username": username,
+            "subscription_until": until,
+            "subscription_url": url
+        }
+        for tg_id, uuid, username, until, url in rows
+    ]
+    records = await pool.fetch(
+        "SELECT sync_subscriptions($1::jsonb, to_timestamp($2)) AS tg_id",
+        payload, synced_before
+    )
+    return [record["tg_id"] for record in records]
+
+
+async def get_sync_cursor(name: str) -> int:
+    """Позиция фонового обхода name"""
+    return await pool.fetchval("SELECT position FROM sync_cursors WHERE name = $1", name) or 0
+
+
+async def set_sync_cursor(name: str, position: int):
+    """Сохранить позицию фонового обхода name"""
+    await pool.execute(
+        """
+        INSERT INTO sync_cursors (name, position, updated_at) VALUES ($1, $2, NOW())
+        ON CONFLICT (name) DO UPDATE SET position = EXCLUDED.position, updated_at = NOW()
+        """,
+        name, position
+    )
+
+
+async def create_payment(tg_id: int, tariff_code: str, amount: float, provider: str, invoice_id: str,
+                         pay_url: str | None = None, expires_at: int | None = None):
+    """Создать запись о платеже (expires_at — epoch-секунды)"""
+    await pool.execute(
+        """
+        INSERT INTO payments (tg_id, tariff_code, amount, created_at, provider, invoice_id, pay_url, expires_at)
+        VALUES ($1, $2, $3, NOW(), $4, $5, $6, to_timestamp($7))
+        """,
+        tg_id, tariff_code, amount, provider, str(invoice_id), pay_url, expires_at
+    )
+
+
+async def get_open_invoice(tg_id: int, tariff_code: str, amount: float, valid_until: int):
+    """Найти неоплаченный счёт пользователя на тот же тариф и сумму: (invoice_id, pay_url)"""
+    return await pool.fetchrow(
+        """
+        SELECT invoice_id, pay_url FROM payments
+        WHERE tg_id = $1 AND status = 'pending' AND provider = 'cryptobot'
+          AND tariff_code = $2 AND amount = $3 AND pay_url IS NOT NULL AND expires_at > to_timestamp($4)
+        ORDER BY id DESC LIMIT 1
+        """,
+        tg_id, tariff_code, amount, valid_until
+    )
+
+
+async def get_pending_payments():
+    """Получить все ожидающие платежи"""
+    return await pool.fetch(
+        "SELECT id, tg_id, invoice_id, tariff_code FROM payments WHERE status = 'pending' AND provider = 'cryptobot'"
+    )
+
+
+async def get_pending_payments_after(after_id: int = 0, limit: int = 1000):
+    """Получить ожидающие платежи с id больше after_id, created_at в epoch-секундах"""
+    return await pool.fetch(
+        """
+        SELECT id, tg_id, invoice_id, tariff_code, EXTRACT(EPOCH FROM created_at)::BIGINT AS created_at
+        FROM payments
+        WHERE status = 'pending' AND provider = 'cryptobot' AND id > $1
+        ORDER BY id LIMIT $2
+        """,
+        after_id, limit
+    )
+
+
+async def get_last_pending_payment(tg_id: int):
+    """Получить последний ожидающий платеж пользователя"""
+    return await pool.fetchrow(
+        "SELECT invoice_id, tariff_code FROM payments WHERE tg_id = $1 AND status = 'pending' AND provider = 'cryptobot' ORDER BY id DESC LIMIT 1",
+        tg_id
+    )
+
+
+async def get_payment_by_invoice(invoice_id: str):
+    """Получить платёж по invoice_id: (id, tg_id, tariff_code, status)"""
+    return await pool.fetchrow(
+        "SELECT id, tg_id, tariff_code, status FROM payments WHERE invoice_id = $1",
+        str(invoice_id)
+    )
+
+
+async def update_payment_status(payment_id: int, status: str):
+    """Обновить статус платежа"""
+    await pool.execute("UPDATE payments SET status = $1 WHERE id = $2", status, payment_id)
+
+
+async def update_payment_status_by_invoice(invoice_id: str, status: str):
+    """Обновить статус платежа по invoice_id"""
+    await pool.execute("UPDATE payments SET status = $1 WHERE invoice_id = $2", status, str(invoice_id))
+
+
+async def expire_payments(payment_ids: list) -> int:
+    """Пометить платежи как expired, если они всё ещё ожидают оплаты"""
+    if not payment_ids:
+        return 0
+    result = await pool.execute(
+        "UPDATE payments SET status = 'expired' WHERE status = 'pending' AND id = ANY($1::int[])",
+        list(payment_ids)
+    )
+    return int(result.split()[-1])
+
+
+async def enqueue_activation(invoice_id: str, tg_id: int, tariff_code: str, days: int) -> bool:
+    """Поставить активацию в outbox; invoice_id — ключ идемпотентности"""
+    created = await pool.fetchval(
+        """
+        INSERT INTO activation_jobs (invoice_id, tg_id, tariff_code, days)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (invoice_id) DO NOTHING
+        RETURNING id
+        """,
+        str(invoice_id), tg_id, tariff_code, days
+    )
+    return created is not None
+
+
+async def claim_activation_jobs(owner: str, limit: int, lease_seconds: int, invoice_id: str | None = None) -> list:
+    """Захватить готовые задачи outbox (функция claim_activation_jobs, SKIP LOCKED)"""
+    rows = await pool.fetch(
+        "SELECT * FROM claim_activation_jobs($1, $2, $3, $4)",
+        owner, limit, lease_seconds, str(invoice_id) if invoice_id is not None else None
+    )
+    return [dict(row) for row in rows]
+
+
+async def save_activation_progress(invoice_id: str, owner: str, step: str | None, lease_seconds: int, fields: dict) -> bool:
+    """Сохранить выполненный шаг (None — не менять), продлить аренду; fields уже отфильтрованы по ACTIVATION_PROGRESS_FIELDS"""
+    assignments = "".join(f", {column} = ${i}" for i, column in enumerate(fields, start=5))
+    result = await pool.execute(
+        f"UPDATE activation_jobs SET step = COALESCE($3, step), locked_until = NOW() + make_interval(secs => $4), "
+        f"updated_at = NOW(){assignments} WHERE invoice_id = $1 AND locked_by = $2",
+        str(invoice_id), owner, step, float(lease_seconds), *fields.values()
+    )
+    return result.split()[-1] == "1"
+
+
+async def count_activation_referral(invoice_id: str, owner: str, referrer_id: int | None, lease_seconds: int) -> bool:
+    """Засчитать реферала и отметить шаг referral_count (функция count_activation_referral)"""
+    return await pool.fetchval(
+        "SELECT count_activation_referral($1, $2, $3, $4)",
+        str(invoice_id), owner, referrer_id, int(lease_seconds)
+    )
+
+
+async def finish_activation_job(invoice_id: str, owner: str, state: str, attempts: int,
+                                next_attempt_at: int = 0, last_error: str | None = None):
+    """Завершить попытку и снять аренду (next_attempt_at — epoch-секунды)"""
+    await pool.execute(
+        """
+        UPDATE activation_jobs
+        SET state = $3, attempts = $4, next_attempt_at = to_timestamp($5), last_error = $6,
+            locked_by = NULL, locked_until = NULL, updated_at = NOW()
+        WHERE invoice_id = $1 AND locked_by = $2
+        """,
+        str(invoice_id), owner, state, attempts, next_attempt_at, last_error
+    )
+
+
+async def get_activation_backlog() -> dict:
+    """Состояние outbox (функция activation_backlog)"""
+    return await pool.fetchval("SELECT activation_backlog()")
+
+
+async def update_referral_count(tg_id: int) -> int | None:
+    """Атомарно увеличить счётчик рефералов, вернуть новое значение"""
+    return await pool.fetchval(
+        "UPDATE users SET referral_count = referral_count + 1 WHERE tg_id = $1 RETURNING referral_count",
+        tg_id
+    )
+
+
+async def increment_active_referrals(tg_id: int) -> int | None:
+    """Атомарно увеличить счётчик активных рефералов, вернуть новое значение"""
+    return await pool.fetchval(
+        "UPDATE users SET active_referrals = active_referrals + 1 WHERE tg_id = $1 RETURNING active_referrals",
+        tg_id
+    )
+
+
+async def mark_first_payment(tg_id: int):
+    """Отметить что пользователь сделал первый платёж"""
+    await pool.execute("UPDATE users SET first_payment = TRUE WHERE tg_id = $1", tg_id)
+
+
+async def mark_gift_received(tg_id: int):
+    """Отметить что пользователь получил подарок"""
+    await pool.execute("UPDATE users SET gift_received = TRUE WHERE tg_id = $1", tg_id)
+
+
+async def get_promo_code(code: str):
+    """Получить информацию о промокоде"""
+    return await pool.fetchrow(
+        "SELECT days, max_uses, used_count, active FROM promo_codes WHERE code = $1",
+        code.upper()
+    )
+
+
+async def create_promo_code(code: str, days: int, max_uses: int):
+    """Создать новый промокод"""
+    await pool.execute(
+        """
+        INSERT INTO promo_codes (code, days, max_uses, used_count, active)
+        VALUES ($1, $2, $3, 0, TRUE)
+        ON CONFLICT (code) DO UPDATE
+        SET days = EXCLUDED.days, max_uses = EXCLUDED.max_uses, used_count = 0, active = TRUE
+        """,
+        code.upper(), days, max_uses
+    )
+
+
+async def increment_promo_usage(code: str) -> int | None:
+    """Атомарно увеличить счётчик использования промокода, вернуть новое значение"""
+    return await pool.fetchval(
+        "UPDATE promo_codes SET used_count = used_count + 1 WHERE code = $1 RETURNING used_count",
+        code.upper()
+    )
+
+
+async def redeem_promo_code(code: str):
+    """
+    Списать одно использование промокода, если он активен и лимит не исчерпан
+
+    Returns:
+        Запись (days, used_count, max_uses) после списания или None
+    """
+    return await pool.fetchrow(
+        """
+        UPDATE promo_codes SET used_count = used_count + 1
+        WHERE code = $1 AND active AND used_count < max_uses
+        RETURNING days, used_count, max_uses
+        """,
+        code.upper()
+    )
+
+
+async def release_promo_code(code: str):
+    """Вернуть использование промокода (если активация не удалась)"""
+    await pool.execute(
+        "UPDATE promo_codes SET used_count = used_count - 1 WHERE code = $1 AND used_count > 0",
+        code.upper()
+    )
@@ -0,0 +1,195 @@
+"""
+Ограничение частоты запросов к внешним API и повторы при 429/5xx.
+
+UpstreamPolicy — клиентский middleware aiohttp: подключается к сессии
+в http_clients.py и действует на все запросы к своему API.
+
+- Перед каждым запросом берётся токен из TokenBucket: не больше rate
+  запросов в секунду в среднем, всплеск до burst.
+- Ответ 429 с Retry-After приостанавливает весь бакет на указанное
+  время — остальные запросы к этому API ждут, а не получают 429.
+- Идемпотентные запросы (GET, HEAD) при 429, 5xx и сетевых ошибках
+  повторяются до max_retries раз с экспоненциальной задержкой и
+  джиттером (не меньше Retry-After). POST не повторяется: вызывающий
+  получает ответ как есть.
+- Повтор не начинается, если задержка перед ним не укладывается в
+  остаток дедлайна (deadline.py): вызывающий сразу получает последний
+  ответ или ошибку.
+
+Метрики (см. metrics.py), <name> — cryptobot или remnawave:
+    http_<name>_throttled              — запросов, ждавших токен или паузу
+    http_<name>_throttle_wait_seconds  — сколько ждали
+    http_<name>_rate_limited           — ответов 429
+    http_<name>_retries                — повторов запроса
+    http_<name>_retries_exhausted      — запросов, исчерпавших повторы
+    http_<name>_timeouts               — таймаутов соединения или чтения
+    http_<name>_deadline_exceeded      — запросов, прерванных дедлайном
+"""
+
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+
+import deadline
+import metrics
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD"})
+
+
+class TokenBucket:
+    """Бакет токенов: rate токенов в секунду, не больше burst в запасе"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # Ожидающие получают токены по очереди
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Не выдавать токены seconds секунд (ответ 429 с Retry-After)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> float:
+        """
+        Дождаться токена
+
+        Returns:
+            Сколько секунд пришлось ждать
+        """
+        if self.rate <= 0 and self._paused_until <= time.monotonic():
+            return 0.0
+
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self.rate <= 0:
+                    return waited
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return waited
+                    delay = (1 - self._tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After в секундах: число секунд или HTTP-дата"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class UpstreamPolicy:
+    """Клиентский middleware aiohttp: лимит частоты и повторы для одного API"""
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: int,
+        max_retries: int,
+        retry_base: float,
+        retry_max: float
+    ):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+
+    def backoff(self, attempt: int) -> float:
+        """Задержка перед повтором attempt (с 1): экспонента с полным джиттером"""
+        return random.uniform(0, min(self.retry_max, self.retry_base * 2 ** (attempt - 1)))
+
+    async def _acquire(self):
+        waited = await self.bucket.acquire()
+        if waited > 0:
+            metrics.inc(f"http_{self.name}_throttled")
+            metrics.observe(f"http_{self.name}_throttle_wait_seconds", waited)
+
+    def _no_time_for_retry(self, delay: float) -> bool:
+        left = deadline.remaining()
+        if left is not None and delay >= left:
+            metrics.inc(f"http_{self.name}_deadline_exceeded")
+            return True
+        return False
+
+    async def __call__(self, request: aiohttp.ClientRequest, handler) -> aiohttp.ClientResponse:
+        retryable = request.method in IDEMPOTENT_METHODS
+        attempt = 0
+
+        while True:
+            attempt += 1
+
+            try:
+                await self._acquire()
+                response = await handler(request)
+            except asyncio.CancelledError:
+                # Общий таймаут запроса (остаток дедлайна) aiohttp снимает отменой
+                if deadline.expired():
+                    metrics.inc(f"http_{self.name}_deadline_exceeded")
+                raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    metrics.inc(f"http_{self.name}_timeouts")
+                if not retryable or attempt > self.max_retries:
+                    if retryable:
+                        metrics.inc(f"http_{self.name}_retries_exhausted")
+                    raise
+                delay = self.backoff(attempt)
+                if self._no_time_for_retry(delay):
+                    raise
+                reason = type(e).__name__
+            else:
+                if response.status != 429 and response.status < 500:
+                    return response
+
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if response.status == 429:
+                    metrics.inc(f"http_{self.name}_rate_limited")
+                    # Пауза для всех запросов к этому API, не только для этого
+                    self.bucket.pause(min(self.retry_max, retry_after if retry_after is not None else self.backoff(attempt)))
+
+                if not retryable or attempt > self.max_retries:
+                    if retryable:
+                        metrics.inc(f"http_{self.name}_retries_exhausted")
+                    return response
+
+                delay = max(self.backoff(attempt), min(self.retry_max, retry_after or 0))
+                if self._no_time_for_retry(delay):
+                    return response
+                response.release()
+                reason = f"HTTP {response.status}"
+
+            metrics.inc(f"http_{self.name}_retries")
+            logger.warning(
+                f"{self.name}: {request.method} {request.url.path} failed ({reason}), "
+                f"retry {attempt}/{self.max_retries} in {delay:.2f}s"
+            )
+            await asyncio.sleep(delay)
@@ -0,0 +1,346 @@
+"""
+Outbox активаций оплаченных счетов.
+
+Оплаченный счёт сначала записывается в activation_jobs (invoice_id —
+ключ идемпотентности), и только потом выполняются шаги активации:
+
+    provision        — найти или создать пользователя Remnawave, выставить expireAt и сквад
+    squad            — добавить в сквад (если provision этого не сделал)
+    subscription_url — получить ссылку подписки (если её не было в ответе provision)
+    referral         — бонус рефералиту и отметка первого платежа
+    referral_count   — счётчик активных рефералов рефералита
+    subscription     — записать подписку в БД
+    notify           — сообщение пользователю
+
+После каждого шага в задаче сохраняется step и результаты шага, поэтому
+повтор продолжает с первого невыполненного шага. Продление считается
+один раз: дата окончания (target_expire_at, referrer_expire_at)
+сохраняется до обращения к Remnawave и выставляется как абсолютное
+значение, так что повтор после падения не добавляет дни второй раз.
+
+Ошибка шага возвращает задачу в pending с экспоненциальной задержкой;
+после ACTIVATION_MAX_ATTEMPTS попыток задача получает состояние failed
+и видна в /outbox. Задачи берутся с арендой (ACTIVATION_LEASE): если
+процесс упал посреди активации, задачу подберёт activation_worker.
+
+Пока Remnawave недоступен (цепь разомкнута, см. circuit_breaker.py),
+задачи не берутся и ждут в pending, не тратя попыток; оплата при этом
+уже сохранена, и активация пройдёт после восстановления панели.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+
+import aiohttp
+
+from config import (
+    TARIFFS,
+    DEFAULT_SQUAD_UUID,
+    ACTIVATION_WORKERS,
+    ACTIVATION_POLL_INTERVAL,
+    ACTIVATION_LEASE,
+    ACTIVATION_MAX_ATTEMPTS,
+    ACTIVATION_RETRY_BASE,
+    ACTIVATION_RETRY_MAX
+)
+import async_database as db
+import deadline
+import http_clients
+import metrics
+from circuit_breaker import CircuitOpenError
+from user_locks import user_lock
+from services.remnawave import (
+    RemnawaveClient,
+    RemnawaveError,
+    remnawave_unavailable,
+    extend_expire_at,
+    parse_expire_at,
+    squad_uuids,
+    remnawave_add_to_squad,
+    remnawave_get_subscription_url,
+    remnawave_get_user_info
+)
+
+STEPS = ("provision", "squad", "subscription_url", "referral", "referral_count", "subscription", "notify")
+
+# Бонус рефералиту за первый платёж приглашённого, дней
+REFERRAL_BONUS_DAYS = 7
+
+_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def retry_delay(attempts: int) -> float:
+    """Задержка перед попыткой attempts + 1: экспонента с джиттером"""
+    delay = min(ACTIVATION_RETRY_MAX, ACTIVATION_RETRY_BASE * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class _Job:
+    """Задача outbox и сохранение её прогресса"""
+
+    def __init__(self, row: dict):
+        self.row = row
+
+    def __getitem__(self, key):
+        return self.row.get(key)
+
+    async def save(self, step: str | None, **fields):
+        if not await db.save_activation_progress(self["invoice_id"], _owner, step, ACTIVATION_LEASE, fields):
+            raise RuntimeError(f"Lost lease on activation job {self['invoice_id']}")
+        self.row.update(fields)
+        if step is not None:
+            self.row["step"] = step
+
+
+def _before(current: str | None, target: str) -> bool:
+    """Дата окончания current раньше target (или не задана)"""
+    current_dt = parse_expire_at(current)
+    return current_dt is None or current_dt < parse_expire_at(target)
+
+
+async def _step_provision(job: _Job, bot, remnawave: aiohttp.ClientSession):
+    client = RemnawaveClient(remnawave)
+    # UUID из прошлой попытки или из БД (продление), иначе поиск по username
+    known_uuid = job["remnawave_uuid"] or db.user_field(await db.get_user(job["tg_id"]), "remnawave_uuid")
+    user = await client.find_user(job["tg_id"], known_uuid)
+
+    if not job["target_expire_at"]:
+        current = user.get("expireAt") if user else None
+        await job.save(None, target_expire_at=extend_expire_at(current, job["days"]))
+    target = job["target_expire_at"]
+    squad = [DEFAULT_SQUAD_UUID] if DEFAULT_SQUAD_UUID else []
+
+    # Сквад добавляется тем же запросом, что и дата окончания
+    if user is None:
+        user = await client.create_user(job["tg_id"], target, squad)
+    else:
+        squads = squad_uuids(user)
+        new_squads = squads + squad if squad and squad[0] not in squads else None
+        expire_at = target if _before(user.get("expireAt"), target) else None
+        if expire_at is not None or new_squads is not None:
+            user = await client.update_user(user, expire_at, new_squads)
+
+    in_squad = not squad or squad[0] in squad_uuids(user)
+    await job.save(
+        "squad" if in_squad else "provision",
+        remnawave_uuid=user["uuid"],
+        remnawave_username=user.get("username") or f"tg_{job['tg_id']}",
+        sub_url=user.get("subscriptionUrl")
+    )
+
+
+async def _step_squad(job: _Job, bot, remnawave: aiohttp.ClientSession):
+    if not await remnawave_add_to_squad(remnawave, job["remnawave_uuid"]):
+        raise RemnawaveError("Add to squad failed")
+    await job.save("squad")
+
+
+async def _step_subscription_url(job: _Job, bot, remnawave: aiohttp.ClientSession):
+    if not job["sub_url"]:
+        sub_url = await remnawave_get_subscription_url(remnawave, job["remnawave_uuid"])
+        if not sub_url:
+            raise RemnawaveError("Subscription URL not available")
+        await job.save("subscription_url", sub_url=sub_url)
+    else:
+        await job.save("subscription_url")
+
+
+async def _step_referral(job: _Job, bot, remnawave: aiohttp.ClientSession):
+    referrer = await db.get_referrer(job["tg_id"])
+    # referrer_expire_at уже сохранён — бонус начат прошлой попыткой
+    if referrer and referrer[0] and (not referrer[1] or job["referrer_expire_at"]):
+        referrer_uuid = db.user_field(await db.get_user(referrer[0]), "remnawave_uuid")
+        if referrer_uuid:
+            info = await remnawave_get_user_info(remnawave, referrer_uuid)
+            if info is None:
+                raise RemnawaveError(f"Referrer {referrer[0]} not available in Remnawave")
+
+            if not job["referrer_expire_at"]:
+                await job.save(None, referrer_expire_at=extend_expire_at(info.get("expireAt"), REFERRAL_BONUS_DAYS))
+            target = job["referrer_expire_at"]
+
+            if _before(info.get("expireAt"), target):
+                await RemnawaveClient(remnawave).update_user(info, target)
+            logging.info(f"Referral bonus given to {referrer[0]}")
+
+        await db.mark_first_payment(job["tg_id"])
+
+    await job.save("referral")
+
+
+async def _step_referral_count(job: _Job, bot, remnawave: aiohttp.ClientSession):
+    referrer_id = None
+    if job["referrer_expire_at"]:
+        referrer = await db.get_referrer(job["tg_id"])
+        if referrer and referrer[0]:
+            referrer_id = referrer[0]
+    # Счётчик и отметка шага пишутся вместе — повтор не засчитает реферала дважды
+    if not await db.count_activation_referral(job["invoice_id"], _owner, referrer_id, ACTIVATION_LEASE):
+        raise RuntimeError(f"Lost lease on activation job {job['invoice_id']}")
+    job.row["step"] = "referral_count"
+
+
+async def _step_subscription(job: _Job, bot, remnawave: aiohttp.ClientSession):
+    await db.update_subscription(
+        job["tg_id"], job["remnawave_uuid"], job["remnawave_username"],
+        job["target_expire_at"], DEFAULT_SQUAD_UUID, job["sub_url"]
+    )
+    await job.save("subscription")
+
+
+async def _step_notify(job: _Job, bot, remnawave: aiohttp.ClientSession):
+    text = (
+        "✅ <b>Оплата прошла успешно!</b>\n\n"
+        f"Тариф: {job['tariff_code']} ({job['days']} дней)\n"
+        f"<b>Ссылка подписки:</b>\n<code>{job['sub_url']}</code>"
+    )
+    try:
+        await bot.send_message(job["tg_id"], text)
+    except Exception as e:
+        # Подписка уже активна — из-за недоставленного сообщения не повторяем
+        logging.warning(f"Failed to notify user {job['tg_id']} about invoice {job['invoice_id']}: {e}")
+    await job.save("notify")
+
+
+_STEP_HANDLERS = {
+    "provision": _step_provision,
+    "squad": _step_squad,
+    "subscription_url": _step_subscription_url,
+    "referral": _step_referral,
+    "referral_count": _step_referral_count,
+    "subscription": _step_subscription,
+    "notify": _step_notify
+}
+
+
+async def run_job(bot, remnawave: aiohttp.ClientSession, row: dict) -> bool:
+    """
+    Выполнить захваченную задачу с первого невыполненного шага
+
+    Args:
+        bot: Экземпляр Bot
+        remnawave: Сессия Remnawave (http_clients.remnawave)
+        row: Задача из claim_activation_jobs
+
+    Returns:
+        True если активация завершена, False если задача отложена или failed
+    """
+    job = _Job(dict(row))
+    started = time.perf_counter()
+    done = job["step"]
+    remaining = STEPS[STEPS.index(done) + 1:] if done in STEPS else STEPS
+
+    try:
+        # Задача не должна пережить аренду — иначе её подхватит другой процесс
+        with deadline.budget(ACTIVATION_LEASE):
+            for step in remaining:
+                await _STEP_HANDLERS[step](job, bot, remnawave)
+    except Exception as e:
+        error = f"{job['step'] or 'start'}: {e}"[:500]
+        if isinstance(e, CircuitOpenError) or remnawave_unavailable():
+            # Remnawave недоступен — попытка не засчитывается, задача ждёт восстановления
+            retry_in = max(ACTIVATION_POLL_INTERVAL, http_clients.remnawave_breaker.retry_in())
+            await db.finish_activation_job(job["invoice_id"], _owner, "pending", job["attempts"] or 0,
+                                           int(time.time() + retry_in), error)
+            metrics.inc("activation_jobs_deferred")
+            logging.warning(f"Activation of invoice {job['invoice_id']} deferred: Remnawave unavailable")
+            return False
+
+        attempts = (job["attempts"] or 0) + 1
+        if attempts >= ACTIVATION_MAX_ATTEMPTS:
+            await db.finish_activation_job(job["invoice_id"], _owner, "failed", attempts, 0, error)
+            metrics.inc("activation_jobs_failed")
+            logging.error(f"Activation of invoice {job['invoice_id']} failed after {attempts} attempts: {error}")
+        else:
+            next_attempt_at = int(time.time() + retry_delay(attempts))
+            await db.finish_activation_job(job["invoice_id"], _owner, "pending", attempts, next_attempt_at, error)
+            metrics.inc("activation_jobs_retried")
+            logging.warning(f"Activation of invoice {job['invoice_id']} will be retried (attempt {attempts}): {error}")
+        return False
+
+    await db.finish_activation_job(job["invoice_id"], _owner, "done", (job["attempts"] or 0) + 1)
+    metrics.inc("activation_jobs_done")
+    metrics.observe("activation_job_seconds", time.perf_counter() - started)
+    logging.info(f"Activated invoice {job['invoice_id']} for user {job['tg_id']}")
+    return True
+
+
+async def activate_paid_invoice(
+    bot,
+    remnawave: aiohttp.ClientSession,
+    tg_id: int,
+    invoice_id: str,
+    tariff_code: str
+) -> bool:
+    """
+    Записать оплаченный счёт в outbox и сразу попытаться активировать
+
+    Вызывается под user_lock(tg_id). Платёж помечается paid сразу после
+    записи задачи: дальше активацией владеет outbox, и опрос CryptoBot
+    больше не трогает этот счёт.
+
+    Args:
+        bot: Экземпляр Bot
+        remnawave: Сессия Remnawave (http_clients.remnawave)
+        tg_id: ID пользователя Telegram
+        invoice_id: ID счёта в CryptoBot
+        tariff_code: Код тарифа
+
+    Returns:
+        True если подписка активирована сейчас, False если активация
+        отложена (её завершит activation_worker)
+    """
+    await db.enqueue_activation(invoice_id, tg_id, tariff_code, TARIFFS[tariff_code]["days"])
+    await db.update_payment_status_by_invoice(invoice_id, "paid")
+
+    if remnawave_unavailable():
+        # Оплата сохранена в outbox — активация пройдёт, когда панель восстановится
+        metrics.inc("activation_jobs_deferred")
+        return False
+
+    jobs = await db.claim_activation_jobs(_owner, 1, ACTIVATION_LEASE, invoice_id)
+    if not jobs:
+        # Задача уже выполнена, выполняется другим процессом или ждёт повтора
+        return False
+    return await run_job(bot, remnawave, jobs[0])
+
+
+async def _run_claimed(bot, remnawave: aiohttp.ClientSession, row: dict):
+    async with user_lock(row["tg_id"]) as acquired:
+        if not acquired:
+            # Пользователь занят (например, «Проверить оплату») — вернём задачу без штрафа
+            await db.finish_activation_job(row["invoice_id"], _owner, "pending", row["attempts"] or 0,
+                                           int(time.time() + ACTIVATION_POLL_INTERVAL), row.get("last_error"))
+            return
+        await run_job(bot, remnawave, row)
+
+
+async def activation_worker(bot, remnawave: aiohttp.ClientSession, interval: float = ACTIVATION_POLL_INTERVAL):
+    """
+    Фоновая задача: выполняет отложенные и брошенные задачи outbox
+
+    Args:
+        bot: Экземпляр Bot
+        remnawave: Сессия Remnawave (http_clients.remnawave)
+        interval: Интервал опроса outbox, сек
+    """
+    while True:
+        if remnawave_unavailable():
+            # Задачи не берём, пока цепь разомкнута: они бы только потратили попытки
+            await asyncio.sleep(max(interval, http_clients.remnawave_breaker.retry_in()))
+            continue
+        try:
+            jobs = await db.claim_activation_jobs(_owner, ACTIVATION_WORKERS, ACTIVATION_LEASE)
+            if jobs:
+                await asyncio.gather(*(_run_claimed(bot, remnawave, row) for row in jobs), return_exceptions=True)
+                # Полная пачка — возможно, есть ещё готовые задачи
+                if len(jobs) == ACTIVATION_WORKERS:
+                    continue
+        except Exception as e:
+            logging.error(f"Activation worker error: {e}")
+        await asyncio.sleep(interval)
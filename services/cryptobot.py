@@ -1,18 +1,36 @@
 import aiohttp
 import logging
 import asyncio
-from datetime import datetime, timedelta, timezone
-from config import CRYPTOBOT_TOKEN, CRYPTOBOT_API_URL, TARIFFS, PAYMENT_CHECK_INTERVAL
-import database as db
-from services.remnawave import (
-    remnawave_get_or_create_user,
-    remnawave_add_to_squad,
-    remnawave_get_subscription_url,
-    remnawave_extend_subscription
+import time
+from typing import AsyncIterator
+from config import (
+    CRYPTOBOT_API_URL,
+    CRYPTOBOT_BATCH_SIZE,
+    CRYPTOBOT_INVOICE_TTL,
+    PAYMENT_CHECK_INTERVAL,
+    PAYMENT_POLL_MAX_INTERVAL,
+    PAYMENT_SCHEDULER_TICK,
+    PAYMENT_WORKERS,
+    SINGLE_FLIGHT_TTL,
+    CRYPTOBOT_CONNECT_TIMEOUT,
+    CRYPTOBOT_READ_TIMEOUT
 )
+import async_database as db
+import deadline
+import metrics
+from single_flight import SingleFlight
+from user_locks import user_lock
+from services.invoice_schedule import InvoiceSchedule
+from services.activation import activate_paid_invoice
+
+
+def _timeout() -> aiohttp.ClientTimeout:
+    """Таймауты запроса к CryptoBot с учётом дедлайна обработчика"""
+    return deadline.client_timeout("cryptobot", CRYPTOBOT_CONNECT_TIMEOUT, CRYPTOBOT_READ_TIMEOUT)
 
 
 async def create_cryptobot_invoice(
+    session: aiohttp.ClientSession,
     bot,
     amount: float,
     tariff_code: str,
@@ -22,6 +40,7 @@ async def create_cryptobot_invoice(
     Создать счёт для оплаты через CryptoBot
     
     Args:
+        session: Сессия CryptoBot (http_clients.cryptobot)
         bot: Экземпляр Bot
         amount: Сумма платежа в рублях
         tariff_code: Код тарифа
@@ -31,7 +50,6 @@ async def create_cryptobot_invoice(
         Словарь с информацией о счёте или None
     """
     url = f"{CRYPTOBOT_API_URL}/createInvoice"
-    headers = {"Crypto-Pay-API-Token": CRYPTOBOT_TOKEN}
     
     bot_username = (await bot.get_me()).username
     
@@ -43,151 +61,335 @@ async def create_cryptobot_invoice(
         "payload": f"spn_{tg_id}_{tariff_code}",
         "paid_btn_name": "openBot",
         "paid_btn_url": f"https://t.me/{bot_username}",
-        "accepted_assets": "USDT,TON,BTC"
+        "accepted_assets": "USDT,TON,BTC",
+        "expires_in": CRYPTOBOT_INVOICE_TTL
     }
 
-    connector = aiohttp.TCPConnector(ssl=False)
     try:
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.post(url, headers=headers, json=payload) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    if data.get("ok"):
-                        logging.info(f"Created CryptoBot invoice for user {tg_id}")
-                        return data["result"]
-                else:
-                    logging.error(f"CryptoBot error {resp.status}: {await resp.text()}")
+        async with session.post(url, json=payload, timeout=_timeout()) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                if data.get("ok"):
+                    logging.info(f"Created CryptoBot invoice for user {tg_id}")
+                    return data["result"]
+            else:
+                logging.error(f"CryptoBot error {resp.status}: {await resp.text()}")
     except Exception as e:
         logging.error(f"CryptoBot invoice exception: {e}")
     
     return None
 
 
-async def get_invoice_status(invoice_id: str) -> dict | None:
+# Статусы счетов: одновременные запросы одного счёта объединяются,
+# фоновая проверка кладёт сюда то, что получила пачкой
+_invoice_status = SingleFlight("invoice_status", SINGLE_FLIGHT_TTL)
+
+
+async def get_invoice_status(session: aiohttp.ClientSession, invoice_id: str) -> dict | None:
     """
     Получить статус счёта в CryptoBot
     
+    Если счёт прямо сейчас запрашивается (другим нажатием кнопки) или
+    был получен за последние SINGLE_FLIGHT_TTL секунд (в том числе
+    фоновой проверкой), новый запрос не отправляется.
+
     Args:
+        session: Сессия CryptoBot (http_clients.cryptobot)
         invoice_id: ID счёта в CryptoBot
         
     Returns:
         Словарь с информацией о счёте или None
     """
-    connector = aiohttp.TCPConnector(ssl=False)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        headers = {"Crypto-Pay-API-Token": CRYPTOBOT_TOKEN}
-        url = f"{CRYPTOBOT_API_URL}/getInvoices"
-        params = {"invoice_ids": invoice_id}
+    return await _invoice_status.do(str(invoice_id), lambda: _fetch_invoice_status(session, invoice_id))
 
-        try:
-            async with session.get(url, headers=headers, params=params) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    if data.get("ok"):
-                        invoices = data["result"]["items"]
-                        if invoices:
-                            return invoices[0]
-        except Exception as e:
-            logging.error(f"Get invoice status exception: {e}")
+
+async def _fetch_invoice_status(session: aiohttp.ClientSession, invoice_id: str) -> dict | None:
+    url = f"{CRYPTOBOT_API_URL}/getInvoices"
+    params = {"invoice_ids": invoice_id}
+
+    try:
+        async with session.get(url, params=params, timeout=_timeout()) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                if data.get("ok"):
+                    invoices = data["result"]["items"]
+                    if invoices:
+                        return invoices[0]
+    except Exception as e:
+        logging.error(f"Get invoice status exception: {e}")
 
     return None
 
 
-async def process_paid_invoice(bot, tg_id: int, invoice_id: str, tariff_code: str) -> bool:
+async def _get_invoices_chunk(session: aiohttp.ClientSession, chunk: list) -> list:
+    """Один запрос getInvoices на пачку счетов; при ошибке — пустой список"""
+    url = f"{CRYPTOBOT_API_URL}/getInvoices"
+    params = {
+        "invoice_ids": ",".join(str(invoice_id) for invoice_id in chunk),
+        "count": len(chunk)
+    }
+
+    try:
+        async with session.get(url, params=params, timeout=_timeout()) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                if data.get("ok"):
+                    items = data["result"]["items"]
+                    for item in items:
+                        _invoice_status.set(str(item["invoice_id"]), item)
+                    return items
+            else:
+                logging.error(f"CryptoBot getInvoices error {resp.status}: {await resp.text()}")
+    except Exception as e:
+        logging.error(f"Get invoices batch exception: {e}")
+
+    return []
+
+
+async def get_invoices(session: aiohttp.ClientSession, invoice_ids: list) -> AsyncIterator[dict]:
+    """
+    Получить счета в CryptoBot пачками
+
+    getInvoices принимает список invoice_ids через запятую, поэтому на
+    N счетов уходит N / CRYPTOBOT_BATCH_SIZE запросов. Результат каждой
+    пачки отдаётся сразу, не дожидаясь остальных.
+    Пачка, запрос которой не удался, просто отсутствует в результате и
+    будет проверена в следующем цикле.
+
+    Args:
+        session: Сессия CryptoBot (http_clients.cryptobot)
+        invoice_ids: Список ID счетов в CryptoBot
+
+    Yields:
+        Словарь {invoice_id (str): информация о счёте} для каждой пачки
+    """
+    for start in range(0, len(invoice_ids), CRYPTOBOT_BATCH_SIZE):
+        chunk = invoice_ids[start:start + CRYPTOBOT_BATCH_SIZE]
+        yield {str(item["invoice_id"]): item for item in await _get_invoices_chunk(session, chunk)}
+
+
+async def process_paid_invoice(
+    bot,
+    remnawave: aiohttp.ClientSession,
+    tg_id: int,
+    invoice_id: str,
+    tariff_code: str
+) -> bool:
     """
     Обработать оплаченный счёт и активировать подписку
-    
+
+    Активация идёт через outbox (services/activation.py): повторный вызов
+    для того же счёта не продлевает подписку второй раз.
+
     Args:
         bot: Экземпляр Bot
+        remnawave: Сессия Remnawave (http_clients.remnawave)
         tg_id: ID пользователя Telegram
         invoice_id: ID счёта в CryptoBot
         tariff_code: Код тарифа
-        
+
     Returns:
-        True если успешно, False иначе
+        True если подписка активирована, False если активация отложена или не удалась
     """
     try:
-        days = TARIFFS[tariff_code]["days"]
-        
-        connector = aiohttp.TCPConnector(ssl=False)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            # Создаём или получаем пользователя в Remnawave
-            uuid, username = await remnawave_get_or_create_user(
-                session, tg_id, days, extend_if_exists=True
-            )
-            
-            if not uuid:
-                logging.error(f"Failed to create/get Remnawave user for {tg_id}")
-                return False
-
-            # Добавляем в сквад
-            await remnawave_add_to_squad(session, uuid)
-            
-            # Получаем ссылку подписки
-            sub_url = await remnawave_get_subscription_url(session, uuid)
-
-            # Обрабатываем реферальную программу
-            referrer = db.get_referrer(tg_id)
-            if referrer and referrer[0] and not referrer[1]:  # есть рефералит и это первый платеж
-                referrer_uuid_row = db.get_user(referrer[0])
-                if referrer_uuid_row and referrer_uuid_row[3]:  # remnawave_uuid существует
-                    await remnawave_extend_subscription(session, referrer_uuid_row[3], 7)
-                    db.increment_active_referrals(referrer[0])
-                    logging.info(f"Referral bonus given to {referrer[0]}")
-                
-                db.mark_first_payment(tg_id)
-
-            # Обновляем платеж в БД
-            db.update_payment_status_by_invoice(invoice_id, 'paid')
-            
-            # Обновляем подписку пользователя
-            new_until = (datetime.now(timezone.utc) + timedelta(days=days)).isoformat()
-            db.update_subscription(tg_id, uuid, username, new_until, None)
-
-            # Отправляем сообщение пользователю
-            text = (
-                "✅ <b>Оплата прошла успешно!</b>\n\n"
-                f"Тариф: {tariff_code} ({days} дней)\n"
-                f"<b>Ссылка подписки:</b>\n<code>{sub_url}</code>"
-            )
-            await bot.send_message(tg_id, text)
-            
-            return True
-
+        return await activate_paid_invoice(bot, remnawave, tg_id, invoice_id, tariff_code)
     except Exception as e:
         logging.error(f"Process paid invoice exception: {e}")
         return False
 
 
-async def check_cryptobot_invoices(bot):
+# Статусы платежа в БД, при которых оплаченный счёт ещё нужно активировать
+# (expired — счёт истёк по нашим часам, но CryptoBot успел принять оплату)
+ACTIVATABLE_STATUSES = ("pending", "expired")
+
+
+async def _probe_stage(cryptobot: aiohttp.ClientSession, by_invoice: dict, queue: asyncio.Queue, results: dict):
+    """Стадия 1: опрос статусов пачками без блокировок, оплаченные — в очередь"""
+    started = time.perf_counter()
+    async for invoices in get_invoices(cryptobot, list(by_invoice)):
+        metrics.observe("payment_probe_seconds", time.perf_counter() - started)
+
+        for invoice_id, item in invoices.items():
+            if invoice_id not in by_invoice:
+                continue
+            results[invoice_id] = item.get("status")
+            if item.get("status") != "paid":
+                continue
+            tg_id, tariff_code = by_invoice[invoice_id]
+            await queue.put((invoice_id, tg_id, tariff_code, time.perf_counter()))
+            metrics.set_gauge("payment_activation_queue_depth", queue.qsize())
+
+        started = time.perf_counter()
+
+
+async def _activation_worker(bot, remnawave: aiohttp.ClientSession, queue: asyncio.Queue, results: dict):
+    """Стадия 2: активация оплаченных счетов под блокировкой пользователя"""
+    while True:
+        job = await queue.get()
+        if job is None:
+            return
+
+        invoice_id, tg_id, tariff_code, enqueued = job
+        metrics.set_gauge("payment_activation_queue_depth", queue.qsize())
+        metrics.observe("payment_activation_queue_wait_seconds", time.perf_counter() - enqueued)
+
+        started = time.perf_counter()
+        try:
+            async with user_lock(tg_id) as acquired:
+                if not acquired:
+                    continue
+
+                # Счёт мог уже активировать вебхук или кнопка «Проверить оплату»
+                payment = await db.get_payment_by_invoice(invoice_id)
+                if not payment or payment[3] not in ACTIVATABLE_STATUSES:
+                    results[invoice_id] = "skipped"
+                    continue
+
+                success = await process_paid_invoice(bot, remnawave, tg_id, invoice_id, tariff_code)
+                if success:
+                    results[invoice_id] = "activated"
+                    logging.info(f"Processed payment for user {tg_id}, invoice {invoice_id}")
+
+        except Exception as e:
+            logging.error(f"Check invoice error for {tg_id}: {e}")
+
+        finally:
+            # Учитываются все платежи из очереди, включая занятых пользователей и пропущенные
+            metrics.observe("payment_activation_seconds", time.perf_counter() - started)
+
+
+async def run_payment_check(
+    bot,
+    cryptobot: aiohttp.ClientSession,
+    remnawave: aiohttp.ClientSession,
+    pending,
+    workers: int = PAYMENT_WORKERS
+) -> dict:
     """
-    Фоновая задача для проверки статусов платежей в CryptoBot
-    
+    Один проход проверки ожидающих платежей
+
+    Опрос статусов и активация идут параллельно: пока опрашиваются
+    следующие пачки, оплаченные счета уже активируют workers
+    обработчиков. Один медленный ответ Remnawave задерживает только свой
+    платёж, а не всю очередь.
+
     Args:
         bot: Экземпляр Bot
+        cryptobot: Сессия CryptoBot (http_clients.cryptobot)
+        remnawave: Сессия Remnawave (http_clients.remnawave)
+        pending: Строки (id, tg_id, invoice_id, tariff_code) из get_pending_payments
+        workers: Сколько платежей активировать одновременно
+
+    Returns:
+        Словарь {invoice_id: исход}. Исход — статус счёта в CryptoBot
+        (active, expired, …), activated — подписка активирована,
+        skipped — платёж уже обработан другим путём, paid — оплачен, но
+        активировать не удалось. Счетов, не вернувшихся из CryptoBot, в
+        словаре нет.
     """
+    # invoice_id -> (tg_id, tariff_code)
+    by_invoice = {
+        str(invoice_id): (tg_id, tariff_code)
+        for payment_id, tg_id, invoice_id, tariff_code in pending
+    }
+
+    queue = asyncio.Queue(maxsize=CRYPTOBOT_BATCH_SIZE)
+    results = {}
+    worker_tasks = [
+        asyncio.create_task(_activation_worker(bot, remnawave, queue, results))
+        for _ in range(max(1, workers))
+    ]
+
+    try:
+        await _probe_stage(cryptobot, by_invoice, queue, results)
+    finally:
+        for _ in worker_tasks:
+            await queue.put(None)
+        await asyncio.gather(*worker_tasks)
+        metrics.set_gauge("payment_activation_queue_depth", 0)
+
+    return results
+
+
+_PAYMENTS_SCAN_LIMIT = 1000
+
+
+async def _load_new_payments(schedule: InvoiceSchedule, after_id: int) -> int:
+    """Добавить в расписание платежи с id больше after_id, вернуть новый курсор"""
     while True:
-        await asyncio.sleep(PAYMENT_CHECK_INTERVAL)
+        rows = await db.get_pending_payments_after(after_id, _PAYMENTS_SCAN_LIMIT)
+        for payment_id, tg_id, invoice_id, tariff_code, created_at in rows:
+            schedule.add(payment_id, tg_id, invoice_id, tariff_code, created_at)
+            after_id = max(after_id, payment_id)
+        if len(rows) < _PAYMENTS_SCAN_LIMIT:
+            return after_id
 
-        pending = db.get_pending_payments()
 
-        if not pending:
-            continue
+async def check_cryptobot_invoices(
+    bot,
+    cryptobot: aiohttp.ClientSession,
+    remnawave: aiohttp.ClientSession,
+    interval: float = PAYMENT_CHECK_INTERVAL
+):
+    """
+    Фоновая задача для проверки статусов платежей в CryptoBot
+
+    Каждый шаг (PAYMENT_SCHEDULER_TICK) подхватывает новые платежи по
+    курсору id и проверяет только счета, чья очередь наступила по
+    InvoiceSchedule. Счета, которые CryptoBot вернул со статусом expired,
+    помечаются expired и больше не опрашиваются; счёт без ответа (сбой
+    getInvoices) остаётся в расписании и проверяется с отсрочкой.
 
-        for payment_id, tg_id, invoice_id, tariff_code in pending:
-            if not db.acquire_user_lock(tg_id):
+    Args:
+        bot: Экземпляр Bot
+        cryptobot: Сессия CryptoBot (http_clients.cryptobot)
+        remnawave: Сессия Remnawave (http_clients.remnawave)
+        interval: Интервал проверки свежего счёта, сек (с вебхуком — PAYMENT_SAFETY_NET_INTERVAL)
+    """
+    schedule = InvoiceSchedule(interval, PAYMENT_POLL_MAX_INTERVAL)
+    last_payment_id = 0
+
+    while True:
+        await asyncio.sleep(PAYMENT_SCHEDULER_TICK)
+        due = []
+
+        try:
+            last_payment_id = await _load_new_payments(schedule, last_payment_id)
+            metrics.set_gauge("payment_schedule_size", len(schedule))
+
+            now = time.time()
+            due = schedule.pop_due(now)
+            if not due:
                 continue
 
-            try:
-                invoice = await get_invoice_status(invoice_id)
-                
-                if invoice and invoice.get("status") == "paid":
-                    success = await process_paid_invoice(bot, tg_id, invoice_id, tariff_code)
-                    if success:
-                        logging.info(f"Processed payment for user {tg_id}, invoice {invoice_id}")
-
-            except Exception as e:
-                logging.error(f"Check invoice error for {tg_id}: {e}")
-            
-            finally:
-                db.release_user_lock(tg_id)
+            pending = [(e.payment_id, e.tg_id, e.invoice_id, e.tariff_code) for e in due]
+            results = await run_payment_check(bot, cryptobot, remnawave, pending)
+
+            expired = []
+            now = time.time()
+            for entry in due:
+                outcome = results.get(entry.invoice_id)
+                if outcome in ("activated", "skipped"):
+                    schedule.remove(entry.payment_id)
+                elif outcome == "paid":
+                    # Оплачен, но не активирован (пользователь занят или ошибка Remnawave)
+                    schedule.reschedule(entry.payment_id, now, delay=interval)
+                elif outcome == "expired":
+                    # Только подтверждённое CryptoBot истечение: счёт создан с expires_in,
+                    # и пока CryptoBot считает его активным, он ещё может быть оплачен
+                    expired.append(entry.payment_id)
+                    schedule.remove(entry.payment_id)
+                else:
+                    # active или нет ответа (пачка не получена, счёт не вернулся) — проверим позже
+                    schedule.reschedule(entry.payment_id, now)
+
+            if expired:
+                count = await db.expire_payments(expired)
+                metrics.inc("payments_expired", count)
+                logging.info(f"Marked {count} payments as expired")
+
+        except Exception as e:
+            logging.error(f"Payment check cycle error: {e}")
+            # Не теряем извлечённые счета — проверим их на следующем шаге
+            for entry in due:
+                schedule.reschedule(entry.payment_id, time.time(), delay=interval)
@@ -0,0 +1,168 @@
+"""
+Приём вебхуков CryptoBot (обновления invoice_paid).
+
+CryptoBot отправляет POST с JSON-обновлением и заголовком
+crypto-pay-api-signature — HMAC-SHA256 от тела запроса, где ключ —
+SHA256 от CRYPTOBOT_TOKEN. Запросы с неверной подписью отклоняются.
+
+Оплата активируется сразу в фоне, CryptoBot получает ответ не дожидаясь
+Remnawave. Если пользователь в этот момент занят (нажал «Проверить
+оплату»), счёт подберёт фоновая проверка check_cryptobot_invoices,
+которая при включённом вебхуке работает редко, как страховка.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import time
+
+import aiohttp
+from aiohttp import web
+
+from config import CRYPTOBOT_TOKEN, CRYPTOBOT_WEBHOOK_PATH
+import async_database as db
+import metrics
+from user_locks import user_lock
+from services.cryptobot import ACTIVATABLE_STATUSES, process_paid_invoice
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = "crypto-pay-api-signature"
+
+# Ссылки на фоновые активации, чтобы их не собрал сборщик мусора
+_tasks: set[asyncio.Task] = set()
+
+
+def sign_body(body: bytes, token: str = CRYPTOBOT_TOKEN) -> str:
+    """
+    Подписать тело вебхука так же, как это делает CryptoBot
+
+    Args:
+        body: Сырое тело запроса
+        token: Токен API CryptoBot
+
+    Returns:
+        HMAC-SHA256 в hex
+    """
+    secret = hashlib.sha256(token.encode()).digest()
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(body: bytes, signature: str | None) -> bool:
+    """Проверить подпись вебхука CryptoBot"""
+    if not signature or not CRYPTOBOT_TOKEN:
+        return False
+    return hmac.compare_digest(sign_body(body), signature)
+
+
+async def activate_invoice(bot, remnawave: aiohttp.ClientSession, invoice_id: str) -> bool:
+    """
+    Активировать подписку по оплаченному счёту
+
+    Повторная доставка вебхука безопасна: уже оплаченный платёж
+    пропускается. Платёж, помеченный expired, активируется — CryptoBot
+    подтвердил оплату.
+
+    Args:
+        bot: Экземпляр Bot
+        remnawave: Сессия Remnawave (http_clients.remnawave)
+        invoice_id: ID счёта в CryptoBot
+
+    Returns:
+        True если подписка активирована, False иначе
+    """
+    payment = await db.get_payment_by_invoice(invoice_id)
+    if not payment:
+        logger.warning(f"Webhook for unknown invoice {invoice_id}")
+        return False
+
+    payment_id, tg_id, tariff_code, status = payment
+    if status not in ACTIVATABLE_STATUSES:
+        return False
+
+    async with user_lock(tg_id) as acquired:
+        if not acquired:
+            logger.info(f"User {tg_id} busy, invoice {invoice_id} left for the payment checker")
+            return False
+
+        # Статус мог измениться, пока ждали блокировку
+        payment = await db.get_payment_by_invoice(invoice_id)
+        if not payment or payment[3] not in ACTIVATABLE_STATUSES:
+            return False
+
+        return await process_paid_invoice(bot, remnawave, tg_id, invoice_id, tariff_code)
+
+
+async def _activate_in_background(bot, remnawave: aiohttp.ClientSession, invoice_id: str, received: float):
+    try:
+        if await activate_invoice(bot, remnawave, invoice_id):
+            metrics.observe("cryptobot_webhook_activation_seconds", time.perf_counter() - received)
+            logger.info(f"Processed webhook payment for invoice {invoice_id}")
+    except Exception as e:
+        logger.error(f"Webhook activation error for invoice {invoice_id}: {e}")
+
+
+def create_webhook_app(bot, remnawave: aiohttp.ClientSession) -> web.Application:
+    """
+    Создать aiohttp-приложение с обработчиком вебхука
+
+    Args:
+        bot: Экземпляр Bot
+        remnawave: Сессия Remnawave (http_clients.remnawave)
+
+    Returns:
+        web.Application с маршрутом CRYPTOBOT_WEBHOOK_PATH
+    """
+    async def handle_update(request: web.Request) -> web.Response:
+        received = time.perf_counter()
+        body = await request.read()
+
+        if not verify_signature(body, request.headers.get(SIGNATURE_HEADER)):
+            metrics.inc("cryptobot_webhook_rejected")
+            logger.warning(f"Rejected CryptoBot webhook with bad signature from {request.remote}")
+            return web.Response(status=401)
+
+        try:
+            update = json.loads(body)
+        except ValueError:
+            metrics.inc("cryptobot_webhook_rejected")
+            return web.Response(status=400)
+
+        # Подписанное тело может оказаться JSON не того вида (список, строка, payload не объект)
+        invoice = update.get("payload", {}) if isinstance(update, dict) else None
+        if not isinstance(invoice, dict):
+            metrics.inc("cryptobot_webhook_rejected")
+            return web.Response(status=400)
+
+        metrics.inc("cryptobot_webhook_updates")
+
+        if update.get("update_type") == "invoice_paid" and invoice.get("invoice_id") is not None:
+            task = asyncio.create_task(
+                _activate_in_background(bot, remnawave, str(invoice["invoice_id"]), received)
+            )
+            _tasks.add(task)
+            task.add_done_callback(_tasks.discard)
+
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app.router.add_post(CRYPTOBOT_WEBHOOK_PATH, handle_update)
+    return app
+
+
+async def start_webhook_server(bot, remnawave: aiohttp.ClientSession, host: str, port: int) -> web.AppRunner:
+    """Запустить HTTP-сервер вебхука"""
+    runner = web.AppRunner(create_webhook_app(bot, remnawave), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"CryptoBot webhook listening on {host}:{port}{CRYPTOBOT_WEBHOOK_PATH}")
+    return runner
+
+
+async def stop_webhook_server(runner: web.AppRunner):
+    """Остановить сервер и дождаться начатых активаций"""
+    await runner.cleanup()
+    if _tasks:
+        await asyncio.gather(*_tasks, return_exceptions=True)
@@ -0,0 +1,90 @@
+"""
+Расписание опроса ожидающих счетов CryptoBot.
+
+Счета лежат в куче по времени следующей проверки, поэтому шаг
+планировщика забирает только те, чья проверка наступила, без обхода
+всей таблицы платежей.
+
+Интервал считается от created_at: свежий счёт проверяется через
+min_interval, дальше интервал равен возрасту счёта (ограничен
+max_interval). Это экспоненциальная отсрочка — проверки на 10, 20, 40,
+80 … секунде — которая не сбрасывается при перезапуске бота.
+"""
+
+import heapq
+from dataclasses import dataclass
+
+
+@dataclass
+class PendingInvoice:
+    payment_id: int
+    tg_id: int
+    invoice_id: str
+    tariff_code: str
+    created_at: float
+    due_at: float = 0.0
+
+
+class InvoiceSchedule:
+    """Куча ожидающих счетов по времени следующей проверки"""
+
+    def __init__(self, min_interval: float, max_interval: float):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self._heap: list[tuple[float, int]] = []  # (due_at, payment_id)
+        self._entries: dict[int, PendingInvoice] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, payment_id: int) -> bool:
+        return payment_id in self._entries
+
+    def _push(self, entry: PendingInvoice, due_at: float):
+        entry.due_at = due_at
+        heapq.heappush(self._heap, (due_at, entry.payment_id))
+
+    def add(self, payment_id: int, tg_id: int, invoice_id: str, tariff_code: str, created_at: float):
+        """Добавить счёт; первая проверка — через min_interval после создания"""
+        if payment_id in self._entries:
+            return
+        entry = PendingInvoice(payment_id, tg_id, str(invoice_id), tariff_code, float(created_at or 0))
+        self._entries[payment_id] = entry
+        self._push(entry, entry.created_at + self.min_interval)
+
+    def reschedule(self, payment_id: int, now: float, delay: float | None = None):
+        """
+        Запланировать следующую проверку
+
+        Args:
+            payment_id: ID платежа
+            now: Текущее время (epoch)
+            delay: Явная задержка; по умолчанию — возраст счёта в пределах [min_interval, max_interval]
+        """
+        entry = self._entries.get(payment_id)
+        if entry is None:
+            return
+        if delay is None:
+            delay = min(self.max_interval, max(self.min_interval, now - entry.created_at))
+        self._push(entry, now + delay)
+
+    def remove(self, payment_id: int):
+        """Убрать счёт из расписания (запись в куче отбросится при извлечении)"""
+        self._entries.pop(payment_id, None)
+
+    def pop_due(self, now: float) -> list[PendingInvoice]:
+        """
+        Извлечь счета, проверка которых наступила
+
+        Извлечённые счета остаются в расписании: после проверки их нужно
+        либо reschedule, либо remove.
+        """
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due_at, payment_id = heapq.heappop(self._heap)
+            entry = self._entries.get(payment_id)
+            # Устаревшие записи кучи: счёт удалён или перепланирован
+            if entry is None or entry.due_at != due_at:
+                continue
+            due.append(entry)
+        return due
@@ -0,0 +1,219 @@
+"""
+Сверка users с Remnawave.
+
+Дата окончания, UUID и ссылка подписки в users — копия данных Remnawave
+(по ней показывается «Моя подписка»), и копия расходится с панелью:
+подписку изменили в панели, пользователя пересоздали, запись в БД после
+выдачи не прошла. reconcile_worker обходит всех пользователей Remnawave
+страницами и исправляет расхождения.
+
+Один проход (reconcile_pass):
+- берёт RECONCILE_PAGES страниц GET /users начиная с курсора
+  (sync_cursors, name=remnawave_users), не больше RECONCILE_CONCURRENCY
+  запросов одновременно;
+- каждую полученную страницу сразу сравнивает с users по tg_id
+  (username tg_{tg_id}) одним запросом к БД — без GET на пользователя;
+  в памяти не больше RECONCILE_CONCURRENCY страниц;
+- расхождения страницы записывает одной пачкой; строки, записанные после
+  чтения страницы (продление во время сверки), не перезаписываются;
+- сдвигает курсор до первой неудачной страницы, а дойдя до конца списка,
+  начинает сначала.
+
+Курсор — смещение в списке: если пользователя удалили из панели во время
+обхода, соседний может быть пропущен до следующего круга. Удалённые из
+Remnawave пользователи обходом не обнаруживаются — для них при следующей
+выдаче сработает поиск по username (RemnawaveClient.find_user).
+
+Метрики (см. metrics.py):
+    reconcile_users_checked    — пользователей Remnawave сверено
+    reconcile_drift_expire_at  — расхождений даты окончания
+    reconcile_drift_uuid       — расхождений UUID
+    reconcile_drift_url        — расхождений ссылки подписки
+    reconcile_users_repaired   — пользователей исправлено в БД
+    reconcile_page_errors      — страниц, которые не удалось сверить
+    reconcile_position         — курсор (gauge)
+    reconcile_total            — пользователей в Remnawave (gauge)
+    reconcile_pass_seconds     — длительность прохода
+"""
+
+import asyncio
+import logging
+import re
+import time
+
+import aiohttp
+
+from config import RECONCILE_INTERVAL, RECONCILE_PAGE_SIZE, RECONCILE_PAGES, RECONCILE_CONCURRENCY
+import async_database as db
+import metrics
+from services.remnawave import RemnawaveClient, parse_expire_at, remnawave_unavailable
+
+CURSOR = "remnawave_users"
+
+_USERNAME = re.compile(r"tg_(\d+)")
+
+
+def _tg_id(user: dict) -> int | None:
+    match = _USERNAME.fullmatch(user.get("username") or "")
+    return int(match.group(1)) if match else None
+
+
+def diff_page(users: list[dict], local: dict) -> list[tuple]:
+    """
+    Найти расхождения страницы пользователей Remnawave с users
+
+    Args:
+        users: Пользователи Remnawave одной страницы
+        local: get_subscription_states для tg_id этой страницы
+
+    Returns:
+        Исправления для sync_subscriptions:
+        [(tg_id, remnawave_uuid, remnawave_username, subscription_until ISO, subscription_url)]
+    """
+    repairs = []
+    for user in users:
+        tg_id = _tg_id(user)
+        if tg_id not in local or not user.get("uuid"):
+            continue
+        local_uuid, local_until, local_url = local[tg_id]
+        expire_at = parse_expire_at(user.get("expireAt"))
+        remote_until = int(expire_at.timestamp()) if expire_at else None
+        sub_url = user.get("subscriptionUrl")
+
+        drift = []
+        if local_uuid != user["uuid"]:
+            drift.append("uuid")
+        if local_until != remote_until:
+            drift.append("expire_at")
+        if sub_url and local_url != sub_url:
+            drift.append("url")
+        if not drift:
+            continue
+
+        for field in drift:
+            metrics.inc(f"reconcile_drift_{field}")
+        repairs.append((
+            tg_id,
+            user["uuid"],
+            user["username"],
+            expire_at.isoformat() if expire_at else None,
+            sub_url
+        ))
+    return repairs
+
+
+async def _check_page(
+    client: RemnawaveClient,
+    start: int,
+    size: int,
+    semaphore: asyncio.Semaphore
+) -> tuple[int, int, int]:
+    """
+    Получить страницу, сверить с users и записать исправления
+
+    Returns:
+        (пользователей в странице, исправлено, всего пользователей в Remnawave)
+    """
+    async with semaphore:
+        # Всё, что записано в users начиная с этой секунды, новее страницы
+        synced_before = int(time.time())
+        users, total = await client.list_users(start, size)
+
+    tg_ids = [tg_id for tg_id in map(_tg_id, users) if tg_id is not None]
+    local = await db.get_subscription_states(tg_ids)
+    repaired = await db.sync_subscriptions(diff_page(users, local), synced_before)
+
+    metrics.inc("reconcile_users_checked", len(users))
+    if repaired:
+        metrics.inc("reconcile_users_repaired", repaired)
+    return len(users), repaired, total
+
+
+async def reconcile_pass(
+    remnawave: aiohttp.ClientSession,
+    pages: int = RECONCILE_PAGES,
+    page_size: int = RECONCILE_PAGE_SIZE,
+    concurrency: int = RECONCILE_CONCURRENCY
+) -> dict:
+    """
+    Сверить следующие pages страниц пользователей Remnawave
+
+    Args:
+        remnawave: Сессия Remnawave (http_clients.remnawave)
+        pages: Сколько страниц сверить
+        page_size: Размер страницы
+        concurrency: Сколько страниц запрашивать одновременно
+
+    Returns:
+        {"checked", "repaired", "position", "total"} — position — курсор после прохода
+    """
+    started = time.monotonic()
+    client = RemnawaveClient(remnawave)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    position = await db.get_sync_cursor(CURSOR)
+
+    # Первая страница сообщает размер списка — остальные запрашиваются только в его пределах
+    try:
+        checked, repaired, total = await _check_page(client, position, page_size, semaphore)
+    except Exception as e:
+        metrics.inc("reconcile_page_errors")
+        logging.error(f"Reconciliation page at {position} failed: {e}")
+        return {"checked": 0, "repaired": 0, "position": position, "total": None}
+
+    starts = [position + i * page_size for i in range(1, pages)]
+    starts = [start for start in starts if start < total]
+    results = await asyncio.gather(
+        *(_check_page(client, start, page_size, semaphore) for start in starts),
+        return_exceptions=True
+    )
+
+    end = position + checked
+    complete = checked < page_size
+    if not complete:
+        for start, result in zip(starts, results):
+            if isinstance(result, BaseException):
+                metrics.inc("reconcile_page_errors")
+                logging.error(f"Reconciliation page at {start} failed: {result}")
+                # Курсор — до первой неудачной страницы: следующий проход начнёт с неё
+                break
+            page_checked, page_repaired, _ = result
+            checked += page_checked
+            repaired += page_repaired
+            end = start + page_checked
+            if page_checked < page_size:
+                complete = True
+                break
+        else:
+            complete = end >= total
+
+    # Курсор, ушедший за конец списка (пользователей удалили), тоже начинает новый круг
+    new_position = 0 if complete or end >= total else end
+    await db.set_sync_cursor(CURSOR, new_position)
+
+    metrics.set_gauge("reconcile_position", new_position)
+    metrics.set_gauge("reconcile_total", total)
+    metrics.observe("reconcile_pass_seconds", time.monotonic() - started)
+    if repaired:
+        logging.info(f"Reconciliation repaired {repaired} of {checked} users (position {position} → {new_position})")
+    if new_position == 0:
+        logging.info(f"Reconciliation round over {total} Remnawave users complete")
+    return {"checked": checked, "repaired": repaired, "position": new_position, "total": total}
+
+
+async def reconcile_worker(remnawave: aiohttp.ClientSession, interval: float = RECONCILE_INTERVAL):
+    """
+    Фоновая задача: сверяет users с Remnawave порциями каждые interval секунд
+
+    Args:
+        remnawave: Сессия Remnawave (http_clients.remnawave)
+        interval: Пауза между проходами, сек
+    """
+    while True:
+        if remnawave_unavailable():
+            await asyncio.sleep(interval)
+            continue
+        try:
+            await reconcile_pass(remnawave)
+        except Exception as e:
+            logging.error(f"Reconciliation error: {e}")
+        await asyncio.sleep(interval)
@@ -1,147 +1,326 @@
+import asyncio
 import aiohttp
 import logging
 import secrets
 import string
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from config import REMNAWAVE_BASE_URL, REMNAWAVE_API_TOKEN, DEFAULT_SQUAD_UUID
+from config import (
+    REMNAWAVE_BASE_URL,
+    DEFAULT_SQUAD_UUID,
+    SINGLE_FLIGHT_TTL,
+    SQUAD_BATCH_WINDOW,
+    SQUAD_BATCH_SIZE,
+    REMNAWAVE_CONNECT_TIMEOUT,
+    REMNAWAVE_READ_TIMEOUT
+)
+import deadline
+import http_clients
+from micro_batch import MicroBatcher
+from single_flight import SingleFlight
 
 
-async def remnawave_get_or_create_user(
-    session: aiohttp.ClientSession,
-    tg_id: int,
-    days: int = 30,
-    extend_if_exists: bool = False
-) -> tuple[str | None, str | None]:
+# GET /users/{uuid}: одновременные запросы одного пользователя объединяются
+_user_info = SingleFlight("remnawave_user", SINGLE_FLIGHT_TTL)
+
+
+def _timeout() -> aiohttp.ClientTimeout:
+    """Таймауты запроса к Remnawave с учётом дедлайна обработчика"""
+    return deadline.client_timeout("remnawave", REMNAWAVE_CONNECT_TIMEOUT, REMNAWAVE_READ_TIMEOUT)
+
+
+# Ответ пользователю, когда действие требует Remnawave, а цепь разомкнута
+DEGRADED_TEXT = "⏳ Сервис подписок временно недоступен. Попробуй через пару минут."
+
+
+def remnawave_unavailable() -> bool:
     """
-    Получить или создать пользователя в Remnawave API
-    
-    Args:
-        session: aiohttp сессия
-        tg_id: ID пользователя Telegram
-        days: Количество дней подписки для новых пользователей
-        extend_if_exists: Продлить подписку если пользователь существует
-        
-    Returns:
-        Кортеж (UUID пользователя, имя пользователя) или (None, None)
+    Remnawave недоступен: цепь разомкнута, запросы к нему сейчас сразу
+    завершаются CircuitOpenError
+
+    Обработчики в этом случае показывают данные из БД, а оплаченные
+    активации остаются в outbox до восстановления панели.
     """
-    remna_username = f"tg_{tg_id}"
+    return http_clients.remnawave_breaker.is_open
 
-    url = f"{REMNAWAVE_BASE_URL}/users/by-username/{remna_username}"
-    headers = {"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
 
-    try:
-        async with session.get(url, headers=headers) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                user_data = data.get("response", {})
-                uuid = user_data.get("uuid")
-                if uuid:
-                    if extend_if_exists:
-                        await remnawave_extend_subscription(session, uuid, days)
-                    return uuid, remna_username
-    except Exception as e:
-        logging.error(f"Get existing user error: {e}")
+class RemnawaveError(Exception):
+    """Remnawave API ответил ошибкой"""
+
+
+@dataclass
+class ProvisionResult:
+    uuid: str
+    username: str
+    expire_at: str  # ISO, новая дата окончания подписки
+    subscription_url: str | None
 
-    # Создаём нового пользователя если не нашли существующего
-    create_url = f"{REMNAWAVE_BASE_URL}/users"
+
+def _generate_password() -> str:
     alphabet = string.ascii_letters + string.digits
-    password = (
+    return (
         secrets.choice(string.ascii_uppercase) +
         secrets.choice(string.ascii_lowercase) +
         secrets.choice(string.digits) +
         ''.join(secrets.choice(alphabet) for _ in range(21))
     )
 
-    expire_at = (datetime.now(timezone.utc) + timedelta(days=days)).isoformat()
 
-    payload = {
-        "username": remna_username,
-        "password": password,
-        "expireAt": expire_at
-    }
+def parse_expire_at(value: str | None) -> datetime | None:
+    """Разобрать expireAt из ответа Remnawave"""
+    if not value:
+        return None
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
 
-    headers = {
-        "Authorization": f"Bearer {REMNAWAVE_API_TOKEN}",
-        "Content-Type": "application/json"
-    }
 
-    try:
-        async with session.post(create_url, headers=headers, json=payload) as resp:
-            if resp.status in (200, 201):
-                data = await resp.json()
-                user_data = data.get("response", {})
-                uuid = user_data.get("uuid")
-                if uuid:
-                    logging.info(f"Created new Remnawave user: {remna_username}")
-                    return uuid, remna_username
-            else:
-                logging.error(f"Create user failed ({resp.status}): {await resp.text()}")
-    except Exception as e:
-        logging.error(f"Create user exception: {e}")
+def extend_expire_at(current: str | None, days: int) -> str:
+    """Дата окончания после продления на days: от текущей, если подписка ещё активна"""
+    now = datetime.now(timezone.utc)
+    base = max(parse_expire_at(current) or now, now)
+    return (base + timedelta(days=days)).isoformat()
 
-    return None, None
 
+def squad_uuids(user: dict) -> list[str]:
+    """UUID сквадов пользователя (activeInternalSquads — объекты или строки)"""
+    return [
+        squad.get("uuid") if isinstance(squad, dict) else squad
+        for squad in user.get("activeInternalSquads") or []
+    ]
 
-async def remnawave_extend_subscription(
-    session: aiohttp.ClientSession,
-    user_uuid: str,
-    days: int
-) -> bool:
+
+class RemnawaveClient:
     """
-    Продлить подписку пользователя в Remnawave
-    
-    Args:
-        session: aiohttp сессия
-        user_uuid: UUID пользователя в Remnawave
-        days: Количество дней для продления
-        
-    Returns:
-        True если успешно, False иначе
+    Клиент Remnawave API поверх общей сессии (http_clients.remnawave)
+
+    Методы бросают RemnawaveError, если API ответил ошибкой, и различают
+    «пользователь не найден» (None) и сбой API — повтор после сбоя не
+    создаёт пользователя заново.
     """
-    try:
-        # 1. Получаем текущий expireAt
-        async with session.get(
-            f"{REMNAWAVE_BASE_URL}/users/{user_uuid}",
-            headers={"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
-        ) as resp:
+
+    def __init__(self, session: aiohttp.ClientSession):
+        self.session = session
+
+    async def find_by_username(self, tg_id: int) -> dict | None:
+        """
+        Найти пользователя по Telegram ID (GET /users/by-username/tg_{tg_id})
+
+        Returns:
+            Данные пользователя (uuid, username, expireAt, subscriptionUrl,
+            activeInternalSquads …) или None
+        """
+        async with self.session.get(f"{REMNAWAVE_BASE_URL}/users/by-username/tg_{tg_id}", timeout=_timeout()) as resp:
+            if resp.status == 404:
+                return None
             if resp.status != 200:
-                logging.error(f"Get user failed ({resp.status}): {await resp.text()}")
-                return False
+                raise RemnawaveError(f"Find user failed ({resp.status}): {await resp.text()}")
+            data = await resp.json()
+            return data.get("response") or None
 
+    async def get_user(self, user_uuid: str) -> dict | None:
+        """
+        Получить пользователя по UUID (GET /users/{uuid}) в обход кэша
+
+        Для изменений нужен актуальный expireAt, поэтому запрос не идёт
+        через single-flight remnawave_get_user_info.
+
+        Returns:
+            Данные пользователя или None, если UUID не найден
+        """
+        async with self.session.get(f"{REMNAWAVE_BASE_URL}/users/{user_uuid}", timeout=_timeout()) as resp:
+            if resp.status == 404:
+                return None
+            if resp.status != 200:
+                raise RemnawaveError(f"Get user failed ({resp.status}): {await resp.text()}")
             data = await resp.json()
-            current_expire = data["response"].get("expireAt")
-            if not current_expire:
-                logging.error("expireAt not found in response")
-                return False
+            return data.get("response") or None
+
+    async def list_users(self, start: int, size: int) -> tuple[list[dict], int]:
+        """
+        Страница списка пользователей (GET /users?start=&size=)
+
+        Args:
+            start: Смещение от начала списка
+            size: Размер страницы
+
+        Returns:
+            (пользователи страницы, всего пользователей в панели)
+        """
+        params = {"start": start, "size": size}
+        async with self.session.get(f"{REMNAWAVE_BASE_URL}/users", params=params, timeout=_timeout()) as resp:
+            if resp.status != 200:
+                raise RemnawaveError(f"List users failed ({resp.status}): {await resp.text()}")
+            data = (await resp.json()).get("response") or {}
+            return data.get("users") or [], int(data.get("total") or 0)
 
-        # 2. Считаем новую дату
-        current_dt = datetime.fromisoformat(current_expire.replace("Z", "+00:00"))
-        new_expire = current_dt + timedelta(days=days)
+    async def find_user(self, tg_id: int, user_uuid: str | None = None) -> dict | None:
+        """
+        Найти пользователя: по UUID из БД, если он известен, иначе по username
 
+        К поиску по username переходим только если UUID не найден (404) —
+        например, пользователя удалили в панели.
+        """
+        if user_uuid:
+            user = await self.get_user(user_uuid)
+            if user is not None:
+                return user
+            logging.warning(f"Remnawave user {user_uuid} not found, looking up tg_{tg_id} by username")
+        return await self.find_by_username(tg_id)
+
+    async def create_user(self, tg_id: int, expire_at: str, squads: list[str] = ()) -> dict:
+        """
+        Создать пользователя с датой окончания подписки и сквадами (POST /users)
+
+        Returns:
+            Данные созданного пользователя
+        """
         payload = {
-            "uuid": user_uuid,
-            "expireAt": new_expire.isoformat()
+            "username": f"tg_{tg_id}",
+            "password": _generate_password(),
+            "expireAt": expire_at
         }
+        if squads:
+            payload["activeInternalSquads"] = list(squads)
 
-        # 3. PATCH /users для обновления
-        async with session.patch(
-            f"{REMNAWAVE_BASE_URL}/users",
-            headers={
-                "Authorization": f"Bearer {REMNAWAVE_API_TOKEN}",
-                "Content-Type": "application/json"
-            },
-            json=payload
-        ) as resp:
-            if resp.status == 200:
-                logging.info(f"Extended subscription for {user_uuid} by {days} days")
-                return True
+        async with self.session.post(f"{REMNAWAVE_BASE_URL}/users", json=payload, timeout=_timeout()) as resp:
+            if resp.status not in (200, 201):
+                raise RemnawaveError(f"Create user failed ({resp.status}): {await resp.text()}")
+            data = await resp.json()
+        user_data = data.get("response") or {}
+        if not user_data.get("uuid"):
+            raise RemnawaveError("Create user response has no uuid")
+        logging.info(f"Created new Remnawave user: tg_{tg_id}")
+        return user_data
+
+    async def update_user(self, user: dict, expire_at: str | None = None, squads: list[str] | None = None) -> dict:
+        """
+        Изменить дату окончания и/или сквады одним PATCH /users
+
+        expire_at — абсолютная дата: повтор с тем же значением ничего не
+        меняет. squads заменяет список сквадов целиком.
 
-            logging.error(f"Extend failed ({resp.status}): {await resp.text()}")
-            return False
+        Args:
+            user: Текущие данные пользователя (нужен uuid)
+            expire_at: Новая дата окончания подписки (ISO)
+            squads: Полный список UUID сквадов
 
+        Returns:
+            Данные пользователя после изменения
+        """
+        payload = {"uuid": user["uuid"]}
+        if expire_at is not None:
+            payload["expireAt"] = expire_at
+        if squads is not None:
+            payload["activeInternalSquads"] = list(squads)
+
+        try:
+            async with self.session.patch(f"{REMNAWAVE_BASE_URL}/users", json=payload, timeout=_timeout()) as resp:
+                if resp.status != 200:
+                    raise RemnawaveError(f"Update user failed ({resp.status}): {await resp.text()}")
+                data = await resp.json()
+        finally:
+            # Чтение, начатое до PATCH, не должно остаться в кэше
+            _user_info.forget(user["uuid"])
+
+        logging.info(f"Updated Remnawave user {user['uuid']} (expireAt={expire_at}, squads={squads})")
+        # Если ответ без тела пользователя — дополняем известными данными
+        return {**user, **{k: v for k, v in payload.items() if k != "uuid"}, **(data.get("response") or {})}
+
+    async def provision(
+        self,
+        tg_id: int,
+        days: int,
+        squad_uuid: str = DEFAULT_SQUAD_UUID,
+        user_uuid: str | None = None
+    ) -> ProvisionResult:
+        """
+        Выдать или продлить подписку и добавить в сквад
+
+        Пользователь ищется по user_uuid (users.remnawave_uuid), а по
+        username — только если UUID не передан или не найден. Найденный
+        пользователь (с его expireAt, сквадами и ссылкой) используется
+        повторно: продление и сквад — один PATCH, новый пользователь
+        создаётся сразу со сквадом. Итого 2 запроса; третий (GET ссылки) —
+        только если ссылки нет в ответах.
+
+        Args:
+            tg_id: ID пользователя Telegram
+            days: На сколько дней продлить (от текущей даты окончания, если она в будущем)
+            squad_uuid: UUID сквада; пустой — не менять сквады
+            user_uuid: UUID пользователя из БД, если уже известен
+
+        Returns:
+            ProvisionResult с uuid, username, новой датой окончания и ссылкой
+
+        Raises:
+            RemnawaveError: API ответил ошибкой
+        """
+        user = await self.find_user(tg_id, user_uuid)
+
+        if user is None:
+            expire_at = extend_expire_at(None, days)
+            user = await self.create_user(tg_id, expire_at, [squad_uuid] if squad_uuid else [])
+        else:
+            expire_at = extend_expire_at(user.get("expireAt"), days)
+            squads = squad_uuids(user)
+            new_squads = squads + [squad_uuid] if squad_uuid and squad_uuid not in squads else None
+            user = await self.update_user(user, expire_at, new_squads)
+
+        sub_url = user.get("subscriptionUrl") or await remnawave_get_subscription_url(self.session, user["uuid"])
+        return ProvisionResult(
+            uuid=user["uuid"],
+            username=user.get("username") or f"tg_{tg_id}",
+            expire_at=expire_at,
+            subscription_url=sub_url
+        )
+
+
+async def _post_add_users(session: aiohttp.ClientSession, squad_uuid: str, user_uuids: list[str]) -> int | None:
+    """POST /internal-squads/{squad}/bulk-actions/add-users; статус ответа или None при сетевой ошибке"""
+    url = f"{REMNAWAVE_BASE_URL}/internal-squads/{squad_uuid}/bulk-actions/add-users"
+    try:
+        async with session.post(url, json={"userUuids": user_uuids}, timeout=_timeout()) as resp:
+            if resp.status in (200, 201):
+                logging.info(f"Added {len(user_uuids)} users to squad {squad_uuid}")
+            else:
+                logging.error(f"Add {len(user_uuids)} users to squad failed: {resp.status} → {await resp.text()}")
+            return resp.status
     except Exception as e:
-        logging.exception(f"Extend subscription exception: {e}")
-        return False
+        logging.error(f"Add to squad exception: {e}")
+        return None
+
+
+async def _add_users_to_squad(session: aiohttp.ClientSession, squad_uuid: str, user_uuids: list[str]) -> dict:
+    """
+    Добавить пачку пользователей в сквад
+
+    Bulk-эндпоинт отвечает об успехе всей пачки. Если пачку отклонили
+    (4xx — например, один UUID удалён), она делится пополам, чтобы
+    неверный UUID не лишил сквада остальных.
+
+    Returns:
+        {user_uuid: True/False}
+    """
+    status = await _post_add_users(session, squad_uuid, user_uuids)
+    if status in (200, 201):
+        return dict.fromkeys(user_uuids, True)
+    if status is not None and 400 <= status < 500 and len(user_uuids) > 1:
+        middle = len(user_uuids) // 2
+        left, right = await asyncio.gather(
+            _add_users_to_squad(session, squad_uuid, user_uuids[:middle]),
+            _add_users_to_squad(session, squad_uuid, user_uuids[middle:])
+        )
+        return {**left, **right}
+    return dict.fromkeys(user_uuids, False)
+
+
+async def _flush_squad_adds(group: tuple, user_uuids: list[str]) -> dict:
+    session, squad_uuid = group
+    return await _add_users_to_squad(session, squad_uuid, user_uuids)
+
+
+# Добавления в сквад копятся SQUAD_BATCH_WINDOW секунд и уходят одним запросом на сквад
+_squad_adds = MicroBatcher("remnawave_squad_add", _flush_squad_adds, SQUAD_BATCH_WINDOW, SQUAD_BATCH_SIZE)
 
 
 async def remnawave_add_to_squad(
@@ -151,33 +330,23 @@ async def remnawave_add_to_squad(
 ) -> bool:
     """
     Добавить пользователя в сквад
-    
+
+    Одновременные добавления в один сквад объединяются в один
+    bulk-запрос (не дольше SQUAD_BATCH_WINDOW секунд, не больше
+    SQUAD_BATCH_SIZE пользователей).
+
     Args:
-        session: aiohttp сессия
+        session: Сессия Remnawave (http_clients.remnawave)
         user_uuid: UUID пользователя в Remnawave
         squad_uuid: UUID сквада для добавления
-        
+
     Returns:
         True если успешно, False иначе
     """
-    url = f"{REMNAWAVE_BASE_URL}/internal-squads/{squad_uuid}/bulk-actions/add-users"
-    payload = {"userUuids": [user_uuid]}
-    headers = {
-        "Authorization": f"Bearer {REMNAWAVE_API_TOKEN}",
-        "Content-Type": "application/json"
-    }
-
-    try:
-        async with session.post(url, headers=headers, json=payload) as resp:
-            if resp.status in (200, 201):
-                logging.info(f"Added user {user_uuid} to squad {squad_uuid}")
-                return True
-            else:
-                logging.error(f"Add to squad failed: {resp.status} → {await resp.text()}")
-    except Exception as e:
-        logging.error(f"Add to squad exception: {e}")
-    
-    return False
+    added = bool(await _squad_adds.submit((session, squad_uuid), user_uuid))
+    if added:
+        _user_info.forget(user_uuid)
+    return added
 
 
 async def remnawave_get_subscription_url(
@@ -188,27 +357,15 @@ async def remnawave_get_subscription_url(
     Получить ссылку подписки пользователя
     
     Args:
-        session: aiohttp сессия
+        session: Сессия Remnawave (http_clients.remnawave)
         user_uuid: UUID пользователя в Remnawave
         
     Returns:
         Ссылка подписки или None
     """
-    url = f"{REMNAWAVE_BASE_URL}/users/{user_uuid}"
-    headers = {"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
-
-    try:
-        async with session.get(url, headers=headers) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                sub_url = data.get("response", {}).get("subscriptionUrl")
-                if sub_url:
-                    return sub_url
-            else:
-                logging.error(f"Get subscription URL failed ({resp.status})")
-    except Exception as e:
-        logging.error(f"Get subscription URL exception: {e}")
-
+    user_data = await remnawave_get_user_info(session, user_uuid)
+    if user_data:
+        return user_data.get("subscriptionUrl") or None
     return None
 
 
@@ -219,21 +376,29 @@ async def remnawave_get_user_info(
     """
     Получить информацию о пользователе из Remnawave
     
+    Параллельные вызовы для одного UUID ждут один запрос, результат
+    переиспользуется SINGLE_FLIGHT_TTL секунд. Изменение expireAt через
+    этот модуль сбрасывает сохранённый результат.
+
     Args:
-        session: aiohttp сессия
+        session: Сессия Remnawave (http_clients.remnawave)
         user_uuid: UUID пользователя в Remnawave
         
     Returns:
         Словарь с информацией пользователя или None
     """
+    return await _user_info.do(user_uuid, lambda: _fetch_user_info(session, user_uuid))
+
+
+async def _fetch_user_info(session: aiohttp.ClientSession, user_uuid: str) -> dict | None:
     url = f"{REMNAWAVE_BASE_URL}/users/{user_uuid}"
-    headers = {"Authorization": f"Bearer {REMNAWAVE_API_TOKEN}"}
 
     try:
-        async with session.get(url, headers=headers) as resp:
+        async with session.get(url, timeout=_timeout()) as resp:
             if resp.status == 200:
                 data = await resp.json()
                 return data.get("response", {})
+            logging.error(f"Get user info failed ({resp.status})")
     except Exception as e:
         logging.error(f"Get user info exception: {e}")
 
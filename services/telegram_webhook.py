@@ -0,0 +1,227 @@
+"""
+Приём обновлений Telegram через вебхук.
+
+Режим включается TELEGRAM_WEBHOOK_URL (см. main.main), без него бот
+работает long polling. Telegram отправляет каждое обновление POST-запросом
+с заголовком X-Telegram-Bot-Api-Secret-Token — он должен совпадать с
+TELEGRAM_WEBHOOK_SECRET, иначе запрос отклоняется (401).
+
+Обработчик HTTP только проверяет секрет, разбирает обновление и ставит
+его в очередь UpdatePool; обработку выполняют UPDATE_WORKERS воркеров.
+Очередь ограничена UPDATE_QUEUE_SIZE: если она заполнена дольше
+UPDATE_ENQUEUE_TIMEOUT секунд, Telegram получает 503 и повторит доставку
+позже. Одновременно Telegram держит не больше
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS запросов, так что ожидание места в
+очереди замедляет и его.
+
+Бюджет обработчика (deadline.py) отсчитывается от получения обновления:
+время в очереди вычитается из HANDLER_DEADLINE.
+
+Метрики (см. metrics.py):
+    telegram_updates_received      — принятых обновлений
+    telegram_updates_rejected      — отклонённых из-за заполненной очереди (503)
+    telegram_webhook_unauthorized  — запросов с неверным секретом
+    telegram_update_errors         — обновлений, обработка которых упала
+    telegram_update_queue          — обновлений в очереди (gauge)
+    telegram_update_workers_busy   — занятых воркеров (gauge)
+    telegram_update_wait_seconds   — ожидание в очереди
+    telegram_update_seconds        — от получения обновления до конца обработки
+"""
+
+import asyncio
+import hmac
+import json
+import logging
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+from pydantic import ValidationError
+
+from config import (
+    TELEGRAM_WEBHOOK_URL,
+    TELEGRAM_WEBHOOK_PATH,
+    TELEGRAM_WEBHOOK_SECRET,
+    TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+    UPDATE_WORKERS,
+    UPDATE_QUEUE_SIZE,
+    UPDATE_ENQUEUE_TIMEOUT,
+    HANDLER_DEADLINE
+)
+import deadline
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Обновление, получившее место в очереди последним моментом, всё равно
+# получает хотя бы столько секунд на обработку
+MIN_BUDGET = 1.0
+
+
+class UpdatePool:
+    """Ограниченная очередь обновлений Telegram и фиксированное число воркеров"""
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        workers: int = UPDATE_WORKERS,
+        queue_size: int = UPDATE_QUEUE_SIZE,
+        enqueue_timeout: float = UPDATE_ENQUEUE_TIMEOUT
+    ):
+        """
+        Args:
+            dp: Диспетчер с зарегистрированными обработчиками
+            bot: Экземпляр Bot
+            workers: Сколько обновлений обрабатывается одновременно
+            queue_size: Сколько обновлений может ждать обработки
+            enqueue_timeout: Сколько секунд ждать места в заполненной очереди
+        """
+        self.dp = dp
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.enqueue_timeout = enqueue_timeout
+        self._queue: asyncio.Queue[tuple[Update, float]] = asyncio.Queue(max(1, queue_size))
+        self._tasks: list[asyncio.Task] = []
+        self._busy = 0
+
+    def start(self):
+        """Запустить воркеров"""
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self, timeout: float = HANDLER_DEADLINE):
+        """Дождаться обработки очереди (не дольше timeout секунд) и остановить воркеров"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stopping update pool with {self._queue.qsize()} updates still queued")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def submit(self, update: Update, received: float) -> bool:
+        """
+        Поставить обновление в очередь
+
+        Args:
+            update: Обновление Telegram
+            received: time.monotonic() получения обновления
+
+        Returns:
+            True если обновление принято, False если очередь осталась заполненной
+        """
+        try:
+            self._queue.put_nowait((update, received))
+        except asyncio.QueueFull:
+            # Очередь заполнена — ждём места не дольше enqueue_timeout
+            try:
+                await asyncio.wait_for(self._queue.put((update, received)), self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                return False
+        metrics.set_gauge("telegram_update_queue", self._queue.qsize())
+        return True
+
+    async def _worker(self):
+        while True:
+            update, received = await self._queue.get()
+            waited = time.monotonic() - received
+            metrics.set_gauge("telegram_update_queue", self._queue.qsize())
+            metrics.observe("telegram_update_wait_seconds", waited)
+            self._busy += 1
+            metrics.set_gauge("telegram_update_workers_busy", self._busy)
+            try:
+                # Ожидание в очереди входит в бюджет: ответ на кнопку Telegram ждёт от нажатия
+                with deadline.budget(max(HANDLER_DEADLINE - waited, MIN_BUDGET) if HANDLER_DEADLINE else None):
+                    await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                metrics.inc("telegram_update_errors")
+                logger.error(f"Update {update.update_id} failed: {e}")
+            finally:
+                self._busy -= 1
+                metrics.set_gauge("telegram_update_workers_busy", self._busy)
+                metrics.observe("telegram_update_seconds", time.monotonic() - received)
+                self._queue.task_done()
+
+
+def verify_secret(header: str | None, secret: str = TELEGRAM_WEBHOOK_SECRET) -> bool:
+    """Проверить секрет вебхука Telegram"""
+    if not header or not secret:
+        return False
+    return hmac.compare_digest(header.encode(), secret.encode())
+
+
+def create_webhook_app(pool: UpdatePool, path: str = TELEGRAM_WEBHOOK_PATH) -> web.Application:
+    """
+    Создать aiohttp-приложение с обработчиком вебхука
+
+    Args:
+        pool: Пул, в который ставятся обновления
+        path: Путь вебхука
+
+    Returns:
+        web.Application с маршрутом path
+    """
+    async def handle_update(request: web.Request) -> web.Response:
+        received = time.monotonic()
+
+        if not verify_secret(request.headers.get(SECRET_HEADER)):
+            metrics.inc("telegram_webhook_unauthorized")
+            logger.warning(f"Rejected Telegram webhook with bad secret from {request.remote}")
+            return web.Response(status=401)
+
+        try:
+            update = Update.model_validate(json.loads(await request.read()), context={"bot": pool.bot})
+        except (ValueError, ValidationError):
+            return web.Response(status=400)
+
+        if not await pool.submit(update, received):
+            metrics.inc("telegram_updates_rejected")
+            return web.Response(status=503)
+
+        metrics.inc("telegram_updates_received")
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+
+async def start_webhook_server(dp: Dispatcher, bot: Bot, host: str, port: int) -> tuple[web.AppRunner, UpdatePool]:
+    """
+    Запустить пул воркеров и HTTP-сервер вебхука и зарегистрировать вебхук в Telegram
+
+    Returns:
+        (runner, pool) для stop_webhook_server
+    """
+    if not TELEGRAM_WEBHOOK_SECRET:
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET is required for webhook mode")
+
+    pool = UpdatePool(dp, bot)
+    pool.start()
+    runner = web.AppRunner(create_webhook_app(pool), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    await bot.set_webhook(
+        f"{TELEGRAM_WEBHOOK_URL.rstrip('/')}{TELEGRAM_WEBHOOK_PATH}",
+        secret_token=TELEGRAM_WEBHOOK_SECRET,
+        max_connections=TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info(
+        f"Telegram webhook listening on {host}:{port}{TELEGRAM_WEBHOOK_PATH} "
+        f"(workers={pool.workers}, queue={UPDATE_QUEUE_SIZE})"
+    )
+    return runner, pool
+
+
+async def stop_webhook_server(runner: web.AppRunner, pool: UpdatePool):
+    """Остановить приём обновлений и дождаться обработки принятых"""
+    # Вебхук в Telegram не удаляется: обновления подождут у Telegram до перезапуска
+    await runner.cleanup()
+    await pool.stop()
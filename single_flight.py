@@ -0,0 +1,84 @@
+"""
+Объединение одновременных запросов к одному внешнему ресурсу.
+
+Пока запрос по ключу (ID счёта, UUID пользователя Remnawave) в пути,
+остальные вызывающие ждут его же результат, а не отправляют свой.
+Полученный результат ещё ttl секунд отдаётся из TTLCache, так что
+«Проверить оплату» сразу после фоновой проверки или несколько открытых
+«Моя подписка» подряд не порождают новых HTTP-запросов.
+
+Метрики (см. metrics.py):
+    <name>_singleflight_shared — вызовов, присоединившихся к запросу в пути
+    <name>_cache_hits / <name>_cache_misses — ответы из кэша результатов
+"""
+
+import asyncio
+
+import deadline
+import metrics
+from cache import TTLCache
+
+
+_MISSING = object()
+
+
+class SingleFlight:
+    """Один запрос в пути на ключ плюс короткий кэш результата"""
+
+    def __init__(self, name: str, ttl: float, maxsize: int = 10000):
+        self.name = name
+        self._results = TTLCache(name, maxsize, ttl)
+        self._in_flight: dict = {}  # key -> asyncio.Task
+
+    async def do(self, key, loader):
+        """
+        Получить результат loader() для ключа, разделив запрос с параллельными вызовами
+
+        Запрос выполняется в отдельной задаче: отмена одного из ожидающих
+        или истечение его дедлайна не отменяет запрос для остальных. None и исключения не кэшируются,
+        исключение получают все, кто ждал этот запрос.
+
+        Args:
+            key: Ключ ресурса
+            loader: Корутинная функция без аргументов, выполняющая запрос
+
+        Returns:
+            Результат loader()
+        """
+        value = self._results.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        task = self._in_flight.get(key)
+        if task is None:
+            # Запрос общий — он не ограничен дедлайном того, кто пришёл первым
+            with deadline.unbounded():
+                task = asyncio.create_task(loader())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            metrics.inc(f"{self.name}_singleflight_shared")
+
+        # Каждый ждёт не дольше своего остатка дедлайна
+        return await asyncio.wait_for(asyncio.shield(task), deadline.remaining())
+
+    def set(self, key, value):
+        """Положить уже известный результат (например, из пакетного запроса)"""
+        if value is not None:
+            self._results.set(key, value)
+
+    def forget(self, key):
+        """Сбросить результат; запрос, идущий сейчас, не попадёт в кэш"""
+        self._results.invalidate(key)
+        self._in_flight.pop(key, None)
+
+    def _finish(self, key, task: asyncio.Task):
+        # Задачу могли сбросить через forget — тогда результат устарел
+        current = self._in_flight.get(key) is task
+        if current:
+            del self._in_flight[key]
+        if task.cancelled():
+            return
+        # Читаем исключение, даже если его никто не ждал
+        if task.exception() is None and current:
+            self.set(key, task.result())
@@ -41,6 +41,19 @@ def init_tables():
         logger.error(f"Failed to initialize tables: {e}")
 
 
+def get_schema_version() -> int | None:
+    """Последняя применённая миграция (schema_migrations) или None, если таблицы нет"""
+    if not is_supabase_enabled():
+        return None
+
+    try:
+        response = supabase_client.table("schema_migrations").select("version").order("version", desc=True).limit(1).execute()
+        return response.data[0]["version"] if response.data else 0
+    except Exception as e:
+        logger.error(f"Error reading schema version: {e}")
+        return None
+
+
 def get_user(tg_id: int):
     """Получить информацию о пользователе из Supabase"""
     if not is_supabase_enabled():
@@ -93,6 +106,40 @@ def create_user(tg_id: int, username: str, referrer_id=None):
         logger.error(f"Error creating user {tg_id}: {e}")
 
 
+def bootstrap_user(tg_id: int, username: str, referrer_id=None) -> tuple:
+    """
+    Создать пользователя при необходимости и вернуть его запись
+
+    Один запрос к RPC-функции bootstrap_user (см. migrations.py): вставка
+    с ON CONFLICT DO NOTHING и увеличение счётчика у пригласившего только
+    для нового пользователя. Если функция ещё не создана в базе,
+    выполняется прежняя последовательность запросов.
+
+    Returns:
+        Кортеж (запись пользователя или None, создан ли пользователь сейчас)
+    """
+    if not is_supabase_enabled():
+        return None, False
+
+    try:
+        response = supabase_client.rpc("bootstrap_user", {
+            "p_tg_id": tg_id,
+            "p_username": username,
+            "p_referrer_id": referrer_id
+        }).execute()
+        data = response.data or {}
+        return data.get("user"), bool(data.get("created"))
+    except Exception as e:
+        logger.warning(f"bootstrap_user RPC failed for {tg_id}, falling back: {e}")
+
+    created = not user_exists(tg_id)
+    if created:
+        create_user(tg_id, username, referrer_id)
+        if referrer_id:
+            update_referral_count(referrer_id)
+    return get_user(tg_id), created
+
+
 def accept_terms(tg_id: int):
     """Пользователь принял условия использования"""
     if not is_supabase_enabled():
@@ -120,23 +167,121 @@ def has_accepted_terms(tg_id: int) -> bool:
         return False
 
 
-def update_subscription(tg_id: int, uuid: str, username: str, subscription_until: str, squad_uuid: str):
+def update_subscription(tg_id: int, uuid: str, username: str, subscription_until: str, squad_uuid: str,
+                        subscription_url: str | None = None):
     """Обновить подписку пользователя"""
     if not is_supabase_enabled():
         return
     
+    from datetime import datetime, timezone
+    fields = {
+        "remnawave_uuid": uuid,
+        "remnawave_username": username,
+        "subscription_until": subscription_until,
+        "squad_uuid": squad_uuid,
+        "subscription_synced_at": datetime.now(timezone.utc).isoformat()
+    }
+    if subscription_url:
+        fields["subscription_url"] = subscription_url
     try:
-        supabase_client.table("users").update({
-            "remnawave_uuid": uuid,
-            "remnawave_username": username,
-            "subscription_until": subscription_until,
-            "squad_uuid": squad_uuid
-        }).eq("tg_id", tg_id).execute()
+        supabase_client.table("users").update(fields).eq("tg_id", tg_id).execute()
         logger.info(f"Subscription updated for user {tg_id}")
     except Exception as e:
         logger.error(f"Error updating subscription for user {tg_id}: {e}")
 
 
+def sync_subscription(tg_id: int, subscription_until: str | None, subscription_url: str | None):
+    """Сохранить состояние подписки, прочитанное из Remnawave"""
+    if not is_supabase_enabled():
+        return
+
+    from datetime import datetime, timezone
+    fields = {
+        "subscription_until": subscription_until,
+        "subscription_synced_at": datetime.now(timezone.utc).isoformat()
+    }
+    if subscription_url:
+        fields["subscription_url"] = subscription_url
+    try:
+        supabase_client.table("users").update(fields).eq("tg_id", tg_id).execute()
+    except Exception as e:
+        logger.error(f"Error syncing subscription for user {tg_id}: {e}")
+
+
+def get_subscription_states(tg_ids: list) -> list:
+    """Состояние подписки пользователей: [(tg_id, remnawave_uuid, subscription_until, subscription_url)]"""
+    if not is_supabase_enabled():
+        return []
+
+    try:
+        response = supabase_client.table("users").select(
+            "tg_id, remnawave_uuid, subscription_until, subscription_url"
+        ).in_("tg_id", list(tg_ids)).execute()
+        return [
+            (row["tg_id"], row["remnawave_uuid"], row["subscription_until"], row["subscription_url"])
+            for row in response.data
+        ]
+    except Exception as e:
+        logger.error(f"Error getting subscription states: {e}")
+        raise
+
+
+def sync_subscriptions(rows: list, synced_before: int) -> int:
+    """Записать исправления сверки пачкой (RPC sync_subscriptions)"""
+    if not is_supabase_enabled():
+        return 0
+
+    from datetime import datetime, timezone
+    payload = [
+        {
+            "tg_id": tg_id,
+            "remnawave_uuid": uuid,
+            "remnawave_username": username,
+            "subscription_until": until,
+            "subscription_url": url
+        }
+        for tg_id, uuid, username, until, url in rows
+    ]
+    try:
+        response = supabase_client.rpc("sync_subscriptions", {
+            "p_rows": payload,
+            "p_synced_before": datetime.fromtimestamp(synced_before, timezone.utc).isoformat()
+        }).execute()
+        return len(response.data or [])
+    except Exception as e:
+        logger.error(f"Error syncing {len(rows)} subscriptions: {e}")
+        raise
+
+
+def get_sync_cursor(name: str) -> int:
+    """Позиция фонового обхода name"""
+    if not is_supabase_enabled():
+        return 0
+
+    try:
+        response = supabase_client.table("sync_cursors").select("position").eq("name", name).execute()
+        return response.data[0]["position"] if response.data else 0
+    except Exception as e:
+        logger.error(f"Error getting sync cursor {name}: {e}")
+        return 0
+
+
+def set_sync_cursor(name: str, position: int):
+    """Сохранить позицию фонового обхода name"""
+    if not is_supabase_enabled():
+        return
+
+    from datetime import datetime, timezone
+    try:
+        supabase_client.table("sync_cursors").upsert({
+            "name": name,
+            "position": position,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }, on_conflict="name").execute()
+    except Exception as e:
+        logger.error(f"Error saving sync cursor {name}: {e}")
+
+
 def has_subscription(tg_id: int) -> bool:
     """Проверить есть ли активная подписка"""
     if not is_supabase_enabled():
@@ -150,40 +295,74 @@ def has_subscription(tg_id: int) -> bool:
         return False
 
 
-def create_payment(tg_id: int, tariff_code: str, amount: float, provider: str, invoice_id: str):
-    """Создать запись о платеже"""
+def create_payment(tg_id: int, tariff_code: str, amount: float, provider: str, invoice_id: str,
+                   pay_url: str | None = None, expires_at: int | None = None):
+    """Создать запись о платеже (expires_at — epoch-секунды)"""
     if not is_supabase_enabled():
         return
     
     try:
-        from datetime import datetime
+        from datetime import datetime, timezone
         supabase_client.table("payments").insert({
             "tg_id": tg_id,
             "tariff_code": tariff_code,
             "amount": amount,
             "status": "pending",
-            "created_at": datetime.utcnow().isoformat(),
+            "created_at": datetime.now(timezone.utc).isoformat(),
             "provider": provider,
-            "invoice_id": str(invoice_id)
+            "invoice_id": str(invoice_id),
+            "pay_url": pay_url,
+            "expires_at": datetime.fromtimestamp(expires_at, timezone.utc).isoformat() if expires_at else None
         }).execute()
         logger.info(f"Payment created for user {tg_id}")
     except Exception as e:
         logger.error(f"Error creating payment for user {tg_id}: {e}")
 
 
+def get_open_invoice(tg_id: int, tariff_code: str, amount: float, valid_until: int):
+    """Найти неоплаченный счёт пользователя на тот же тариф и сумму: (invoice_id, pay_url)"""
+    if not is_supabase_enabled():
+        return None
+
+    try:
+        from datetime import datetime, timezone
+        response = supabase_client.table("payments").select("invoice_id, pay_url").eq("tg_id", tg_id).eq("status", "pending").eq("provider", "cryptobot").eq("tariff_code", tariff_code).eq("amount", amount).not_.is_("pay_url", "null").gt("expires_at", datetime.fromtimestamp(valid_until, timezone.utc).isoformat()).order("id", desc=True).limit(1).execute()
+        if response.data:
+            row = response.data[0]
+            return (row["invoice_id"], row["pay_url"])
+        return None
+    except Exception as e:
+        logger.error(f"Error getting open invoice for user {tg_id}: {e}")
+        return None
+
+
 def get_pending_payments():
     """Получить все ожидающие платежи"""
     if not is_supabase_enabled():
         return []
     
     try:
-        response = supabase_client.table("payments").select("*").eq("status", "pending").eq("provider", "cryptobot").execute()
-        return response.data
+        response = supabase_client.table("payments").select("id, tg_id, invoice_id, tariff_code").eq("status", "pending").eq("provider", "cryptobot").execute()
+        # Кортежи как в SQLite: проверка платежей распаковывает строки позиционно
+        return [(row["id"], row["tg_id"], row["invoice_id"], row["tariff_code"]) for row in response.data]
     except Exception as e:
         logger.error(f"Error getting pending payments: {e}")
         return []
 
 
+def get_pending_payments_after(after_id: int = 0, limit: int = 1000):
+    """Получить ожидающие платежи с id больше after_id: (id, tg_id, invoice_id, tariff_code, created_at)"""
+    if not is_supabase_enabled():
+        return []
+
+    try:
+        response = supabase_client.table("payments").select("id, tg_id, invoice_id, tariff_code, created_at").eq("status", "pending").eq("provider", "cryptobot").gt("id", after_id).order("id").limit(limit).execute()
+        return [(row["id"], row["tg_id"], row["invoice_id"], row["tariff_code"], row["created_at"]) for row in response.data]
+    except Exception as e:
+        logger.error(f"Error getting pending payments after {after_id}: {e}")
+        return []
+
+
 def get_last_pending_payment(tg_id: int):
     """Получить последний ожидающий платеж пользователя"""
     if not is_supabase_enabled():
@@ -199,6 +378,22 @@ def get_last_pending_payment(tg_id: int):
         return None
 
 
+def get_payment_by_invoice(invoice_id: str):
+    """Получить платёж по invoice_id в виде кортежа (id, tg_id, tariff_code, status)"""
+    if not is_supabase_enabled():
+        return None
+
+    try:
+        response = supabase_client.table("payments").select("id, tg_id, tariff_code, status").eq("invoice_id", str(invoice_id)).limit(1).execute()
+        if response.data:
+            row = response.data[0]
+            return (row["id"], row["tg_id"], row["tariff_code"], row["status"])
+        return None
+    except Exception as e:
+        logger.error(f"Error getting payment for invoice {invoice_id}: {e}")
+        return None
+
+
 def update_payment_status(payment_id: int, status: str):
     """Обновить статус платежа"""
     if not is_supabase_enabled():
@@ -227,36 +422,149 @@ def update_payment_status_by_invoice(invoice_id: str, status: str):
         logger.error(f"Error updating payment {invoice_id} status: {e}")
 
 
+def expire_payments(payment_ids: list) -> int:
+    """Пометить платежи как expired, если они всё ещё ожидают оплаты"""
+    if not is_supabase_enabled():
+        return 0
+
+    try:
+        response = supabase_client.table("payments").update({
+            "status": "expired"
+        }).in_("id", list(payment_ids)).eq("status", "pending").execute()
+        return len(response.data)
+    except Exception as e:
+        logger.error(f"Error expiring payments: {e}")
+        return 0
+
+
+def enqueue_activation(invoice_id: str, tg_id: int, tariff_code: str, days: int) -> bool:
+    """Поставить активацию в outbox; invoice_id — ключ идемпотентности"""
+    if not is_supabase_enabled():
+        return False
+
+    try:
+        response = supabase_client.table("activation_jobs").upsert({
+            "invoice_id": str(invoice_id),
+            "tg_id": tg_id,
+            "tariff_code": tariff_code,
+            "days": days
+        }, on_conflict="invoice_id", ignore_duplicates=True).execute()
+        return bool(response.data)
+    except Exception as e:
+        logger.error(f"Error enqueuing activation for invoice {invoice_id}: {e}")
+        raise
+
+
+def claim_activation_jobs(owner: str, limit: int, lease_seconds: int, invoice_id: str | None = None) -> list:
+    """Захватить готовые задачи outbox (RPC claim_activation_jobs, SKIP LOCKED)"""
+    if not is_supabase_enabled():
+        return []
+
+    try:
+        response = supabase_client.rpc("claim_activation_jobs", {
+            "p_owner": owner,
+            "p_limit": limit,
+            "p_lease_seconds": lease_seconds,
+            "p_invoice_id": str(invoice_id) if invoice_id is not None else None
+        }).execute()
+        return response.data or []
+    except Exception as e:
+        logger.error(f"Error claiming activation jobs: {e}")
+        return []
+
+
+def save_activation_progress(invoice_id: str, owner: str, step: str | None, lease_seconds: int, fields: dict) -> bool:
+    """Сохранить выполненный шаг (None — не менять), продлить аренду задачи"""
+    if not is_supabase_enabled():
+        return False
+
+    from datetime import datetime, timedelta, timezone
+    locked_until = datetime.now(timezone.utc) + timedelta(seconds=lease_seconds)
+    values = {
+        "locked_until": locked_until.isoformat(),
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+        **fields
+    }
+    if step is not None:
+        values["step"] = step
+    try:
+        response = supabase_client.table("activation_jobs").update(values).eq("invoice_id", str(invoice_id)).eq("locked_by", owner).execute()
+        return bool(response.data)
+    except Exception as e:
+        logger.error(f"Error saving activation progress for invoice {invoice_id}: {e}")
+        raise
+
+
+def count_activation_referral(invoice_id: str, owner: str, referrer_id: int | None, lease_seconds: int) -> bool:
+    """Засчитать реферала и отметить шаг referral_count (RPC count_activation_referral)"""
+    if not is_supabase_enabled():
+        return False
+
+    try:
+        return bool(supabase_client.rpc("count_activation_referral", {
+            "p_invoice_id": str(invoice_id),
+            "p_owner": owner,
+            "p_referrer_id": referrer_id,
+            "p_lease_seconds": int(lease_seconds)
+        }).execute().data)
+    except Exception as e:
+        logger.error(f"Error counting referral for invoice {invoice_id}: {e}")
+        raise
+
+
+def finish_activation_job(invoice_id: str, owner: str, state: str, attempts: int,
+                          next_attempt_at: int = 0, last_error: str | None = None):
+    """Завершить попытку и снять аренду (next_attempt_at — epoch-секунды)"""
+    if not is_supabase_enabled():
+        return
+
+    from datetime import datetime, timezone
+    try:
+        supabase_client.table("activation_jobs").update({
+            "state": state,
+            "attempts": attempts,
+            "next_attempt_at": datetime.fromtimestamp(next_attempt_at, timezone.utc).isoformat(),
+            "last_error": last_error,
+            "locked_by": None,
+            "locked_until": None,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }).eq("invoice_id", str(invoice_id)).eq("locked_by", owner).execute()
+    except Exception as e:
+        logger.error(f"Error finishing activation job for invoice {invoice_id}: {e}")
+
+
+def get_activation_backlog() -> dict:
+    """Состояние outbox (RPC activation_backlog)"""
+    if not is_supabase_enabled():
+        return {"counts": {}, "oldest_pending_at": None, "failed": []}
+
+    try:
+        return supabase_client.rpc("activation_backlog").execute().data
+    except Exception as e:
+        logger.error(f"Error getting activation backlog: {e}")
+        return {"counts": {}, "oldest_pending_at": None, "failed": []}
+
+
 def update_referral_count(tg_id: int):
-    """Увеличить счётчик рефералов"""
+    """Увеличить счётчик рефералов (атомарно, RPC increment_referral_count)"""
     if not is_supabase_enabled():
         return
     
     try:
-        user = get_user(tg_id)
-        if user:
-            new_count = (user.get("referral_count", 0) or 0) + 1
-            supabase_client.table("users").update({
-                "referral_count": new_count
-            }).eq("tg_id", tg_id).execute()
-            logger.info(f"Referral count increased for user {tg_id}")
+        supabase_client.rpc("increment_referral_count", {"p_tg_id": tg_id}).execute()
+        logger.info(f"Referral count increased for user {tg_id}")
     except Exception as e:
         logger.error(f"Error updating referral count for user {tg_id}: {e}")
 
 
 def increment_active_referrals(tg_id: int):
-    """Увеличить счётчик активных рефералов"""
+    """Увеличить счётчик активных рефералов (атомарно, RPC increment_active_referrals)"""
     if not is_supabase_enabled():
         return
     
     try:
-        user = get_user(tg_id)
-        if user:
-            new_count = (user.get("active_referrals", 0) or 0) + 1
-            supabase_client.table("users").update({
-                "active_referrals": new_count
-            }).eq("tg_id", tg_id).execute()
-            logger.info(f"Active referrals increased for user {tg_id}")
+        supabase_client.rpc("increment_active_referrals", {"p_tg_id": tg_id}).execute()
+        logger.info(f"Active referrals increased for user {tg_id}")
     except Exception as e:
         logger.error(f"Error incrementing active referrals for user {tg_id}: {e}")
 
@@ -367,54 +675,81 @@ def create_promo_code(code: str, days: int, max_uses: int):
 
 
 def increment_promo_usage(code: str):
-    """Увеличить счётчик использования промокода"""
+    """Увеличить счётчик использования промокода (атомарно, RPC increment_promo_usage)"""
     if not is_supabase_enabled():
         return
     
     try:
-        promo = get_promo_code(code)
-        if promo:
-            new_count = promo[2] + 1
-            supabase_client.table("promo_codes").update({
-                "used_count": new_count
-            }).eq("code", code.upper()).execute()
-            logger.info(f"Promo code {code} usage incremented")
+        supabase_client.rpc("increment_promo_usage", {"p_code": code}).execute()
+        logger.info(f"Promo code {code} usage incremented")
     except Exception as e:
         logger.error(f"Error incrementing promo code usage for {code}: {e}")
 
 
-def acquire_user_lock(tg_id: int) -> bool:
+def redeem_promo_code(code: str):
+    """
+    Списать одно использование промокода, если он активен и лимит не исчерпан
+
+    Проверка и инкремент выполняются одним условным UPDATE на сервере
+    (RPC redeem_promo_code), поэтому параллельные активации не превышают лимит.
+
+    Returns:
+        Кортеж (days, used_count, max_uses) после списания или None
+    """
+    if not is_supabase_enabled():
+        return None
+    
+    try:
+        data = supabase_client.rpc("redeem_promo_code", {"p_code": code}).execute().data
+        if data:
+            return (data.get("days"), data.get("used_count"), data.get("max_uses"))
+        return None
+    except Exception as e:
+        logger.error(f"Error redeeming promo code {code}: {e}")
+        return None
+
+
+def release_promo_code(code: str):
+    """Вернуть использование промокода (если активация не удалась)"""
+    if not is_supabase_enabled():
+        return
+    
+    try:
+        supabase_client.rpc("release_promo_code", {"p_code": code}).execute()
+        logger.info(f"Promo code {code} usage released")
+    except Exception as e:
+        logger.error(f"Error releasing promo code {code}: {e}")
+
+
+def acquire_user_lease(tg_id: int, owner: str, ttl: int) -> bool:
     """
-    Атомарно блокирует пользователя.
-    Возвращает True если блок получен, False если уже занят.
+    Атомарно взять аренду блокировки пользователя (RPC acquire_user_lease).
+    Возвращает True только если условный UPDATE действительно изменил строку.
     """
     if not is_supabase_enabled():
         return True
     
     try:
-        user = get_user(tg_id)
-        if user and not user.get("action_lock", 0):
-            supabase_client.table("users").update({
-                "action_lock": 1
-            }).eq("tg_id", tg_id).eq("action_lock", 0).execute()
-            return True
-        return False
+        response = supabase_client.rpc("acquire_user_lease", {
+            "p_tg_id": tg_id,
+            "p_owner": owner,
+            "p_ttl_seconds": ttl
+        }).execute()
+        return response.data is True
     except Exception as e:
-        logger.error(f"Error acquiring lock for user {tg_id}: {e}")
+        logger.error(f"Error acquiring lease for user {tg_id}: {e}")
         return False
 
 
-def release_user_lock(tg_id: int):
+def release_user_lease(tg_id: int, owner: str):
     """
-    Освобождает блокировку пользователя
+    Освобождает аренду блокировки, если она принадлежит owner
     """
     if not is_supabase_enabled():
         return
     
     try:
-        supabase_client.table("users").update({
-            "action_lock": 0
-        }).eq("tg_id", tg_id).execute()
-        logger.info(f"Lock released for user {tg_id}")
+        supabase_client.rpc("release_user_lease", {"p_tg_id": tg_id, "p_owner": owner}).execute()
+        logger.info(f"Lease released for user {tg_id}")
     except Exception as e:
-        logger.error(f"Error releasing lock for user {tg_id}: {e}")
+        logger.error(f"Error releasing lease for user {tg_id}: {e}")
@@ -0,0 +1,80 @@
+"""
+Блокировки действий пользователя (подарок, промокод, оплата, выдача подписки).
+
+Внутри процесса — asyncio.Lock на каждый tg_id в WeakValueDictionary:
+запись исчезает сама, как только блокировку никто не держит.
+
+При USER_LOCK_BACKEND=db дополнительно берётся аренда в БД (владелец и
+срок истечения), чтобы один пользователь не обрабатывался параллельно
+несколькими процессами бота. Аренда истекает через USER_LOCK_TTL секунд,
+даже если процесс упал, не освободив её.
+"""
+
+import asyncio
+import os
+import socket
+import uuid
+import weakref
+from contextlib import asynccontextmanager
+
+from config import USER_LOCK_BACKEND, USER_LOCK_TTL
+import async_database as db
+import metrics
+
+
+_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+_node_id = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _get_lock(tg_id: int) -> asyncio.Lock:
+    lock = _locks.get(tg_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _locks[tg_id] = lock
+    return lock
+
+
+@asynccontextmanager
+async def user_lock(tg_id: int):
+    """
+    Попытаться заблокировать пользователя на время действия (без ожидания)
+
+    Пример:
+        async with user_lock(tg_id) as acquired:
+            if not acquired:
+                await callback.answer("Подожди пару секунд ⏳", show_alert=True)
+                return
+            ...
+
+    Args:
+        tg_id: ID пользователя Telegram
+
+    Yields:
+        True если блокировка получена, False если пользователь уже занят
+    """
+    lock = _get_lock(tg_id)
+    if lock.locked():
+        metrics.inc("user_lock_busy")
+        yield False
+        return
+
+    # Свободный asyncio.Lock захватывается без переключения задач
+    await lock.acquire()
+    owner = None
+    try:
+        if USER_LOCK_BACKEND == "db":
+            lease_owner = f"{_node_id}:{uuid.uuid4().hex[:8]}"
+            if not await db.acquire_user_lease(tg_id, lease_owner, USER_LOCK_TTL):
+                metrics.inc("user_lock_busy")
+                yield False
+                return
+            owner = lease_owner
+
+        metrics.inc("user_lock_acquired")
+        yield True
+    finally:
+        try:
+            if owner is not None:
+                await db.release_user_lease(tg_id, owner)
+        finally:
+            lock.release()